@@ -30,19 +30,139 @@ will be changed so that there is only one instance of the file:
 """
 from __future__ import print_function
 
+import collections
+import ctypes
+import ctypes.util
+import errno
+import filecmp
 import fnmatch
 import hashlib
+import heapq
+import itertools
+import json
+import multiprocessing
 import os
+import select
 import shutil
+import sqlite3
+import stat
+import struct
 import sys
+import tempfile
 import threading
+import time
 try:
     import queue
 except ImportError:
     import Queue as queue
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    from systemtools.progressbar import ProgressBar
+except ImportError:
+    from progressbar import ProgressBar
+
+# Non-cryptographic hash algorithms, from the xxhash package if installed.
+# Files having the same hash are compared byte-for-byte when these are used.
+if xxhash is not None:
+    FAST_HASHES = tuple(a for a in ('xxh64', 'xxh3_64', 'xxh3_128', 'xxh128')
+                        if hasattr(xxhash, a))
+else:
+    FAST_HASHES = ()
+
+# Hash algorithm used if not specified.
+if 'blake2b' in hashlib.algorithms_available:
+    DEFAULT_HASH = 'blake2b'
+else:
+    DEFAULT_HASH = 'sha1'
+
+# Number of jobs that read from a rotating disk at the same time, unless
+# specified otherwise.
+HDD_JOBS = 1
+
+# Number of bytes read from a file at a time when calculating a hash.
+BLOCKSIZE = 65536
+
+# Per-thread read buffers, reused for every file hashed by a thread.
+_buffers = threading.local()
+
+# Linux ioctl to share identical extents between files, from linux/fs.h:
+# _IOWR(0x94, 54, struct file_dedupe_range)
+FIDEDUPERANGE = 0xc0189436
+FILE_DEDUPE_RANGE_DIFFERS = 1
+
+
+class FileInfo(collections.namedtuple('FileInfo',
+                                      'dir name size dev ino nlink mtime_ns')):
+
+    """
+    Information about a file, from a single stat of the file.
+
+    The path is kept as the directory and the file name.  All files found in
+    the same directory share one directory string, so that long directory
+    paths are not repeated for every file.  The full path is only created
+    when it is used.
+
+    """
+
+    __slots__ = ()
+
+    @property
+    def path(self):
+        return os.path.join(self.dir, self.name)
+
+
+# Number of bytes, read from the start and from the end of a file, that are
+# hashed to eliminate same-size files that differ, before reading the entire
+# file to calculate a full hash.
+PARTIAL_SIZE = 16384
+
+# Seconds that an unused hash cache entry is kept.
+CACHE_MAX_AGE = 30 * 24 * 60 * 60
+
+# Maximum number of files, in groups of same-size files, that are loaded from
+# a checkpoint to be compared at one time.
+CHECKPOINT_FILES = 100000
+
+# Seconds between saving progress to a checkpoint.
+CHECKPOINT_INTERVAL = 60
+
+# Minimum seconds between calls to a progress callback.
+PROGRESS_INTERVAL = 0.5
+
+# Seconds to wait for inotify events, in watch mode, before checking whether
+# to stop.
+WATCH_POLL = 1.0
+
+# Seconds between pruning the hash cache, in watch mode.
+WATCH_PRUNE_INTERVAL = 60 * 60
+
+# Maximum number of sorted runs of file records merged at one time, when the
+# size map is kept on disk.  This limits the number of open files.
+MERGE_WIDTH = 64
+
+# Errors creating a hardlink for which a symlink is created instead.  Other
+# errors, such as the base file not existing, leave the file unchanged.
+_SYMLINK_FALLBACK = (errno.EXDEV, errno.EMLINK, errno.EPERM)
+
+# Sorted run record: size, dev, ino, nlink, mtime_ns, path length.  The path
+# bytes follow each record.
+_RUN_RECORD = struct.Struct('<QQQQqI')
+
 
 def link_same_files(roots, pattern=None, link=False, symlink=False,
-                    absolute=False, quiet=False, verbose=False):
+                    absolute=False, quiet=False, verbose=False, jobs=None,
+                    cache=None, hash_algo=DEFAULT_HASH, block_size=BLOCKSIZE,
+                    verify=None, reflink=False, report=None, stats=None,
+                    device_jobs=None, checkpoint=None, resume=False,
+                    max_files=None, progress=None, cache_max_entries=None,
+                    spill_dir=None):
     """Replace copies of files with links to a single file.
 
     If identical files are found, then the file with the longest path name is
@@ -56,133 +176,1398 @@ def link_same_files(roots, pattern=None, link=False, symlink=False,
     permits links to maintain their validity regardless of the mount point used
     for the filesystem.
 
+    The files in each group of same-size files are hashed by a fixed pool of
+    worker threads.  The number of workers is given by jobs, and defaults to
+    the number of CPUs.  Groups having the most total bytes are scheduled
+    first, so that the longest running jobs are started early.
+
+    The number of workers reading from the same device at once is also
+    limited, so that reads from many threads do not cause a disk to seek
+    constantly.  Rotating disks, as reported by /sys/block/*/queue/rotational,
+    are read by at most HDD_JOBS workers at once.  Limits for specific devices
+    are given by device_jobs, a dictionary of {path or st_dev: limit}, where
+    path is any file on the device.  Files on the same device are read in
+    order of inode number.
+
+    If cache is the path of a hash cache file, then file hashes are read from
+    and saved to the cache.  Only files that have changed since the previous
+    run are read and hashed.  Entries not used for CACHE_MAX_AGE seconds are
+    removed from the cache, and if cache_max_entries is given, then only that
+    many of the most recently used entries are kept.
+
+    Files are hashed using hash_algo, which may be any algorithm supported by
+    hashlib, or one of FAST_HASHES, reading block_size bytes at a time.  If
+    verify is True, then files having the same hash are also compared
+    byte-for-byte before they are linked.  If verify is None, then this is
+    only done when hash_algo is one of FAST_HASHES.
+
+    If reflink is True, then identical files are not replaced by links.
+    Instead, the filesystem is asked to share the data blocks of the files,
+    so that each file remains a separate file, but the storage for its data
+    is shared.  This requires a filesystem, such as btrfs or XFS, that
+    supports the FIDEDUPERANGE ioctl.  Files on filesystems that do not
+    support this are left unchanged.
+
+    If report is a writable file object, then a JSON Lines record is written
+    to it for each group of identical files, as soon as the group is linked.
+    Each record has the group's digest, size, files, base file, and the
+    action taken for each file.  A final record gives the summary stats.
+
+    If stats is a LinkStats instance, then it is updated with the numbers of
+    files compared and linked, and other statistics about the run.
+
+    If checkpoint is the path of a checkpoint file, then the files found by
+    walking the directory trees, and the groups of files that have been
+    compared and linked, are saved to that file.  While walking, the files
+    found and the directories that are done are saved every 10000 files.
+    While comparing, progress is saved every CHECKPOINT_INTERVAL seconds, and
+    when the run is interrupted.  Only up to max_files files, or
+    CHECKPOINT_FILES if max_files is not given, are loaded to be compared at
+    one time.  If resume is True, then an interrupted run is continued from
+    the checkpoint, either walking the directories not yet walked, or
+    comparing the groups not yet done.  A new run is started if there is
+    nothing to resume.  The checkpoint file is removed when the run
+    completes.
+
+    If max_files is given without a checkpoint, then the files found by
+    walking the directory trees are written to sorted runs of at most
+    max_files files in a temporary directory, instead of being held in memory.
+    The runs are merged, and each group of same-size files is read back as it
+    is needed, so only about max_files files are held in memory at once.  The
+    temporary directory is created in spill_dir, if given.  Otherwise, it is
+    created in the system temporary directory, which is often a tmpfs held in
+    memory, so spill_dir should be given to keep the runs on disk.
+
+    If progress is given, then progress(p) is called with a LinkProgress, p,
+    at most every PROGRESS_INTERVAL seconds while the run makes progress, and
+    when the run is done.
+
     Return: None if OK.  Otherwise, error string.
 
     """
     roots, err = _normalize_roots(roots, quiet)
     if err:
         return err
+    if resume and not checkpoint:
+        return 'cannot resume without checkpoint'
+    if reflink and symlink:
+        return 'cannot use both reflink and symlink'
+    if max_files is not None and max_files < 1:
+        return 'max files must be at least 1'
+    if spill_dir is not None and not os.path.isdir(spill_dir):
+        return 'spill directory %s is not a directory' % (spill_dir,)
+    if cache_max_entries is not None and cache_max_entries < 1:
+        return 'cache max entries must be at least 1'
+
+    if not jobs:
+        jobs = multiprocessing.cpu_count()
+    elif jobs < 1:
+        return 'jobs must be a positive number'
+    device_jobs, err = _resolve_device_jobs(device_jobs)
+    if err:
+        return err
+    err = _check_hash_args(hash_algo, block_size)
+    if err:
+        return err
+    if verify is None:
+        verify = hash_algo in FAST_HASHES
 
-    if not quiet:
-        print('Linking identical files in', ', '.join(roots))
-
-    # Walk directory and create map, {size: filepath, ..}.  This allows files,
-    # that do not match another file in size, to be eliminated without having
-    # to calculate a hash of the file.
-    size_file_map = {}
-    for root_dir in roots:
-        for dirpath, dirnames, filenames in os.walk(root_dir):
-            for fname in filenames:
-                fpath = os.path.join(dirpath, fname)
-                if not os.path.isfile(fpath) or os.path.islink(fpath):
-                    continue
-                fsize = os.path.getsize(fpath)
-                if fsize == 0:
-                    continue
-                if pattern and not fnmatch.fnmatch(fname, pattern):
-                    continue
-                size_file_map.setdefault(fsize, []).append(fpath)
-
-    statsq = queue.Queue()
-
-    #  Thread function to check and link files concurrently.
-    def check_and_link(filepaths):
-        links = 0
-        saved = 0
-        hash_map = _create_hash_map(filepaths)
-        for files in hash_map.itervalues():
-            if len(files) < 2:
-                continue
-            l, s = _link_files(files, link, symlink, absolute, verbose)
-            links += l
-            saved += s
-
-        statsq.put((links, saved))
+    state = None
+    if checkpoint:
+        try:
+            state = _Checkpoint(checkpoint)
+        except sqlite3.Error as e:
+            return 'cannot open checkpoint %s: %s' % (checkpoint, e)
+        if resume and state.phase() is None:
+            # No run to resume, as when the previous run completed, so start
+            # a new run.
+            resume = False
+        if resume and not state.matches(roots, pattern):
+            state.close()
+            return 'checkpoint %s is for a different run' % (checkpoint,)
 
-    wait_count = 0
-    for same_size_files in size_file_map.itervalues():
-        if len(same_size_files) < 2:
-            # Skip unique files
-            continue
-        wait_count += 1
-        t = threading.Thread(target=check_and_link, args=(same_size_files,))
-        t.start()
+    if not quiet:
+        if resume:
+            print('Resuming linking identical files in', ', '.join(roots))
+        else:
+            print('Linking identical files in', ', '.join(roots))
 
-    link_count = 0
-    size_saved = 0
-    while wait_count:
-        l, s = statsq.get()
-        wait_count -= 1
-        link_count += l
-        size_saved += s
+    hash_cache = None
+    if cache:
+        try:
+            hash_cache = HashCache(cache, hash_algo,
+                                   max_entries=cache_max_entries)
+        except sqlite3.Error as e:
+            if state:
+                state.close()
+            return 'cannot open hash cache %s: %s' % (cache, e)
+
+    if stats is None:
+        stats = LinkStats()
+    if report is not None:
+        report = _Report(report)
+    tracker = LinkProgress(progress) if progress else None
+    on_read = tracker._read if tracker else None
+
+    #  Worker function to check and link files concurrently.
+    def check_and_link(bucket):
+        fsize, filepaths = bucket
+        st = LinkStats()
+        st.file_count = len(filepaths)
+        st.candidate_bytes = fsize * len(filepaths)
+        hash_map, st.bytes_read, st.hashes_avoided = _create_hash_map(
+            filepaths, fsize, hash_cache, hash_algo, block_size,
+            on_read=on_read, quiet=quiet)
+        _link_hash_map(hash_map, st, verify, link, symlink, absolute, verbose,
+                       reflink, report, quiet)
+        return st
+
+    try:
+        if state:
+            _run_checkpointed(check_and_link, state, roots, pattern, resume,
+                              jobs, stats, device_jobs,
+                              max_files or CHECKPOINT_FILES, tracker)
+        elif max_files:
+            _run_external(check_and_link, roots, pattern, max_files, jobs,
+                          stats, device_jobs, tracker, spill_dir)
+        else:
+            # Walk directory and create map, {size: [FileInfo, ..], ..}.  This
+            # allows files, that do not match another file in size, to be
+            # eliminated without having to calculate a hash of the file.
+            size_file_map = {}
+            for info in _walk_files(roots, pattern, tracker):
+                size_file_map.setdefault(info.size, []).append(info)
+            buckets = _make_buckets(size_file_map.items(), stats)
+            _run_buckets(check_and_link, buckets, jobs, stats, device_jobs,
+                         None, tracker)
+    finally:
+        if hash_cache:
+            hash_cache.close()
+        if state:
+            state.close(stats)
+    if state:
+        state.remove()
+    if tracker:
+        tracker._finish()
+    _write_summary(report, stats)
 
     if not quiet:
-        print()
-        if not link:
-            print('If writing links (-w), would have...')
-        print('Replaced', link_count, 'files with links')
-        print('Reduced storage by', size_str(size_saved))
+        _print_summary(stats, link, reflink, hash_cache)
 
     return None
 
 
 def link_same_update(update_file, roots, pattern=None, link=False,
                      symlink=False, absolute=False, quiet=False,
-                     verbose=False):
+                     verbose=False, cache=None, hash_algo=DEFAULT_HASH,
+                     block_size=BLOCKSIZE, verify=None, reflink=False,
+                     report=None, stats=None, device_jobs=None,
+                     progress=None, cache_max_entries=None):
     """Replace copies of a specified file with links to a single file.
 
+    This is the same as calling link_same_updates() with a single update file.
+
     Return: None if OK.  Otherwise, error string.
 
     """
     if not update_file:
         return "Update file not specified"
+    return link_same_updates([update_file], roots, pattern, link, symlink,
+                             absolute, quiet, verbose, None, cache, hash_algo,
+                             block_size, verify, reflink, report, stats,
+                             device_jobs, progress, cache_max_entries)
+
+
+def link_same_updates(update_files, roots, pattern=None, link=False,
+                      symlink=False, absolute=False, quiet=False,
+                      verbose=False, jobs=None, cache=None,
+                      hash_algo=DEFAULT_HASH, block_size=BLOCKSIZE,
+                      verify=None, reflink=False, report=None, stats=None,
+                      device_jobs=None, progress=None,
+                      cache_max_entries=None):
+    """Replace copies of any of the specified files with links.
+
+    The directory trees under roots are walked once, to find files that have
+    the same size as any of the update files.  Only those files are hashed,
+    and each file that is identical to an update file is linked to it, or to
+    the copy with the longest name as in link_same_files().
+
+    The jobs, cache, hash_algo, block_size, verify, reflink, report, stats,
+    device_jobs, progress, and cache_max_entries arguments are the same as
+    for link_same_files().
+
+    Return: None if OK.  Otherwise, error string.
+
+    """
+    if not update_files:
+        return "Update file not specified"
     roots, err = _normalize_roots(roots, quiet)
     if err:
         return err
-    if not os.path.isfile(update_file):
-        return '%s is not a file' % (update_file,)
-    update_size = os.path.getsize(update_file)
-    if update_size == 0:
-        return '%s is empty' % (update_file,)
-    update_hash = _hash_file(update_file)
+    if reflink and symlink:
+        return 'cannot use both reflink and symlink'
+    if cache_max_entries is not None and cache_max_entries < 1:
+        return 'cache max entries must be at least 1'
+    if not jobs:
+        jobs = multiprocessing.cpu_count()
+    elif jobs < 1:
+        return 'jobs must be a positive number'
+    device_jobs, err = _resolve_device_jobs(device_jobs)
+    if err:
+        return err
+    err = _check_hash_args(hash_algo, block_size)
+    if err:
+        return err
+    if verify is None:
+        verify = hash_algo in FAST_HASHES
+
+    # Map of {size: [FileInfo, ..]} for update files.
+    update_map = {}
+    update_inodes = set()
+    for update_file in update_files:
+        try:
+            info = _file_info(update_file)
+        except OSError as e:
+            return 'cannot stat %s: %s' % (update_file, e)
+        if info is None:
+            return '%s is not a file' % (update_file,)
+        if info.size == 0:
+            return '%s is empty' % (update_file,)
+        if (info.dev, info.ino) in update_inodes:
+            continue
+        update_inodes.add((info.dev, info.ino))
+        update_map.setdefault(info.size, []).append(info)
 
     if not quiet:
-        print('Linking', update_file, 'to identical files in',
-              ', '.join(roots))
-
-    # Walk directory and find files that are identical to the update file.
-    same = [update_file]
-    for root_dir in roots:
-        for dirpath, dirnames, filenames in os.walk(root_dir):
-            for fname in filenames:
-                fpath = os.path.join(dirpath, fname)
-                if not os.path.isfile(fpath) or os.path.islink(fpath):
-                    continue
-                if os.path.getsize(fpath) != update_size:
-                    continue
-                if pattern and not fnmatch.fnmatch(fname, pattern):
-                    continue
-                if _hash_file(fpath) != update_hash:
-                    continue
-                same.append(fpath)
+        if len(update_files) == 1:
+            print('Linking', update_files[0], 'to identical files in',
+                  ', '.join(roots))
+        else:
+            print('Linking', len(update_files), 'update files to identical '
+                  'files in', ', '.join(roots))
 
-    link_count = 0
-    size_saved = 0
-    if len(same) > 1:
-        # Link files that are identical to the update file.
-        link_count, size_saved = _link_files(same, link, symlink, absolute,
-                                             verbose)
+    hash_cache = None
+    if cache:
+        try:
+            hash_cache = HashCache(cache, hash_algo,
+                                   max_entries=cache_max_entries)
+        except sqlite3.Error as e:
+            return 'cannot open hash cache %s: %s' % (cache, e)
+
+    tracker = LinkProgress(progress) if progress else None
+    on_read = tracker._read if tracker else None
+
+    # Walk directory once and add files having the same size as an update
+    # file.  Files that are already hardlinks to an update file are skipped.
+    size_file_map = dict((fsize, list(infos))
+                         for fsize, infos in update_map.items())
+    for info in _walk_files(roots, pattern, tracker):
+        if info.size not in update_map:
+            continue
+        if (info.dev, info.ino) in update_inodes:
+            continue
+        size_file_map[info.size].append(info)
+
+    if stats is None:
+        stats = LinkStats()
+    if report is not None:
+        report = _Report(report)
+
+    #  Worker function to check and link files concurrently.
+    def check_and_link(bucket):
+        fsize, filepaths = bucket
+        st = LinkStats()
+        st.file_count = len(filepaths)
+        st.candidate_bytes = fsize * len(filepaths)
+        hash_map, st.bytes_read, st.hashes_avoided = _create_hash_map(
+            filepaths, fsize, hash_cache, hash_algo, block_size,
+            update_inodes, on_read, quiet)
+        _link_hash_map(hash_map, st, verify, link, symlink, absolute, verbose,
+                       reflink, report, quiet)
+        return st
+
+    buckets = _make_buckets(size_file_map.items(), stats)
+    try:
+        _run_buckets(check_and_link, buckets, jobs, stats, device_jobs, None,
+                     tracker)
+    finally:
+        if hash_cache:
+            hash_cache.close()
+    if tracker:
+        tracker._finish()
+    _write_summary(report, stats)
 
     if not quiet:
-        print()
-        if not link:
-            print('If writing links (-w), would have...')
-        print('Replaced', link_count, 'files with links')
-        print('Reduced storage by', size_str(size_saved))
+        _print_summary(stats, link, reflink, hash_cache)
+
+    return None
+
+
+def watch_same_files(roots, pattern=None, link=False, symlink=False,
+                     absolute=False, quiet=False, verbose=False, cache=None,
+                     hash_algo=DEFAULT_HASH, block_size=BLOCKSIZE,
+                     verify=None, reflink=False, report=None, stats=None,
+                     stop=None, cache_max_entries=None):
+    """Watch for new and modified files, and link them to identical files.
+
+    The directory trees under roots are walked once to build an index of the
+    files by size, and inotify watches are added for every directory.  Then,
+    whenever a file is written or moved into a watched directory, it is
+    compared with the indexed files of the same size, and linked as in
+    link_same_files() if an identical file is found.  Existing copies are not
+    linked, so link_same_files() should be run once before watching.
+
+    File hashes are kept in the hash cache, so that each indexed file is only
+    read once.  If cache is not given, then the hashes are kept in memory.
+    Hashes of files that are removed or changed are dropped from the cache,
+    and the cache is pruned every WATCH_PRUNE_INTERVAL seconds.  The other
+    arguments are the same as for link_same_files().
+
+    Watching continues until stop.is_set() returns True, checked every
+    WATCH_POLL seconds, or until interrupted if stop is not given.  This is
+    only available on Linux.
+
+    Return: None if OK.  Otherwise, error string.
+
+    """
+    roots, err = _normalize_roots(roots, quiet)
+    if err:
+        return err
+    if reflink and symlink:
+        return 'cannot use both reflink and symlink'
+    if cache_max_entries is not None and cache_max_entries < 1:
+        return 'cache max entries must be at least 1'
+    err = _check_hash_args(hash_algo, block_size)
+    if err:
+        return err
+    if verify is None:
+        verify = hash_algo in FAST_HASHES
+
+    try:
+        hash_cache = HashCache(cache or ':memory:', hash_algo,
+                               max_entries=cache_max_entries)
+    except sqlite3.Error as e:
+        return 'cannot open hash cache %s: %s' % (cache, e)
+    if stats is None:
+        stats = LinkStats()
+    if report is not None:
+        report = _Report(report)
+
+    try:
+        watcher = _Watcher(roots, pattern, hash_cache, hash_algo, block_size,
+                           (verify, link, symlink, absolute, verbose,
+                            reflink, report), stats, quiet)
+    except OSError as e:
+        hash_cache.close()
+        return 'cannot watch files: %s' % (e,)
+    try:
+        watcher.scan()
+        if not quiet:
+            print('Watching', watcher.dir_count(), 'directories in',
+                  ', '.join(roots))
+        last_prune = time.time()
+        while stop is None or not stop.is_set():
+            watcher.poll(WATCH_POLL)
+            if time.time() - last_prune >= WATCH_PRUNE_INTERVAL:
+                hash_cache.prune()
+                last_prune = time.time()
+    except KeyboardInterrupt:
+        if stop is not None:
+            raise
+    finally:
+        watcher.close()
+        hash_cache.close()
+    _write_summary(report, stats)
+
+    if not quiet:
+        _print_summary(stats, link, reflink, cache and hash_cache)
 
     return None
 
 
+class LinkStats(object):
+
+    """
+    Statistics about the files compared and linked by a linksame run.
+
+    """
+
+    # Names of the counts, summed when combining stats.
+    COUNTS = ('link_count', 'size_saved', 'group_count', 'file_count',
+              'candidate_bytes', 'bytes_read', 'hashes_avoided')
+
+    def __init__(self):
+        self.link_count = 0       # Files replaced with links
+        self.size_saved = 0       # Bytes of storage saved
+        self.group_count = 0      # Groups of identical files found
+        self.file_count = 0       # Same-size files compared
+        self.candidate_bytes = 0  # Total size of files compared
+        self.bytes_read = 0       # Bytes read to compare files
+        self.hashes_avoided = 0   # Hashes not needed for existing hardlinks
+        self.elapsed = 0.0        # Seconds spent comparing and linking
+
+    def __repr__(self):
+        return 'LinkStats(%s)' % (', '.join(
+            '%s=%r' % item for item in sorted(self.as_dict().items())),)
+
+    def add(self, other):
+        """Add the counts from other LinkStats to this one."""
+        for name in LinkStats.COUNTS:
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+
+    def as_dict(self):
+        """Return stats as a dictionary."""
+        d = dict((name, getattr(self, name)) for name in LinkStats.COUNTS)
+        d['elapsed'] = self.elapsed
+        return d
+
+
+class LinkProgress(object):
+
+    """
+    Progress of a running link_same_files or link_same_updates call.
+
+    A LinkProgress is passed to the progress callback given to those
+    functions.  Calls to the callback are made from whichever thread made the
+    progress, but never more than one at a time, so the callback should
+    return quickly.
+
+    Attributes:
+    phase           -- 'walk' while finding files, 'hash' while comparing and
+                       linking files, and 'done' when finished.
+    files_walked    -- Files found while walking the directory trees.
+    candidate_bytes -- Total bytes of same-size files to compare, so far.
+    bytes_remaining -- Bytes of same-size files not yet compared.
+    bytes_hashed    -- Bytes read to hash files.
+    group_count     -- Groups of same-size files to compare, so far.
+    groups_done     -- Groups of same-size files compared and linked.
+    link_count      -- Files replaced with links.
+
+    """
+
+    def __init__(self, callback, interval=PROGRESS_INTERVAL):
+        self.phase = 'walk'
+        self.files_walked = 0
+        self.candidate_bytes = 0
+        self.bytes_remaining = 0
+        self.bytes_hashed = 0
+        self.group_count = 0
+        self.groups_done = 0
+        self.link_count = 0
+        self._callback = callback
+        self._interval = interval
+        self._lock = threading.Lock()
+        self._last = 0.0
+        self._hash_start = None
+
+    def __repr__(self):
+        return ('LinkProgress(phase=%r, files_walked=%d, bytes_remaining=%d, '
+                'bytes_hashed=%d, groups_done=%d/%d)' % (
+                    self.phase, self.files_walked, self.bytes_remaining,
+                    self.bytes_hashed, self.groups_done, self.group_count))
+
+    def hash_rate(self):
+        """Return bytes hashed per second since comparing files started."""
+        if self._hash_start is None:
+            return 0.0
+        return self.bytes_hashed / max(time.time() - self._hash_start, 1e-6)
+
+    def _walked(self):
+        # Called for each file found, so only check the time every so often.
+        self.files_walked += 1
+        if not self.files_walked & 0xff:
+            with self._lock:
+                self._notify()
+
+    def _add_groups(self, buckets):
+        with self._lock:
+            if self._hash_start is None:
+                self._hash_start = time.time()
+            self.phase = 'hash'
+            for fsize, files in buckets:
+                self.candidate_bytes += fsize * len(files)
+                self.bytes_remaining += fsize * len(files)
+            self.group_count += len(buckets)
+            self._notify(True)
+
+    def _read(self, nbytes):
+        with self._lock:
+            self.bytes_hashed += nbytes
+            self._notify()
+
+    def _group_done(self, bucket, stats):
+        with self._lock:
+            self.bytes_remaining -= bucket[0] * len(bucket[1])
+            self.groups_done += 1
+            self.link_count += stats.link_count
+            self._notify()
+
+    def _finish(self):
+        with self._lock:
+            self.phase = 'done'
+            self._notify(True)
+
+    def _notify(self, force=False):
+        # Must be called with lock held.
+        now = time.time()
+        if force or now - self._last >= self._interval:
+            self._last = now
+            self._callback(self)
+
+
+class _ProgressDisplay(object):
+
+    """
+    Progress callback that shows progress using a ProgressBar.
+
+    The bar shows the bytes of same-size files that have been compared.  If
+    more files to compare are found after the bar is started, as when files
+    are compared in batches, then a new bar is started.
+
+    """
+
+    def __init__(self):
+        self._bar = None
+        self._total = 0
+        self._done = 0
+        self._walk_line = False
+
+    def __call__(self, p):
+        if p.phase == 'walk':
+            sys.stdout.write('\rFound %d files' % (p.files_walked,))
+            sys.stdout.flush()
+            self._walk_line = True
+            return
+        if self._walk_line:
+            print()
+            self._walk_line = False
+        if p.candidate_bytes != self._total:
+            if self._bar is not None:
+                self._bar.finish()
+                self._bar = None
+            self._total = p.candidate_bytes
+            self._done = 0
+            if self._total > 1:
+                self._bar = ProgressBar(self._total, fraction=False)
+        if self._bar is not None:
+            done = p.candidate_bytes - p.bytes_remaining
+            self._bar.update(done - self._done)
+            self._done = done
+            if p.phase == 'done':
+                self._bar.finish()
+                self._bar = None
+
+
+class _Inotify(object):
+
+    """
+    Linux inotify instance, using the C library through ctypes.
+
+    """
+
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_DONT_FOLLOW = 0x02000000
+    IN_ISDIR = 0x40000000
+
+    # Events watched in each directory.
+    DIR_EVENTS = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+                  IN_DELETE | IN_ONLYDIR | IN_DONT_FOLLOW)
+
+    # struct inotify_event: wd, mask, cookie, len, followed by name.
+    EVENT = struct.Struct('iIII')
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        try:
+            self._add_watch = libc.inotify_add_watch
+            init1 = libc.inotify_init1
+        except AttributeError:
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        self._add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p,
+                                    ctypes.c_uint32)
+        self.fd = init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+
+    def add_watch(self, path, mask=DIR_EVENTS):
+        """Watch path for events in mask, and return the watch descriptor."""
+        wd = self._add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e), path)
+        return wd
+
+    def read_events(self, timeout):
+        """Return list of (wd, mask, name) for events, waiting up to timeout.
+
+        The name is the name of the file in the watched directory, or an empty
+        string if the event is for the directory itself.
+
+        """
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        data = os.read(self.fd, 65536)
+        events = []
+        pos = 0
+        while pos < len(data):
+            wd, mask, _, name_len = _Inotify.EVENT.unpack_from(data, pos)
+            pos += _Inotify.EVENT.size
+            name = data[pos:pos + name_len].rstrip(b'\0')
+            pos += name_len
+            events.append((wd, mask, os.fsdecode(name)))
+        return events
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+class _Watcher(object):
+
+    """
+    Index of files by size, kept up to date using inotify.
+
+    Each file that is written or moved into a watched directory is compared
+    with the indexed files of the same size, and linked to an identical file.
+
+    """
+
+    def __init__(self, roots, pattern, hash_cache, hash_algo, block_size,
+                 link_args, stats, quiet=False):
+        self._roots = roots
+        self._pattern = pattern
+        self._hash_cache = hash_cache
+        self._hash_algo = hash_algo
+        self._block_size = block_size
+        # Arguments to _link_hash_map after the hash map and stats.
+        self._link_args = link_args
+        self._stats = stats
+        self._quiet = quiet
+        self._limit_reported = False
+        self._inotify = _Inotify()
+        self._watches = {}     # {wd: dirpath}
+        self._sizes = {}       # {size: {path: FileInfo}}
+        self._paths = {}       # {path: size}
+        self._keys = {}        # {_stat_key: number of paths}
+
+    def dir_count(self):
+        """Return the number of directories watched."""
+        return len(self._watches)
+
+    def scan(self):
+        """Watch all directories under roots, and index all files."""
+        old_keys = self._keys
+        self._watches.clear()
+        self._sizes.clear()
+        self._paths.clear()
+        self._keys = {}
+        for root in self._roots:
+            self._add_tree(root, False)
+        # Drop cached hashes of files that are gone or have changed.
+        for key in old_keys:
+            if key not in self._keys:
+                self._hash_cache.discard(key)
+
+    def rescan(self):
+        """Scan again, and check the files that are new or have changed.
+
+        This is done when inotify events were lost, so that files written
+        while the events were lost are still compared and linked.
+
+        """
+        old = dict((path, _stat_key(self._sizes[fsize][path]))
+                   for path, fsize in self._paths.items())
+        self.scan()
+        changed = [path for path, fsize in self._paths.items()
+                   if old.get(path) != _stat_key(self._sizes[fsize][path])]
+        for path in changed:
+            # Remove from the index, so that the file is not seen as
+            # unchanged when it is checked.
+            self._remove(path)
+            self._check_file(path)
+
+    def poll(self, timeout):
+        """Wait up to timeout seconds for events, and handle them."""
+        for wd, mask, name in self._inotify.read_events(timeout):
+            if mask & _Inotify.IN_Q_OVERFLOW:
+                # Events were lost, so start over.
+                self.rescan()
+                continue
+            dirpath = self._watches.get(wd)
+            if dirpath is None:
+                continue
+            if mask & _Inotify.IN_IGNORED:
+                # Directory was removed.
+                del self._watches[wd]
+                continue
+            if not name:
+                continue
+            path = os.path.join(dirpath, name)
+            if mask & _Inotify.IN_ISDIR:
+                if mask & (_Inotify.IN_CREATE | _Inotify.IN_MOVED_TO):
+                    self._add_tree(path, True)
+                elif mask & _Inotify.IN_MOVED_FROM:
+                    self._remove_tree(path)
+            elif mask & (_Inotify.IN_CLOSE_WRITE | _Inotify.IN_MOVED_TO):
+                self._check_file(path)
+            elif mask & (_Inotify.IN_DELETE | _Inotify.IN_MOVED_FROM):
+                self._remove(path)
+
+    def close(self):
+        self._inotify.close()
+
+    def _add_tree(self, top, check):
+        # Watch top and all directories under it, and index files.  Files
+        # are compared and linked if check is True.
+        dirs = [top]
+        while dirs:
+            dirpath = dirs.pop()
+            try:
+                self._watches[self._inotify.add_watch(dirpath)] = dirpath
+            except OSError as e:
+                # Files in the directory are still indexed, so that they can
+                # be linked to new files in directories that are watched.
+                if e.errno == errno.ENOSPC:
+                    self._watch_limit(dirpath, e)
+            try:
+                it = os.scandir(dirpath)
+            except OSError:
+                continue
+            with it:
+                for entry in it:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            dirs.append(entry.path)
+                        elif check:
+                            self._check_file(entry.path)
+                        elif self._matches(entry.name):
+                            self._add(_file_info(
+                                entry.path, entry.stat(follow_symlinks=False),
+                                dirpath))
+                    except OSError:
+                        continue
+
+    def _watch_limit(self, dirpath, err):
+        # Report, once, that the limit on the number of watches was reached.
+        if self._limit_reported or self._quiet:
+            return
+        self._limit_reported = True
+        print('cannot watch %s: %s.  Directories are not watched for new '
+              'files beyond this limit.  Increase the '
+              'fs.inotify.max_user_watches sysctl to watch them.' % (
+                  dirpath, err), file=sys.stderr)
+
+    def _remove_tree(self, top):
+        prefix = os.path.join(top, '')
+        for path in [p for p in self._paths if p.startswith(prefix)]:
+            self._remove(path)
+
+    def _matches(self, name):
+        return not self._pattern or fnmatch.fnmatch(name, self._pattern)
+
+    def _add(self, info):
+        if info is None or not info.size:
+            return
+        path = info.path
+        # Forget the file this replaces only after adding the new file, so
+        # that the cached hash is kept if the file is unchanged.
+        old = self._remove(path, False)
+        self._sizes.setdefault(info.size, {})[path] = info
+        self._paths[path] = info.size
+        key = _stat_key(info)
+        self._keys[key] = self._keys.get(key, 0) + 1
+        if old is not None:
+            self._forget(old)
+
+    def _remove(self, path, forget=True):
+        # Remove path from the index, and return its FileInfo, or None.
+        fsize = self._paths.pop(path, None)
+        if fsize is None:
+            return None
+        files = self._sizes[fsize]
+        info = files.pop(path)
+        if not files:
+            del self._sizes[fsize]
+        key = _stat_key(info)
+        self._keys[key] -= 1
+        if not self._keys[key]:
+            del self._keys[key]
+        if forget:
+            self._forget(info)
+        return info
+
+    def _forget(self, info):
+        # Drop cached hashes of a file that no indexed path refers to.
+        key = _stat_key(info)
+        if key not in self._keys:
+            self._hash_cache.discard(key)
+
+    def _check_file(self, path):
+        # Index a new or changed file, and link it to an identical file.
+        if not self._matches(os.path.basename(path)):
+            return
+        try:
+            info = _file_info(path)
+        except OSError:
+            info = None
+        fsize = self._paths.get(path)
+        if info is not None and fsize is not None:
+            if _stat_key(self._sizes[fsize][path]) == _stat_key(info):
+                # Unchanged, as when the file was just replaced by a link.
+                return
+        self._remove(path)
+        if info is None or not info.size:
+            return
+        others = list(self._sizes.get(info.size, {}).values())
+        self._add(info)
+        if not others:
+            return
+
+        files = others + [info]
+        st = LinkStats()
+        st.file_count = len(files)
+        st.candidate_bytes = info.size * len(files)
+        start = time.time()
+        try:
+            hash_map, st.bytes_read, st.hashes_avoided = _create_hash_map(
+                files, info.size, self._hash_cache, self._hash_algo,
+                self._block_size, set([(info.dev, info.ino)]), quiet=True)
+            paths = [i.path for group in hash_map.values() for i in group]
+            _link_hash_map(hash_map, st, *self._link_args, quiet=True)
+        except (IOError, OSError):
+            # File was removed or changed while being read or compared.
+            return
+        self._stats.add(st)
+        self._stats.elapsed += time.time() - start
+
+        # Linked files are replaced, so index them again.
+        for p in paths:
+            try:
+                self._add(_file_info(p))
+            except OSError:
+                self._remove(p)
+
+
+class _Checkpoint(object):
+
+    """
+    Progress of a link_same_files run, saved in a SQLite database.
+
+    The database holds the files found by walking the directory trees, the
+    directories that have not been walked yet, and which groups of same-size
+    files have been compared and linked, so that an interrupted run can be
+    resumed without walking or comparing again.
+
+    """
+
+    # Version of database layout.  The checkpoint is discarded if different.
+    SCHEMA_VERSION = 2
+
+    # Number of files found during the walk between commits.
+    BATCH_SIZE = 10000
+
+    # Tables in the database.
+    TABLES = ('meta', 'files', 'dirs', 'buckets')
+
+    def __init__(self, path):
+        self._path = path
+        self._db = sqlite3.connect(path)
+        self._batch = []
+        self._last_save = time.time()
+        version = self._db.execute('PRAGMA user_version').fetchone()[0]
+        if version != _Checkpoint.SCHEMA_VERSION:
+            for table in _Checkpoint.TABLES:
+                self._db.execute('DROP TABLE IF EXISTS %s' % (table,))
+            self._db.execute('PRAGMA user_version = %d'
+                             % (_Checkpoint.SCHEMA_VERSION,))
+        self._db.execute('CREATE TABLE IF NOT EXISTS meta ('
+                         'key TEXT PRIMARY KEY, value TEXT)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS files ('
+                         'size INTEGER, path BLOB, dev INTEGER, ino INTEGER, '
+                         'nlink INTEGER, mtime_ns INTEGER)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS files_size ON '
+                         'files (size)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS dirs ('
+                         'path BLOB PRIMARY KEY)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS buckets ('
+                         'size INTEGER PRIMARY KEY, count INTEGER, '
+                         'priority INTEGER, done INTEGER)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS buckets_todo ON '
+                         'buckets (done, priority)')
+        self._db.commit()
+
+    def phase(self):
+        """Return 'walk', 'hash', or None if nothing saved."""
+        return self._get('phase')
+
+    def matches(self, roots, pattern):
+        """Return True if checkpoint is for a run with roots and pattern."""
+        return (self._get('roots') == list(roots) and
+                self._get('pattern') == pattern)
+
+    def start(self, roots, pattern):
+        """Discard any saved progress, and start a new run."""
+        for table in _Checkpoint.TABLES:
+            self._db.execute('DELETE FROM %s' % (table,))
+        self._db.executemany('INSERT INTO dirs (path) VALUES (?)',
+                             [(os.fsencode(root),) for root in roots])
+        self._set('roots', list(roots))
+        self._set('pattern', pattern)
+        self._set('phase', 'walk')
+        self._db.commit()
+
+    def pending_dirs(self):
+        """Return list of the directories that have not been walked."""
+        return [os.fsdecode(path) for path, in
+                self._db.execute('SELECT path FROM dirs')]
+
+    def add_dir(self, dirpath, infos, subdirs):
+        """Save the files and subdirectories found in a walked directory.
+
+        The directory is marked as walked in the same transaction that saves
+        its files, so a resumed walk neither misses nor repeats any files.
+        Changes are committed every BATCH_SIZE files.
+
+        """
+        for info in infos:
+            self._batch.append((info.size, os.fsencode(info.path), info.dev,
+                                info.ino, info.nlink, info.mtime_ns))
+        self._db.executemany('INSERT OR IGNORE INTO dirs (path) VALUES (?)',
+                             [(os.fsencode(d),) for d in subdirs])
+        self._db.execute('DELETE FROM dirs WHERE path=?',
+                         (os.fsencode(dirpath),))
+        if len(self._batch) >= _Checkpoint.BATCH_SIZE:
+            self._flush()
+            self._db.commit()
+
+    def finish_walk(self):
+        """Save the groups of same-size files that need to be compared."""
+        self._flush()
+        self._db.execute(
+            'INSERT INTO buckets (size, count, priority, done) SELECT size, '
+            'COUNT(*), size * COUNT(*), 0 FROM files GROUP BY size '
+            'HAVING COUNT(*) > 1')
+        self._db.execute('DELETE FROM files WHERE size NOT IN '
+                         '(SELECT size FROM buckets)')
+        self._db.execute('DELETE FROM dirs')
+        self._set('phase', 'hash')
+        self._db.commit()
+
+    def next_sizes(self, max_files):
+        """Return sizes of the next groups to compare, up to max_files files.
+
+        At least one group is returned, if any groups have not been compared.
+
+        """
+        sizes = []
+        total = 0
+        rows = self._db.execute(
+            'SELECT size, count FROM buckets WHERE done=0 '
+            'ORDER BY priority DESC LIMIT 1000')
+        for fsize, count in rows:
+            if sizes and total + count > max_files:
+                break
+            sizes.append(fsize)
+            total += count
+        return sizes
+
+    def files(self, fsize):
+        """Return list of FileInfo for files of the given size."""
+        rows = self._db.execute(
+            'SELECT path, dev, ino, nlink, mtime_ns FROM files WHERE size=?',
+            (fsize,))
+        dirs = {}
+        return [_new_info(dirs, os.fsdecode(path), fsize, dev, ino, nlink,
+                          mtime_ns)
+                for path, dev, ino, nlink, mtime_ns in rows]
+
+    def complete(self, fsize):
+        """Mark the group of files of the given size as done."""
+        self._db.execute('UPDATE buckets SET done=1 WHERE size=?', (fsize,))
+
+    def save(self, stats, interval=0):
+        """Save progress, if at least interval seconds since last save."""
+        if time.time() - self._last_save < interval:
+            return
+        self._set('stats', stats.as_dict())
+        self._db.commit()
+        self._last_save = time.time()
+
+    def load_stats(self, stats):
+        """Add the saved stats to stats."""
+        saved = self._get('stats')
+        if not saved:
+            return
+        st = LinkStats()
+        for name, value in saved.items():
+            setattr(st, name, value)
+        stats.add(st)
+        stats.elapsed += st.elapsed
+
+    def close(self, stats=None):
+        """Save progress and close the checkpoint."""
+        if self._db is None:
+            return
+        if stats is not None and self.phase() == 'hash':
+            self.save(stats)
+        self._db.close()
+        self._db = None
+
+    def remove(self):
+        """Close and remove the checkpoint file."""
+        self.close()
+        try:
+            os.unlink(self._path)
+        except OSError:
+            pass
+
+    def _flush(self):
+        if self._batch:
+            self._db.executemany(
+                'INSERT INTO files (size, path, dev, ino, nlink, mtime_ns) '
+                'VALUES (?, ?, ?, ?, ?, ?)', self._batch)
+            self._batch = []
+
+    def _get(self, key):
+        row = self._db.execute('SELECT value FROM meta WHERE key=?',
+                               (key,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def _set(self, key, value):
+        self._db.execute('INSERT OR REPLACE INTO meta (key, value) '
+                         'VALUES (?, ?)', (key, json.dumps(value)))
+
+
+class _Report(object):
+
+    """
+    Write JSON Lines records to a file, from multiple threads.
+
+    """
+
+    def __init__(self, out):
+        self._out = out
+        self._lock = threading.Lock()
+
+    def write(self, record):
+        line = json.dumps(record, sort_keys=True) + '\n'
+        with self._lock:
+            self._out.write(line)
+
+
+def _make_buckets(size_files, stats):
+    """Return list of (size, [FileInfo, ..]) groups of files to compare.
+
+    Unique files, and files that are all hardlinks to the same file, are
+    skipped.  The groups are ordered by total bytes, so that the largest
+    amount of hashing work is started first.
+
+    """
+    buckets = []
+    for fsize, files in size_files:
+        if len(files) < 2:
+            continue
+        if len(set((i.dev, i.ino) for i in files)) < 2:
+            # Counted as in _create_hash_map(): one file would be read.
+            stats.hashes_avoided += len(files) - 1
+            continue
+        buckets.append((fsize, files))
+    buckets.sort(key=lambda b: b[0] * len(b[1]), reverse=True)
+    return buckets
+
+
+def _run_buckets(func, buckets, jobs, stats, device_jobs=None, done=None,
+                 tracker=None):
+    """Run func on each bucket with _run_jobs, and add results to stats.
+
+    The number of buckets being read from each device at once is limited by
+    _device_limits().  If done is given, then done(bucket) is called after
+    each bucket's results are added to stats.  If tracker is a LinkProgress,
+    then it is updated as each bucket is done.
+
+    """
+    limits = _device_limits(buckets, jobs, device_jobs)
+    if tracker:
+        tracker._add_groups(buckets)
+    start = time.time()
+    try:
+        for bucket, st in _run_jobs(func, buckets, jobs, _bucket_devices,
+                                    limits):
+            stats.add(st)
+            if tracker:
+                tracker._group_done(bucket, st)
+            if done:
+                done(bucket)
+    finally:
+        stats.elapsed += time.time() - start
+
+
+def _run_checkpointed(func, state, roots, pattern, resume, jobs, stats,
+                      device_jobs=None, max_files=CHECKPOINT_FILES,
+                      tracker=None):
+    """Walk roots and run func on buckets, saving progress in state.
+
+    The walk saves each directory's files as the directory is done, so that
+    a resumed walk continues with the directories not yet walked.  Files are
+    loaded from the checkpoint, and compared, in batches of at most max_files
+    files, so memory use does not depend on the number of files in the
+    directory trees.  When resuming, files that were removed or changed
+    since they were saved are left out.
+
+    """
+    if resume:
+        state.load_stats(stats)
+    else:
+        state.start(roots, pattern)
+    if state.phase() == 'walk':
+        dirs = state.pending_dirs()
+        while dirs:
+            dirpath = dirs.pop()
+            subdirs = []
+            infos = list(_scan_dir(dirpath, pattern, subdirs, tracker))
+            state.add_dir(dirpath, infos, subdirs)
+            dirs.extend(subdirs)
+        state.finish_walk()
+
+    def done(bucket):
+        state.complete(bucket[0])
+        state.save(stats, CHECKPOINT_INTERVAL)
+
+    while True:
+        sizes = state.next_sizes(max_files)
+        if not sizes:
+            break
+        if resume:
+            size_files = [(fsize, _unchanged(state.files(fsize)))
+                          for fsize in sizes]
+        else:
+            size_files = [(fsize, state.files(fsize)) for fsize in sizes]
+        buckets = _make_buckets(size_files, stats)
+        # Groups that do not need to be compared are already done.
+        for fsize in set(sizes) - set(b[0] for b in buckets):
+            state.complete(fsize)
+        _run_buckets(func, buckets, jobs, stats, device_jobs, done, tracker)
+        state.save(stats)
+
+
+def _run_external(func, roots, pattern, max_files, jobs, stats,
+                  device_jobs=None, tracker=None, spill_dir=None):
+    """Walk roots and run func on buckets, keeping the size map on disk.
+
+    The files found by the walk are written to sorted runs in a temporary
+    directory, created in spill_dir, and the runs are merged to read back one group of same-size
+    files at a time.  Groups are compared in batches of about max_files
+    files.  A single group having more than max_files files is still loaded
+    in full.
+
+    """
+    tmpdir = tempfile.mkdtemp(prefix='linksame-', dir=spill_dir)
+    try:
+        runs = _write_runs(_walk_files(roots, pattern, tracker), max_files,
+                           tmpdir)
+        batch = []
+        count = 0
+        for fsize, files in _read_groups(runs, tmpdir):
+            batch.append((fsize, files))
+            count += len(files)
+            if count >= max_files:
+                _run_buckets(func, _make_buckets(batch, stats), jobs, stats,
+                             device_jobs, None, tracker)
+                batch = []
+                count = 0
+        if batch:
+            _run_buckets(func, _make_buckets(batch, stats), jobs, stats,
+                         device_jobs, None, tracker)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def _write_runs(infos, max_files, tmpdir):
+    """Write FileInfo items to files of at most max_files, sorted by size.
+
+    Return: List of paths of sorted run files.
+
+    """
+    runs = []
+    while True:
+        chunk = list(itertools.islice(infos, max_files))
+        if not chunk:
+            return runs
+        chunk.sort(key=lambda info: info.size)
+        runs.append(_write_run(chunk, tmpdir))
+
+
+def _write_run(infos, tmpdir):
+    """Write a sorted run of FileInfo items to a new file in tmpdir."""
+    fd, path = tempfile.mkstemp(dir=tmpdir, suffix='.run')
+    with os.fdopen(fd, 'wb') as f:
+        for info in infos:
+            name = os.fsencode(info.path)
+            f.write(_RUN_RECORD.pack(info.size, info.dev, info.ino,
+                                     info.nlink, info.mtime_ns, len(name)))
+            f.write(name)
+    return path
+
+
+def _read_run(path):
+    """Generate FileInfo items from a sorted run file."""
+    dirs = {}
+    with open(path, 'rb') as f:
+        while True:
+            rec = f.read(_RUN_RECORD.size)
+            if not rec:
+                return
+            size, dev, ino, nlink, mtime_ns, name_len = _RUN_RECORD.unpack(
+                rec)
+            name = os.fsdecode(f.read(name_len))
+            yield _new_info(dirs, name, size, dev, ino, nlink, mtime_ns)
+
+
+def _merge_runs(runs):
+    """Generate FileInfo items, in size order, from sorted run files."""
+    return heapq.merge(*[_read_run(path) for path in runs],
+                       key=lambda info: info.size)
+
+
+def _read_groups(runs, tmpdir):
+    """Generate (size, [FileInfo, ..]) for each size, from sorted runs.
+
+    If there are more than MERGE_WIDTH runs, then groups of runs are first
+    merged into larger runs, so that not too many files are open at once.
+
+    """
+    while len(runs) > MERGE_WIDTH:
+        merged = []
+        for i in range(0, len(runs), MERGE_WIDTH):
+            group = runs[i:i + MERGE_WIDTH]
+            merged.append(_write_run(_merge_runs(group), tmpdir))
+            for path in group:
+                os.unlink(path)
+        runs = merged
+    for fsize, infos in itertools.groupby(_merge_runs(runs),
+                                          key=lambda info: info.size):
+        yield fsize, list(infos)
+
+
+def _write_summary(report, stats):
+    """Write summary record to report, if there is a report."""
+    if report is not None:
+        record = stats.as_dict()
+        record['type'] = 'summary'
+        report.write(record)
+
+
+def _print_summary(stats, link, reflink, hash_cache):
+    print()
+    if not link:
+        print('If writing links (-w), would have...')
+    print('Replaced', stats.link_count, 'files with',
+          'reflinks' if reflink else 'links')
+    print('Reduced storage by', size_str(stats.size_saved))
+    print('Read', size_str(stats.bytes_read), 'to compare',
+          size_str(stats.candidate_bytes), 'of candidate files')
+    print(_throughput_str(stats.file_count, stats.bytes_read, stats.elapsed))
+    print('Avoided', stats.hashes_avoided,
+          'hash operations on existing hardlinks')
+    if hash_cache:
+        print(hash_cache)
+
+
+def _file_info(path, st=None, dirpath=None):
+    """Return FileInfo for path, or None if it is not a regular file.
+
+    If the stat result, st, is not given, then the file is stat'ed without
+    following symlinks.  If dirpath is given, then it is the directory of
+    path, and that string is kept in the FileInfo.
+
+    """
+    if st is None:
+        st = os.lstat(path)
+    if not stat.S_ISREG(st.st_mode):
+        return None
+    if dirpath is None:
+        dirpath = os.path.dirname(path)
+    return FileInfo(dirpath, os.path.basename(path), st.st_size, st.st_dev,
+                    st.st_ino, st.st_nlink, _stat_key(st)[3])
+
+
+def _unchanged(infos):
+    """Return list of the files in infos that exist and have not changed."""
+    files = []
+    for info in infos:
+        try:
+            st = os.lstat(info.path)
+        except OSError:
+            continue
+        if _stat_key(st) == _stat_key(info) and stat.S_ISREG(st.st_mode):
+            files.append(info)
+    return files
+
+
+def _new_info(dirs, path, size, dev, ino, nlink, mtime_ns):
+    """Return FileInfo for path, sharing directory strings kept in dirs."""
+    dirpath, name = os.path.split(path)
+    dirpath = dirs.setdefault(dirpath, dirpath)
+    return FileInfo(dirpath, name, size, dev, ino, nlink, mtime_ns)
+
+
+def _walk_files(roots, pattern=None, tracker=None):
+    """Generate a FileInfo for each non-empty regular file under roots.
+
+    Each directory entry is stat'ed at most once.  Symlinks are not followed,
+    and files that do not match pattern are skipped without being stat'ed.
+    If tracker is a LinkProgress, then it counts each file generated.
+
+    """
+    dirs = list(roots)
+    while dirs:
+        for info in _scan_dir(dirs.pop(), pattern, dirs, tracker):
+            yield info
+
+
+def _scan_dir(dirpath, pattern=None, subdirs=None, tracker=None):
+    """Generate a FileInfo for each non-empty regular file in dirpath.
+
+    Subdirectories are appended to the subdirs list, if given.  Otherwise,
+    this is the same as _walk_files() for a single directory.
+
+    """
+    try:
+        it = os.scandir(dirpath)
+    except OSError:
+        return
+    with it:
+        for entry in it:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    if subdirs is not None:
+                        subdirs.append(entry.path)
+                    continue
+                if not entry.is_file(follow_symlinks=False):
+                    continue
+                if pattern and not fnmatch.fnmatch(entry.name, pattern):
+                    continue
+                info = _file_info(entry.path,
+                                  entry.stat(follow_symlinks=False), dirpath)
+            except OSError:
+                continue
+            if info is not None and info.size:
+                if tracker:
+                    tracker._walked()
+                yield info
+
+
 def _normalize_roots(roots, quiet):
     for i, root_dir in enumerate(roots):
         root_dir = os.path.normpath(os.path.expanduser(root_dir))
@@ -223,75 +1608,783 @@ def _normalize_roots(roots, quiet):
     return roots, None
 
 
-def _hash_file(filename):
-    """Calculate SHA1 hash of file."""
-    BLOCKSIZE = 65536
-    hasher = hashlib.sha1()
+def _run_jobs(func, items, jobs, get_key=None, limits=None):
+    """Call func for each item using a fixed number of worker threads.
+
+    Items are handed to the workers in the order given.  If get_key is
+    specified, then get_key(item) returns a tuple of the resources, such as
+    devices, that are used by the item.  The limits dictionary gives the
+    maximum number of items that may use each resource at the same time.
+    When the next item cannot be started because a resource it uses is busy,
+    the first item that can be started is given to the worker instead.
+
+    If func raises an exception, or the generator is closed before all
+    results are read, then no more items are started, and the items already
+    started are allowed to finish before the exception is raised or the
+    generator returns.
+
+    Return: Generator of (item, result) tuples, in order of completion.
+
+    """
+    if not items:
+        return
+    if limits is None:
+        limits = {}
+
+    # Map of {key: deque([(index, item), ..])}, to find the first item that
+    # can be started without looking at every pending item.
+    pending = collections.OrderedDict()
+    for i, item in enumerate(items):
+        key = get_key(item) if get_key else ()
+        pending.setdefault(key, collections.deque()).append((i, item))
+    active = collections.defaultdict(int)
+    cond = threading.Condition()
+    result_q = queue.Queue()
+
+    def next_item():
+        # Return (key, item) for next item that can be started, or None.
+        # Must be called with cond held.
+        best = None
+        for key, q in pending.items():
+            if best is not None and q[0][0] > pending[best][0][0]:
+                continue
+            if all(active[r] < limits.get(r, jobs) for r in key):
+                best = key
+        if best is None:
+            return None
+        q = pending[best]
+        item = q.popleft()[1]
+        if not q:
+            del pending[best]
+        for r in best:
+            active[r] += 1
+        return best, item
+
+    def worker():
+        while True:
+            with cond:
+                while True:
+                    if not pending:
+                        return
+                    next_job = next_item()
+                    if next_job is not None:
+                        break
+                    cond.wait()
+            key, item = next_job
+            try:
+                result_q.put((item, func(item), None))
+            except Exception as e:
+                result_q.put((item, None, e))
+            finally:
+                with cond:
+                    for r in key:
+                        active[r] -= 1
+                    cond.notify_all()
+
+    threads = []
+    for _ in range(min(jobs, len(items))):
+        t = threading.Thread(target=worker)
+        t.daemon = True
+        t.start()
+        threads.append(t)
+
+    try:
+        for _ in range(len(items)):
+            item, result, exc = result_q.get()
+            if exc is not None:
+                raise exc
+            yield item, result
+    finally:
+        # Stop starting items, and wait for the workers to finish the items
+        # they are working on, so that nothing they use is closed under them.
+        with cond:
+            pending.clear()
+            cond.notify_all()
+        for t in threads:
+            t.join()
+
+
+def _bucket_devices(bucket):
+    """Return tuple of the devices that the files in a bucket are on."""
+    return tuple(sorted(set(info.dev for info in bucket[1])))
+
+
+def _is_rotational(dev):
+    """Return True if the device number, dev, is for a rotating disk.
+
+    This is determined from sysfs, and is False if it cannot be determined.
+
+    """
+    path = '/sys/dev/block/%d:%d' % (os.major(dev), os.minor(dev))
+    # A partition does not have a queue, so look at its parent device.
+    for qpath in (os.path.join(path, 'queue', 'rotational'),
+                  os.path.join(path, '..', 'queue', 'rotational')):
+        try:
+            with open(qpath) as f:
+                return f.read().strip() == '1'
+        except (IOError, OSError):
+            continue
+    return False
+
+
+def _device_limits(buckets, jobs, device_jobs=None):
+    """Return {st_dev: limit} of the number of jobs that may read a device.
+
+    Limits for devices in device_jobs, a dictionary of {st_dev: limit}, are
+    given by that dictionary.  Other rotating disks are limited to HDD_JOBS,
+    and all remaining devices are limited only by jobs.
+
+    """
+    limits = {}
+    for bucket in buckets:
+        for dev in _bucket_devices(bucket):
+            if dev in limits:
+                continue
+            if device_jobs and dev in device_jobs:
+                limits[dev] = device_jobs[dev]
+            elif _is_rotational(dev):
+                limits[dev] = HDD_JOBS
+            else:
+                limits[dev] = jobs
+    return limits
+
+
+def _resolve_device_jobs(device_jobs):
+    """Convert {path or st_dev: limit} to {st_dev: limit}.
+
+    Return: (device jobs dictionary, error string or None)
+
+    """
+    if not device_jobs:
+        return None, None
+    resolved = {}
+    for dev, limit in device_jobs.items():
+        if limit < 1:
+            return None, 'device jobs must be a positive number'
+        if not isinstance(dev, int):
+            try:
+                dev = os.stat(dev).st_dev
+            except OSError as e:
+                return None, 'cannot stat %s: %s' % (dev, e)
+        resolved[dev] = limit
+    return resolved, None
+
+
+def _throughput_str(file_count, byte_count, elapsed):
+    """Return string describing file comparison throughput."""
+    if elapsed <= 0:
+        elapsed = 1e-6
+    return ('Compared %d files (%s read) in %.2f seconds: %.1f files/s, '
+            '%.1f MB/s' % (file_count, size_str(byte_count), elapsed,
+                           file_count / elapsed,
+                           byte_count / elapsed / (1024 * 1024)))
+
+
+def _new_hash(algo):
+    """Return a new hash object for the named algorithm."""
+    if algo in FAST_HASHES:
+        return getattr(xxhash, algo)()
+    return hashlib.new(algo)
+
+
+def _check_hash_args(algo, block_size):
+    """Return error string if hash algorithm or block size is not usable."""
+    if block_size < 1:
+        return 'block size must be a positive number'
+    try:
+        _new_hash(algo).hexdigest()
+    except (ValueError, TypeError):
+        return 'unsupported hash algorithm: %s' % (algo,)
+    return None
+
+
+def _read_buffer(block_size):
+    """Return the calling thread's read buffer, of at least block_size."""
+    buf = getattr(_buffers, 'buf', None)
+    if buf is None or len(buf) < block_size:
+        buf = bytearray(block_size)
+        _buffers.buf = buf
+        _buffers.view = memoryview(buf)
+    return buf, _buffers.view
+
+
+def _fadvise(fd, advice):
+    """Give the kernel advice about file access, if supported."""
+    advice = getattr(os, advice, None)
+    if advice is None or not hasattr(os, 'posix_fadvise'):
+        return
+    try:
+        os.posix_fadvise(fd, 0, 0, advice)
+    except OSError:
+        pass
+
+
+def _hash_file(filename, algo=DEFAULT_HASH, block_size=BLOCKSIZE):
+    """Calculate hash of file.
+
+    The file is read into a reused buffer, without allocating new memory for
+    each block.  The kernel is told that the file is read sequentially, and
+    when done, that its pages do not need to be kept in the page cache.  This
+    prevents hashing a large tree from evicting other data from the cache.
+
+    """
+    hasher = _new_hash(algo)
+    buf, view = _read_buffer(block_size)
+    if len(buf) > block_size:
+        buf = view = view[:block_size]
+    with open(filename, 'rb', buffering=0) as afile:
+        fd = afile.fileno()
+        _fadvise(fd, 'POSIX_FADV_SEQUENTIAL')
+        try:
+            n = afile.readinto(buf)
+            while n:
+                hasher.update(view[:n])
+                n = afile.readinto(buf)
+        finally:
+            _fadvise(fd, 'POSIX_FADV_DONTNEED')
+
+    return hasher.hexdigest()
+
+
+def _hash_partial(filename, fsize, algo=DEFAULT_HASH):
+    """Calculate hash of the first and last PARTIAL_SIZE bytes of file.
+
+    This is only meaningful for files larger than 2 * PARTIAL_SIZE.
+
+    """
+    hasher = _new_hash(algo)
     with open(filename, 'rb') as afile:
-        buf = afile.read(BLOCKSIZE)
-        while len(buf) > 0:
-            hasher.update(buf)
-            buf = afile.read(BLOCKSIZE)
+        hasher.update(afile.read(PARTIAL_SIZE))
+        afile.seek(fsize - PARTIAL_SIZE)
+        hasher.update(afile.read(PARTIAL_SIZE))
 
     return hasher.hexdigest()
 
 
-def _create_hash_map(filepaths):
-    # For list of same size files, create a map {hash: filepath, ..}
-    same_as = []
+def _cached_hash(cache, kind, hash_func, info, *args):
+    """Get hash of file from cache, or call hash_func to calculate it.
+
+    Return: (hash, True if hash was found in cache)
+
+    """
+    if cache is None:
+        return hash_func(info.path, *args), False
+    h = cache.get(info, kind)
+    if h is not None:
+        return h, True
+    h = hash_func(info.path, *args)
+    # Do not cache the hash if the file changed while it was being read.
+    if _stat_key(os.stat(info.path)) == _stat_key(info):
+        cache.put(info, kind, h)
+    return h, False
+
+
+def _create_hash_map(infos, fsize, cache=None, algo=DEFAULT_HASH,
+                     block_size=BLOCKSIZE, required=None, on_read=None,
+                     quiet=False):
+    """For list of same size files, create a map {hash: [FileInfo, ..], ..}.
+
+    Files are compared in stages, where each stage only sees the files that
+    could still be identical after the previous stage.  First, hardlinks to
+    the same file are grouped so that they are only read once.  Next, files
+    are grouped by a hash of their first and last PARTIAL_SIZE bytes.  Only
+    the files in groups with more than one file have their full content
+    hashed.  For files no larger than 2 * PARTIAL_SIZE, the partial hash stage
+    is skipped, since the full hash does not need to read more data.
+
+    If a HashCache is given, then hashes found in the cache are used instead
+    of reading the files.
+
+    If required is a set of (dev, ino) keys, then only groups of files that
+    include one of those files are kept after each stage.  Other files are
+    not hashed any further.
+
+    If on_read is given, then on_read(nbytes) is called after each file is
+    read to calculate a hash.
+
+    A file that cannot be read, as when it was removed after the directory
+    trees were walked, is left out, along with its hardlinks.  A message is
+    printed to stderr unless quiet is True.
+
+    Return: (hash_file_map, bytes_read, hash operations avoided for hardlinks)
+
+    """
+    # Group hardlinks to the same file, so that each file is only read once.
+    inodes = {}
+    for info in infos:
+        inodes.setdefault((info.dev, info.ino), []).append(info)
+    # Read files in order of device and inode, to reduce disk seeks.
+    inode_groups = [inodes[key] for key in sorted(inodes)]
+    avoided = len(infos) - len(inode_groups)
+
+    if len(inode_groups) < 2:
+        return {}, 0, avoided
+
+    bytes_read = 0
+    if fsize > 2 * PARTIAL_SIZE:
+        # Eliminate files that differ in their first or last bytes.
+        partial_map = {}
+        for group in inode_groups:
+            try:
+                h, hit = _cached_hash(cache, 'partial', _hash_partial,
+                                      group[0], fsize, algo)
+            except (IOError, OSError) as e:
+                _hash_error(group[0], e, quiet)
+                continue
+            if not hit:
+                bytes_read += 2 * PARTIAL_SIZE
+                if on_read:
+                    on_read(2 * PARTIAL_SIZE)
+            partial_map.setdefault(h, []).append(group)
+        inode_groups = [group for groups in partial_map.values()
+                        if len(groups) > 1 and
+                        _has_required(groups, required)
+                        for group in groups]
+        inode_groups.sort(key=lambda g: (g[0].dev, g[0].ino))
+
+    hash_groups = {}
+    for group in inode_groups:
+        try:
+            h, hit = _cached_hash(cache, 'digest', _hash_file, group[0], algo,
+                                  block_size)
+        except (IOError, OSError) as e:
+            _hash_error(group[0], e, quiet)
+            continue
+        if not hit:
+            bytes_read += fsize
+            if on_read:
+                on_read(fsize)
+        hash_groups.setdefault(h, []).append(group)
+
     hash_file_map = {}
-    for i, fpath in enumerate(filepaths):
-        if not fpath:
+    for h, groups in hash_groups.items():
+        if _has_required(groups, required):
+            hash_file_map[h] = [info for group in groups for info in group]
+
+    return hash_file_map, bytes_read, avoided
+
+
+def _hash_error(info, err, quiet):
+    """Report a file that could not be read to calculate its hash."""
+    if not quiet:
+        print('cannot read %s: %s' % (info.path, err), file=sys.stderr)
+
+
+def _has_required(inode_groups, required):
+    """Return True if any group is for a file in required, or no required."""
+    if required is None:
+        return True
+    for group in inode_groups:
+        if (group[0].dev, group[0].ino) in required:
+            return True
+    return False
+
+
+def _link_hash_map(hash_map, stats, verify, link, symlink, absolute, verbose,
+                   reflink=False, report=None, quiet=False):
+    """Link the files in each group of files that have the same hash.
+
+    If verify is True, then files are compared byte-for-byte, and only linked
+    to files that are actually identical.  Files that cannot be read to
+    compare are left out, as in _create_hash_map().  The link_count,
+    size_saved, and group_count in stats are updated.  If report is given,
+    then a record is written for each group.
+
+    """
+    for digest, files in hash_map.items():
+        if len(files) < 2:
             continue
+        if verify:
+            same_files = _split_identical(files, quiet)
+        else:
+            same_files = (files,)
+        for files in same_files:
+            if len(files) < 2:
+                continue
+            actions = {} if report is not None else None
+            paths = sorted(info.path for info in files)
+            l, s = _link_files(files, link, symlink, absolute, verbose,
+                               reflink, actions)
+            stats.link_count += l
+            stats.size_saved += s
+            stats.group_count += 1
+            if report is not None:
+                base = [p for p, a in actions.items() if a == 'base'][0]
+                report.write({
+                    'type': 'group', 'digest': digest, 'size': files[0].size,
+                    'files': paths, 'base': base,
+                    'actions': actions, 'dry_run': not link})
+
+
+def _split_identical(files, quiet=False):
+    """Split list of files into lists of files with byte-identical content.
+
+    A file that cannot be read, as when it was removed after it was hashed,
+    is left out.  A message is printed to stderr unless quiet is True.
 
-        # Find hardlinks to current file, and reuse hash for these.
-        for j in xrange(i + 1, len(filepaths)):
-            if not filepaths[j]:
+    """
+    groups = []
+    for info in files:
+        i = 0
+        while i < len(groups):
+            group = groups[i]
+            try:
+                if ((group[0].dev, group[0].ino) == (info.dev, info.ino) or
+                        filecmp.cmp(group[0].path, info.path, False)):
+                    group.append(info)
+                    break
+            except (IOError, OSError) as e:
+                if e.filename != group[0].path:
+                    _hash_error(info, e, quiet)
+                    break
+                # The file that the group is compared against cannot be read,
+                # so compare against the next file in the group instead.
+                _hash_error(group.pop(0), e, quiet)
+                if not group:
+                    del groups[i]
                 continue
+            i += 1
+        else:
+            groups.append([info])
+    return groups
 
-            if os.path.samefile(fpath, filepaths[j]):
-                same_as.append(filepaths[j])
-                filepaths[j] = None
 
-        h = _hash_file(fpath)
-        if same_as:
-            # Reuse hash for additional hardlinked files.
-            same_as.append(fpath)
-            hash_file_map.setdefault(h, []).extend(same_as)
-            same_as = same_as[:0]
-        else:
-            hash_file_map.setdefault(h, []).append(fpath)
+def hash_benchmark(algos=None, block_sizes=None, data_size=32*1024*1024):
+    """Measure the speed of hash algorithms using different block sizes.
+
+    Data is hashed from memory, so the results show the speed of hashing
+    without any disk I/O, as when files are in the page cache.
+
+    Arguments:
+    algos       -- Hash algorithms to measure.  Default is DEFAULT_HASH, sha1,
+                   md5, sha256, and any FAST_HASHES.
+    block_sizes -- Sizes of data given to the hash at a time.
+    data_size   -- Total bytes hashed for each measurement.
+
+    Return: List of (algo, block_size, MB/s) tuples.
+
+    """
+    if algos is None:
+        algos = []
+        for algo in (DEFAULT_HASH, 'sha1', 'md5', 'sha256') + FAST_HASHES:
+            if algo not in algos and not _check_hash_args(algo, 1):
+                algos.append(algo)
+    if block_sizes is None:
+        block_sizes = (4096, BLOCKSIZE, 1024*1024)
+
+    data = memoryview(os.urandom(data_size))
+    results = []
+    for algo in algos:
+        for block_size in block_sizes:
+            hasher = _new_hash(algo)
+            start = time.time()
+            for i in range(0, data_size, block_size):
+                hasher.update(data[i:i + block_size])
+            hasher.hexdigest()
+            elapsed = max(time.time() - start, 1e-6)
+            results.append((algo, block_size,
+                            data_size / elapsed / (1024 * 1024)))
+    return results
+
+
+def memory_benchmark(roots, pattern=None):
+    """Measure memory used to hold the files found under roots.
+
+    The files are kept in a size map, as is done by link_same_files, once
+    with FileInfo items, and once with items holding the full path string of
+    each file.  Memory is measured using tracemalloc.
+
+    Return: Tuple of (file count, bytes using full paths, bytes using
+            FileInfo).
+
+    """
+    import tracemalloc
+
+    def measure(make_item):
+        size_file_map = {}
+        tracemalloc.start()
+        try:
+            for info in _walk_files(roots, pattern):
+                size_file_map.setdefault(info.size, []).append(
+                    make_item(info))
+            used = tracemalloc.get_traced_memory()[0]
+        finally:
+            tracemalloc.stop()
+        return sum(len(files) for files in size_file_map.values()), used
+
+    def full_path(info):
+        return (info.path, info.size, info.dev, info.ino, info.nlink,
+                info.mtime_ns)
+
+    count, full = measure(full_path)
+    _, compact = measure(lambda info: info)
+    return count, full, compact
+
+
+def _stat_key(st):
+    """Return the (dev, inode, size, mtime_ns) key that identifies a file.
+
+    The st argument is either an os.stat_result or a FileInfo.
+
+    """
+    if isinstance(st, FileInfo):
+        return st.dev, st.ino, st.size, st.mtime_ns
+    mtime_ns = getattr(st, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = int(st.st_mtime * 1000000000)
+    return st.st_dev, st.st_ino, st.st_size, mtime_ns
 
-    return hash_file_map
 
+class HashCache(object):
 
-def _link_files(files, link, symlink, absolute, verbose):
+    """
+    Persistent cache of file hashes, stored in a SQLite database.
+
+    Hashes are keyed by the device, inode, size, and modification time of the
+    file.  A file that is modified or replaced gets a different key, so its
+    hash is not found in the cache and must be calculated again.
+
+    Hashes are calculated using the hash algorithm, algo.  Hashes calculated
+    with different algorithms are kept separately in the same cache file.
+
+    Entries that have not been used for max_age seconds are removed when the
+    cache is pruned or closed.  If max_entries is given, then only that many
+    of the most recently used entries are kept.
+
+    """
+
+    # Number of changes to the cache database between commits.
+    COMMIT_INTERVAL = 1000
+
+    # Version of database layout.  The cache is emptied if this changes.
+    SCHEMA_VERSION = 1
+
+    def __init__(self, path, algo=DEFAULT_HASH, max_age=CACHE_MAX_AGE,
+                 max_entries=None):
+        self._path = path
+        self._algo = algo
+        self._max_age = max_age
+        self._max_entries = max_entries
+        self._now = int(time.time())
+        self._lock = threading.Lock()
+        self._changes = 0
+        self.hits = 0
+        self.misses = 0
+        self._db = sqlite3.connect(os.path.expanduser(path),
+                                   check_same_thread=False)
+        version = self._db.execute('PRAGMA user_version').fetchone()[0]
+        if version != HashCache.SCHEMA_VERSION:
+            self._db.execute('DROP TABLE IF EXISTS hashes')
+            self._db.execute('PRAGMA user_version = %d'
+                             % (HashCache.SCHEMA_VERSION,))
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS hashes ('
+            'algo TEXT, dev INTEGER, ino INTEGER, size INTEGER, '
+            'mtime_ns INTEGER, partial TEXT, digest TEXT, used INTEGER, '
+            'PRIMARY KEY (algo, dev, ino, size, mtime_ns))')
+        self._db.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __str__(self):
+        return 'Hash cache %s: %d hits, %d misses' % (
+            self._path, self.hits, self.misses)
+
+    def get(self, st, kind='digest'):
+        """Return hash of file st, or None if not cached.
+
+        Arguments:
+        st   -- FileInfo, or result of os.stat(), for the file.
+        kind -- 'digest' for hash of whole file, or 'partial' for hash of
+                first and last PARTIAL_SIZE bytes.
+
+        """
+        assert kind in ('digest', 'partial')
+        key = (self._algo,) + _stat_key(st)
+        with self._lock:
+            row = self._db.execute(
+                'SELECT %s FROM hashes WHERE algo=? AND dev=? AND ino=? AND '
+                'size=? AND mtime_ns=?' % (kind,), key).fetchone()
+            if row is None or row[0] is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._db.execute(
+                'UPDATE hashes SET used=? WHERE algo=? AND dev=? AND ino=? '
+                'AND size=? AND mtime_ns=?', (self._now,) + key)
+            self._changed()
+        return row[0]
+
+    def put(self, st, kind, value):
+        """Save hash of file st, a FileInfo or os.stat() result, in cache."""
+        assert kind in ('digest', 'partial')
+        key = (self._algo,) + _stat_key(st)
+        with self._lock:
+            self._db.execute(
+                'INSERT OR IGNORE INTO hashes (algo, dev, ino, size, mtime_ns,'
+                ' used) VALUES (?, ?, ?, ?, ?, ?)', key + (self._now,))
+            self._db.execute(
+                'UPDATE hashes SET %s=?, used=? WHERE algo=? AND dev=? AND '
+                'ino=? AND size=? AND mtime_ns=?' % (kind,),
+                (value, self._now) + key)
+            self._changed()
+
+    def discard(self, stat_key):
+        """Remove the hashes of the file with _stat_key() stat_key."""
+        key = (self._algo,) + tuple(stat_key)
+        with self._lock:
+            self._db.execute(
+                'DELETE FROM hashes WHERE algo=? AND dev=? AND ino=? AND '
+                'size=? AND mtime_ns=?', key)
+            self._changed()
+
+    def prune(self):
+        """Remove old entries, and entries in excess of max_entries.
+
+        The time that entries are marked as used at is also updated, for a
+        cache that is kept open for a long time.
+
+        """
+        with self._lock:
+            self._now = int(time.time())
+            if self._max_age is not None:
+                self._db.execute('DELETE FROM hashes WHERE used < ?',
+                                 (self._now - self._max_age,))
+            if self._max_entries is not None:
+                self._db.execute(
+                    'DELETE FROM hashes WHERE rowid NOT IN (SELECT rowid FROM '
+                    'hashes ORDER BY used DESC LIMIT ?)', (self._max_entries,))
+            self._db.commit()
+            self._changes = 0
+
+    def close(self):
+        """Prune old entries, save changes, and close the cache."""
+        if self._db is None:
+            return
+        self.prune()
+        self._db.close()
+        self._db = None
+
+    def _changed(self):
+        self._changes += 1
+        if self._changes >= HashCache.COMMIT_INTERVAL:
+            self._db.commit()
+            self._changes = 0
+
+
+def _reflink(base_file, dest_file, size):
+    """Share the data blocks of base_file with the identical dest_file.
+
+    This uses the FIDEDUPERANGE ioctl, for which the kernel verifies that the
+    data is identical before sharing it, and never modifies the data of
+    dest_file.  The dest_file remains a separate inode with its own metadata.
+
+    Raise OSError if the filesystem does not support sharing data, or if the
+    files differ.
+
+    """
+    if fcntl is None:
+        raise OSError(errno.EOPNOTSUPP, 'reflink not supported on platform')
+    with open(base_file, 'rb') as src, open(dest_file, 'r+b') as dst:
+        offset = 0
+        while offset < size:
+            # struct file_dedupe_range, with one file_dedupe_range_info.
+            arg = bytearray(struct.pack('=QQHHIqQQiI', offset, size - offset,
+                                        1, 0, 0, dst.fileno(), offset, 0, 0,
+                                        0))
+            fcntl.ioctl(src.fileno(), FIDEDUPERANGE, arg, True)
+            deduped, status = struct.unpack_from('=Qi', arg, 40)
+            if status < 0:
+                raise OSError(-status, os.strerror(-status))
+            if status == FILE_DEDUPE_RANGE_DIFFERS:
+                raise OSError(errno.EINVAL, 'file contents differ')
+            if deduped == 0:
+                raise OSError(errno.EIO, 'no data deduplicated')
+            offset += deduped
+
+
+def _replace_with_link(create, dest):
+    """Atomically replace dest with a link made by create(path).
+
+    The link is created with an unused temporary name in the directory of
+    dest, and then renamed over dest.  If either step fails, then dest is left
+    unchanged and OSError is raised.
+
+    """
+    dirname = os.path.dirname(dest)
+    while True:
+        tmp = os.path.join(dirname, '.linksame-%s.tmp' % (os.urandom(6).hex(),))
+        try:
+            create(tmp)
+            break
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+    try:
+        os.replace(tmp, dest)
+    except OSError:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+
+
+def _link_files(files, link, symlink, absolute, verbose, reflink=False,
+                actions=None):
+    """Replace all files with links to the one with the longest name.
+
+    If actions is a dictionary, then it is filled with {path: action}, where
+    action is one of: base, existing, hardlink, symlink, reflink, failed.  If
+    not writing links, action is what would have been done.
+
+    Return: (link_count, size_saved)
+
+    """
+    if actions is None:
+        actions = {}
     link_count = 0
     size_saved = 0
 
-    def fkey(name):
+    def fkey(info):
         # Sort by shortest-basename, shortest-path
-        return len(os.path.basename(name)), len(name)
+        return len(os.path.basename(info.path)), len(info.path)
 
     # Sort files and get file with longest name, or longest path if names are
     # the same.  This only matters for symlinks, but since a failed hardlink
     # can result in a symlink, do it anyway.
     files.sort(key=fkey)
-    base_file = files.pop()
-    base_size = os.path.getsize(base_file)
+    base = files.pop()
+    base_file = base.path
+    base_size = base.size
+    actions[base_file] = 'base'
 
     # Iterate remaining files and replace with links.
-    for f in files:
-        if os.path.samefile(base_file, f):
+    for info in files:
+        if (info.dev, info.ino) == (base.dev, base.ino):
             # If the files are already the same (hardlinked), then do not try
             # to link.
+            actions[info.path] = 'existing'
             continue
+        f = info.path
 
         if not link:
             size_saved += base_size
             link_count += 1
+            if reflink:
+                actions[f] = 'reflink'
+            elif symlink:
+                actions[f] = 'symlink'
+            else:
+                actions[f] = 'hardlink'
             if verbose:
-                if symlink:
+                if reflink:
+                    print('reflink:', f, '<==>', base_file)
+                elif symlink:
                     if absolute:
                         source = base_file
                     else:
@@ -306,25 +2399,61 @@ def _link_files(files, link, symlink, absolute, verbose):
                     print('link:', f, '<-->', base_file)
             continue
 
-        try:
-            os.unlink(f)
-        except OSError:
-            print('cannot remove file:', f, file=sys.stderr)
+        if reflink:
+            try:
+                _reflink(base_file, f, base_size)
+            except (IOError, OSError) as e:
+                print('cannot reflink %s to %s: %s' % (f, base_file, e),
+                      file=sys.stderr)
+                actions[f] = 'failed'
+                if e.errno in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL,
+                               errno.EXDEV):
+                    # Filesystem does not support reflinks, so do not try
+                    # again for the other files.
+                    break
+                continue
+            if verbose:
+                print('reflink:', f, '<==>', base_file)
+            actions[f] = 'reflink'
+            size_saved += base_size
+            link_count += 1
             continue
 
+        # Each link is created with a temporary name and renamed over the
+        # file, so that the file is never missing and is left unchanged if
+        # the link cannot be created.
         create_symlink = symlink
         if not symlink:
             try:
-                os.link(base_file, f)
+                _replace_with_link(lambda tmp: os.link(base_file, tmp), f)
+                actions[f] = 'hardlink'
                 if verbose:
                     print('hardlink:', f, '<-->', base_file)
-            except OSError:
-                create_symlink=True
+            except OSError as e:
+                if e.errno not in _SYMLINK_FALLBACK:
+                    print('failed to create hardlink for %s: %s' % (f, e),
+                          file=sys.stderr)
+                    actions[f] = 'failed'
+                    continue
+                create_symlink = True
                 if verbose:
                     print('could not create hardlink, symlink instead',
                           file=sys.stderr)
 
         if create_symlink:
+            # A symlink can be created to a file that does not exist, so make
+            # sure the base file is still the one that was compared, instead
+            # of replacing a real copy with a dangling link.
+            try:
+                base_ok = _stat_key(os.lstat(base_file)) == _stat_key(base)
+            except OSError:
+                base_ok = False
+            if not base_ok:
+                print('%s changed or removed, not linking %s' % (
+                    base_file, f), file=sys.stderr)
+                actions[f] = 'failed'
+                continue
+
             if absolute:
                 source = base_file
             else:
@@ -336,14 +2465,14 @@ def _link_files(files, link, symlink, absolute, verbose):
                     source = os.path.join(rp, os.path.basename(base_file))
 
             try:
-                os.symlink(source, f)
+                _replace_with_link(lambda tmp: os.symlink(source, tmp), f)
+                actions[f] = 'symlink'
                 if verbose:
                     print('symlink:', f, '--->', source)
             except OSError as e:
                 print('failed to create symlink for %s: %s' % (base_file, e),
                       file=sys.stderr)
-                # Restore file.
-                shutil.copy2(base_file, f)
+                actions[f] = 'failed'
                 continue # skip stats update
 
         size_saved += base_size
@@ -377,6 +2506,10 @@ def main():
                     help='Write links to filesystem')
     ap.add_argument('--symlink', action='store_true',
                     help='Link files using only symlinks')
+    ap.add_argument('--reflink', action='store_true',
+                    help='Share data blocks of identical files, instead of '
+                    'replacing them with links.  Requires filesystem support, '
+                    'such as btrfs or XFS.')
     ap.add_argument('--absolute', '-a', action='store_true',
                     help='When creating symlink, use absolute instead of '
                     'relative link.')
@@ -385,18 +2518,183 @@ def main():
                     help='Suppress output messages and warnings')
     ap.add_argument('--verbose', '-v', action='store_true',
                     help='Print individual link creation messages')
-    ap.add_argument('--update', '-u',
-                    help='Only link files identical to specified update file')
+    ap.add_argument('--update', '-u', action='append',
+                    help='Only link files identical to specified update file.  '
+                    'May be given multiple times.')
+    ap.add_argument('--update-list', metavar='FILE',
+                    help='Only link files identical to the update files '
+                    'listed, one per line, in FILE.  Use - to read stdin.')
+    ap.add_argument('--jobs', '-j', type=int,
+                    help='Number of files hashed concurrently.  Default is '
+                    'the number of CPUs.')
+    ap.add_argument('--device-jobs', metavar='PATH=N', action='append',
+                    help='Limit number of files read concurrently from the '
+                    'device containing PATH.  May be given multiple times.  '
+                    'Rotating disks default to %d.' % (HDD_JOBS,))
+    ap.add_argument('--watch', action='store_true',
+                    help='Keep running, and link new and modified files to '
+                    'identical files as they appear.  Uses inotify, so is '
+                    'only available on Linux.')
+    ap.add_argument('--checkpoint', metavar='PATH',
+                    help='Periodically save progress to checkpoint file, so '
+                    'that an interrupted run can be resumed.')
+    ap.add_argument('--resume', action='store_true',
+                    help='Resume interrupted run from --checkpoint file, '
+                    'continuing the walk or the comparing where it stopped.  '
+                    'Starts a new run if there is no run to resume.')
+    ap.add_argument('--max-files', type=int, metavar='N',
+                    help='Keep the list of files found on disk, and hold '
+                    'only about N files in memory at once.  The list is '
+                    'written to --spill-dir, or to --checkpoint if given.')
+    ap.add_argument('--spill-dir', metavar='DIR',
+                    help='Directory for the list of files kept on disk by '
+                    '--max-files.  Default is the system temporary '
+                    'directory, which is often in memory (tmpfs).')
+    ap.add_argument('--cache', metavar='PATH',
+                    help='Hash cache file.  Only files changed since the '
+                    'previous run using the same cache are hashed.')
+    ap.add_argument('--cache-max-entries', type=int, metavar='N',
+                    help='Keep only the N most recently used entries in the '
+                    'hash cache.  Entries unused for %d days are always '
+                    'removed.' % (CACHE_MAX_AGE // (24 * 60 * 60),))
+    ap.add_argument('--hash', default=DEFAULT_HASH, metavar='ALGO',
+                    help='Hash algorithm used to compare files.  Any hashlib '
+                    'algorithm or one of: %s.  Default is %s.' % (
+                        ', '.join(FAST_HASHES) or '(xxhash not installed)',
+                        DEFAULT_HASH))
+    ap.add_argument('--block-size', type=int, default=BLOCKSIZE,
+                    help='Bytes read at a time when hashing a file.  Default '
+                    'is %d.' % (BLOCKSIZE,))
+    ap.add_argument('--verify', action='store_true', default=None,
+                    help='Compare files byte-for-byte when hashes match.  '
+                    'This is always done for non-cryptographic hashes.')
+    ap.add_argument('--progress', action='store_true',
+                    help='Show progress while finding and comparing files.')
+    ap.add_argument('--report', metavar='FILE',
+                    help='Write a JSON Lines record for each group of '
+                    'identical files, and a final summary record, to FILE.  '
+                    'Use - to write to stdout instead of the usual output.')
+    ap.add_argument('--benchmark', action='store_true',
+                    help='Measure speed of hash algorithms and block sizes, '
+                    'and exit.')
+    ap.add_argument('--memory-benchmark', action='store_true',
+                    help='Measure memory used to hold the files found under '
+                    'roots, with and without shared directory paths, and '
+                    'exit.')
     args = ap.parse_args()
 
-    if args.update:
-        err = link_same_update(
-            args.update, args.roots, args.pattern, args.write, args.symlink,
-            args.absolute, args.quiet, args.verbose)
+    if args.memory_benchmark:
+        count, full, compact = memory_benchmark(args.roots or ['.'],
+                                                args.pattern)
+        print('%d files' % (count,))
+        print('full paths:       %s' % (size_str(full),))
+        print('shared dir paths: %s' % (size_str(compact),))
+        return 0
+
+    if args.benchmark:
+        algos = None
+        if args.hash != DEFAULT_HASH:
+            algos = [args.hash]
+        for algo, block_size, mbps in hash_benchmark(algos):
+            print('%-10s %8d bytes: %8.1f MB/s' % (algo, block_size, mbps))
+        return 0
+
+    # Options that only apply to some modes.  Reject them, instead of
+    # ignoring them, in the modes that do not use them.
+    checkpoint_opts = [('--checkpoint', args.checkpoint),
+                       ('--resume', args.resume),
+                       ('--max-files', args.max_files),
+                       ('--spill-dir', args.spill_dir)]
+    if args.watch:
+        mode = '--watch'
+        unused = [('--update', args.update),
+                  ('--update-list', args.update_list),
+                  ('--jobs', args.jobs),
+                  ('--device-jobs', args.device_jobs),
+                  ('--progress', args.progress)] + checkpoint_opts
+    elif args.update or args.update_list:
+        mode = '--update'
+        unused = checkpoint_opts
+    elif args.checkpoint:
+        # The checkpoint holds the list of files, instead of sorted runs.
+        mode = '--checkpoint'
+        unused = [('--spill-dir', args.spill_dir)]
     else:
-        err = link_same_files(
-            args.roots, args.pattern, args.write, args.symlink, args.absolute,
-            args.quiet, args.verbose)
+        unused = []
+    for opt, value in unused:
+        if value is not None and value is not False:
+            print('cannot use %s with %s' % (opt, mode), file=sys.stderr)
+            return 1
+
+    device_jobs = {}
+    for dev_jobs in args.device_jobs or ():
+        path, _, limit = dev_jobs.rpartition('=')
+        try:
+            device_jobs[path] = int(limit)
+        except ValueError:
+            print('invalid device jobs:', dev_jobs, file=sys.stderr)
+            return 1
+
+    update_files = args.update or []
+    if args.update_list:
+        if args.update_list == '-':
+            lines = sys.stdin.read().splitlines()
+        else:
+            try:
+                with open(args.update_list) as f:
+                    lines = f.read().splitlines()
+            except (IOError, OSError) as e:
+                print('cannot read update list %s: %s' % (args.update_list, e),
+                      file=sys.stderr)
+                return 1
+        update_files.extend(l for l in lines if l.strip())
+        if not update_files:
+            print('no update files listed', file=sys.stderr)
+            return 1
+
+    report = None
+    if args.report == '-':
+        # Only write report records to stdout.
+        report = sys.stdout
+        args.quiet = True
+        args.verbose = False
+    elif args.report:
+        try:
+            report = open(args.report, 'w')
+        except (IOError, OSError) as e:
+            print('cannot write report %s: %s' % (args.report, e),
+                  file=sys.stderr)
+            return 1
+
+    progress = None
+    if args.progress and not args.quiet:
+        progress = _ProgressDisplay()
+
+    try:
+        if args.watch:
+            err = watch_same_files(
+                args.roots, args.pattern, args.write, args.symlink,
+                args.absolute, args.quiet, args.verbose, args.cache,
+                args.hash, args.block_size, args.verify, args.reflink,
+                report, cache_max_entries=args.cache_max_entries)
+        elif update_files:
+            err = link_same_updates(
+                update_files, args.roots, args.pattern, args.write,
+                args.symlink, args.absolute, args.quiet, args.verbose,
+                args.jobs, args.cache, args.hash, args.block_size,
+                args.verify, args.reflink, report, None, device_jobs,
+                progress, args.cache_max_entries)
+        else:
+            err = link_same_files(
+                args.roots, args.pattern, args.write, args.symlink,
+                args.absolute, args.quiet, args.verbose, args.jobs,
+                args.cache, args.hash, args.block_size, args.verify,
+                args.reflink, report, None, device_jobs, args.checkpoint,
+                args.resume, args.max_files, progress,
+                args.cache_max_entries, args.spill_dir)
+    finally:
+        if report is not None and report is not sys.stdout:
+            report.close()
 
     if err:
         print(err, file=sys.stderr)
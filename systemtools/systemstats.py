@@ -4,47 +4,160 @@ Module to query system stats data.
 """
 from __future__ import print_function
 
+import fnmatch
+import heapq
 import subprocess
 import string
 import time
 import os
 import platform
+import re
+import threading
+from array import array
+from collections import namedtuple
 
 __author__ = "Andrew Gillis"
 
 
-# Seconds that stats are good before needing to be refreshed.
+# Seconds that stats are good before needing to be refreshed, unless a
+# different time is given for a metric.
 STATS_TTL = 60
 
+# Names of the cached metrics, which may each be given their own TTL.
+CACHED_METRICS = ('uptime', 'cpu_load', 'disk_usage', 'memory_usage',
+                  'logical_cpu_count')
 
-class SystemStats(object):
+# Distance from 2**32 within which a decreasing 32-bit counter is taken to
+# have wrapped around, instead of having been reset.
+_WRAP_MARGIN = 1 << 30
+
+# Usage of a mounted filesystem.  Sizes are in bytes, and capacity is the
+# percent of space used.
+DiskUsage = namedtuple('DiskUsage', 'partition size used available capacity')
+
+# Memory usage in bytes.
+MemoryUsage = namedtuple('MemoryUsage',
+                         'total available used free swap_total swapped')
+
+# Percent of CPU time spent in each state.  User includes nice, and system
+# includes time servicing interrupts.
+CpuUsage = namedtuple('CpuUsage', 'user system iowait steal idle')
+
+# Disk I/O rates for a block device.  Bytes and I/O operations are per second,
+# queue_depth is the average number of I/Os in progress, await_ms is the
+# average milliseconds for each I/O to complete, and util is the percent of
+# time the device was busy.
+DiskIO = namedtuple('DiskIO', 'read_bytes write_bytes read_iops write_iops '
+                    'queue_depth await_ms util')
+
+# Network interface rates.  Bytes and packets are per second.  Errors and
+# drops are the number since the previous sample.
+NetworkUsage = namedtuple('NetworkUsage', 'rx_bytes tx_bytes rx_packets '
+                          'tx_packets rx_errors tx_errors rx_drops tx_drops')
+
+# Resources used by a process.  rss is in bytes and cpu_time is user plus
+# system seconds.  fds, read_bytes, and write_bytes are None when they cannot
+# be read, which is usually for processes owned by other users.  read_bytes
+# and write_bytes are bytes read from and written to storage.
+ProcessStats = namedtuple('ProcessStats', 'pid name state ppid threads rss '
+                          'cpu_time fds read_bytes write_bytes')
+
+# ProcessStats fields that top_processes() can rank by.
+PROCESS_METRICS = ('rss', 'cpu_time', 'fds', 'threads', 'read_bytes',
+                   'write_bytes', 'io_bytes')
+
+# Aggregate of the samples of a metric over a window of time.
+Aggregate = namedtuple('Aggregate', 'count min max mean p95')
+
+
+class StatsCache(object):
+
+    """
+    Cache of stats values, timestamped using a monotonic clock.
+
+    Each SystemStats has its own cache, unless a StatsCache is given to share
+    between instances.  A shared cache is safe to use from multiple threads.
+    Each instance decides, using its own TTLs, whether a cached value is
+    fresh enough to use, so instances that poll at different rates do not
+    interfere with each other.
+
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def get(self, key, ttl, func, force=False):
+        """Return the cached value for key, or func() if older than ttl.
 
-    _last_uptime = 0
-    _uptime = {}
-    _load = {}
+        If force is True, then func() is always called to get a new value.
 
-    def __init__(self, show_bytes=False, verbose_du=False):
+        """
+        if not force:
+            with self._lock:
+                entry = self._values.get(key)
+            if entry is not None and time.monotonic() - entry[0] < ttl:
+                return entry[1]
+        value = func()
+        with self._lock:
+            self._values[key] = (time.monotonic(), value)
+        return value
+
+    def age(self, key):
+        """Return seconds since the value for key was cached, or None."""
+        with self._lock:
+            entry = self._values.get(key)
+        if entry is None:
+            return None
+        return time.monotonic() - entry[0]
+
+    def clear(self):
+        """Remove all cached values."""
+        with self._lock:
+            self._values.clear()
+
+
+class SystemStats(object):
+
+    def __init__(self, show_bytes=False, verbose_du=False, ttl=None,
+                 cache=None):
         """
         Arguments:
         show_bytes -- If True, show absolute bytes in size values.  If False,
                       only show sizes rounded to the highest significant power
                       of two.
         short_du   -- Show shorter disk usage strings.
+        ttl        -- Seconds that cached stats are used before being read
+                      again.  Either a number for all metrics, or a
+                      dictionary of {metric: seconds}, where metric is one of
+                      CACHED_METRICS.  Metrics not given use STATS_TTL.
+        cache      -- StatsCache to share with other instances.  If None,
+                      then this instance has its own cache.
 
         """
-        self._last_disk = 0
-        self._disk_stats = None
-
-        self._last_mem = 0
-        self._mem_stats = None
+        if ttl is None:
+            ttl = {}
+        elif not isinstance(ttl, dict):
+            ttl = dict.fromkeys(CACHED_METRICS, ttl)
+        for metric in ttl:
+            if metric not in CACHED_METRICS:
+                raise ValueError('unknown metric: %s' % (metric,))
+        self._ttl = ttl
+        self._cache = cache if cache is not None else StatsCache()
         self._show_bytes = show_bytes
         self._verbose_du = verbose_du
+        self._cpu_sampler = CpuSampler()
+        self._disk_io_sampler = DiskIOSampler()
+        self._network_sampler = NetworkSampler()
 
     def __str__(self):
         """Get stats information as string."""
         st = [self.uptime_str(),
               self.disk_usage_str(),
               self.cpu_load_str(),
+              self.cpu_usage_str(),
+              self.disk_io_str(),
+              self.network_usage_str(),
               self.memory_usage_str(),
               self.logical_cpu_count_str()]
         return '\n\n'.join(st)
@@ -52,6 +165,9 @@ class SystemStats(object):
     def stats(self):
         return {'disk_usage': self.disk_usage(),
                 'cpu_load': self.cpu_load(),
+                'cpu_usage': self.cpu_usage(),
+                'disk_io': self.disk_io(),
+                'network_usage': self.network_usage(),
                 'uptime': self.uptime(),
                 'memory_usage': self.memory_usage(),
                 'logical_cpu_count': self.logical_cpu_count()}
@@ -101,6 +217,56 @@ class SystemStats(object):
         st.append('last fifteen minutes: %s' % load_stats['fifteen'])
         return '\n'.join(st)
 
+    def cpu_usage_str(self):
+        """Return CPU utilization, since the previous call, as string."""
+        title = 'CPU Usage:'
+        st = [title]
+        st.append('-'*len(title))
+        usage = self.cpu_usage()
+        for name in sorted(usage, key=_cpu_order):
+            cu = usage[name]
+            st.append('%s\tuser=%.1f%% system=%.1f%% iowait=%.1f%% '
+                      'steal=%.1f%% idle=%.1f%%' % ((name,) + cu))
+        return '\n'.join(st)
+
+    def disk_io_str(self):
+        """Return disk I/O rates, since the previous call, as string."""
+        title = 'Disk I/O:'
+        st = [title]
+        st.append('-'*len(title))
+        disks = self.disk_io()
+        for dev in sorted(disks):
+            io = disks[dev]
+            st.append('%s\tread=%s/s write=%s/s reads=%.1f/s writes=%.1f/s '
+                      'queue=%.2f await=%.1fms util=%.1f%%' % (
+                          dev, size_str(int(io.read_bytes)),
+                          size_str(int(io.write_bytes)), io.read_iops,
+                          io.write_iops, io.queue_depth, io.await_ms,
+                          io.util))
+        return '\n'.join(st)
+
+    def network_usage_str(self, interfaces=None):
+        """Return network interface rates, since the previous call, as string.
+
+        Arguments:
+        interfaces -- Glob pattern of interface names to show.  Default is
+                      all interfaces.
+
+        """
+        title = 'Network Usage:'
+        st = [title]
+        st.append('-'*len(title))
+        nets = self.network_usage(interfaces)
+        for name in sorted(nets):
+            net = nets[name]
+            st.append('%s\trx=%s/s tx=%s/s rx_packets=%.1f/s '
+                      'tx_packets=%.1f/s errors=%d/%d drops=%d/%d' % (
+                          name, size_str(int(net.rx_bytes)),
+                          size_str(int(net.tx_bytes)), net.rx_packets,
+                          net.tx_packets, net.rx_errors, net.tx_errors,
+                          net.rx_drops, net.tx_drops))
+        return '\n'.join(st)
+
     def memory_usage_str(self):
         """Return memory usage information as string."""
         title = 'Memory usage:'
@@ -119,15 +285,59 @@ class SystemStats(object):
         st.append(str(self.logical_cpu_count()))
         return '\n'.join(st)
 
+    def cpu_usage(self):
+        """Return dictionary of {name: CpuUsage}, since the previous call.
+
+        The name 'cpu' is for all CPUs, and 'cpu0', 'cpu1', etc. are for each
+        CPU.  The first call gives utilization since the system started.  The
+        dictionary is empty if /proc/stat is not available.
+
+        """
+        return self._cpu_sampler.sample()
+
+    def disk_io(self):
+        """Return dictionary of {device: DiskIO}, since the previous call.
+
+        The first call gives rates since the system started.  The dictionary
+        is empty if /proc/diskstats is not available.
+
+        """
+        return self._disk_io_sampler.sample()
+
+    def network_usage(self, interfaces=None):
+        """Return dictionary of {interface: NetworkUsage}, since previous call.
+
+        The first call gives rates since the system started.  The dictionary
+        is empty if /proc/net/dev is not available.
+
+        Arguments:
+        interfaces -- Glob pattern of interface names to return.  Default is
+                      all interfaces.
+
+        """
+        nets = self._network_sampler.sample()
+        if interfaces:
+            nets = dict((name, net) for name, net in nets.items()
+                        if fnmatch.fnmatch(name, interfaces))
+        return nets
+
+    def refresh(self, force=True):
+        """Read all cached metrics again.
+
+        If force is False, then only the metrics whose TTL has expired are
+        read again.
+
+        """
+        for metric in CACHED_METRICS:
+            self._cached(metric, force)
+
     def uptime(self):
         """Return uptime info dictionary."""
-        up, load = self._uptime_load()
-        return up
+        return self._cached('uptime')
 
     def cpu_load(self):
         """Return CPU load information dictionary."""
-        up, load = self._uptime_load()
-        return load
+        return self._cached('cpu_load')
 
     def disk_usage(self):
         """Return disk usage dictionary.
@@ -141,39 +351,19 @@ class SystemStats(object):
         the corresponding data.
 
         """
-        now = int(time.time())
-        if now - self._last_disk < STATS_TTL:
-            return self._disk_stats
-
-        proc = subprocess.Popen(('df', '-P'), stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE)
-        out, err = proc.communicate()
-        df = out.decode('utf-8').strip().split('\n')
-        block_size = int(df[0].split()[1].split('-')[0])
         ds = {}
-        for l in df[1:]:
-            part, size_bks, used_bks, avail_bks, cap, mount = l.split()[:6]
-            size = int(size_bks) * block_size
-            used = int(used_bks) * block_size
-            avail = int(avail_bks) * block_size
-            info = {'partition': part, 'capacity': cap}
-            ds[mount] = info
-            if self._show_bytes:
-                # Show absolute bytes as well as short size value.
-                info['size'] = '%s (%s)' % (size, size_str(size))
-                info['used'] = '%s (%s)' % (used, size_str(used))
-                info['available'] = '%s (%s)' % (
-                    avail, size_str(avail))
-            else:
-                # Do not show absolute bytes in size values.
-                info['size'] = size_str(size)
-                info['used'] = size_str(used)
-                info['available'] = size_str(avail)
-
-        self._last_disk = now
-        self._disk_stats = ds
+        for mount, du in self.disk_stats().items():
+            ds[mount] = {'partition': du.partition,
+                         'size': self._size_fmt(du.size),
+                         'used': self._size_fmt(du.used),
+                         'available': self._size_fmt(du.available),
+                         'capacity': '%d%%' % (du.capacity,)}
         return ds
 
+    def disk_stats(self):
+        """Return dictionary of {mount: DiskUsage} for mounted filesystems."""
+        return self._cached('disk_usage')
+
     def memory_usage(self):
         """Return memory usage information dictionary.
 
@@ -182,24 +372,78 @@ class SystemStats(object):
         associated value.
 
         """
-        now = int(time.time())
-        if now - self._last_mem < STATS_TTL:
-            return self._mem_stats
+        mem = self.memory_stats()
+        return dict((name, self._size_fmt(value))
+                    for name, value in zip(mem._fields, mem))
+
+    def memory_stats(self):
+        """Return MemoryUsage.  Values are None if not known."""
+        return self._cached('memory_usage')
+
+    def raw_stats(self):
+        """Return the same stats as stats(), as numbers instead of strings.
+
+        The disk_usage value is a dictionary of {mount: DiskUsage}, and the
+        memory_usage value is a MemoryUsage.
+
+        """
+        return {'disk_usage': self.disk_stats(),
+                'cpu_load': self.cpu_load(),
+                'cpu_usage': self.cpu_usage(),
+                'disk_io': self.disk_io(),
+                'network_usage': self.network_usage(),
+                'uptime': self.uptime(),
+                'memory_usage': self.memory_stats(),
+                'logical_cpu_count': self.logical_cpu_count()}
 
+    def logical_cpu_count(self):
+        """Return the number of logical CPUs."""
+        return self._cached('logical_cpu_count')
+
+    def _cached(self, metric, force=False):
+        # Return the value of metric from the cache, or read it if the cached
+        # value is older than the metric's TTL.
+        return self._cache.get(metric, self._ttl.get(metric, STATS_TTL),
+                               getattr(self, '_read_' + metric), force)
+
+    def _read_uptime(self):
         if platform.system() == 'Linux':
-            mem_stats = self._linux_mem()
-        elif platform.system() == 'FreeBSD':
-            mem_stats = self._freebsd_mem()
-        else:
-            na = 'n/a'
-            mem_stats = {'free': na, 'used': na, 'total': na, 'swapped': na,
-                         'swap_total': na, 'available': na}
+            return self._proc_uptime()
+        return self._uptime_load('uptime')[0]
+
+    def _read_cpu_load(self):
+        if platform.system() == 'Linux':
+            return self._proc_load()
+        return self._uptime_load('cpu_load')[1]
+
+    def _uptime_load(self, metric):
+        # Running uptime gets both uptime and load, so one run serves both
+        # metrics.  Its output is used again if it was read after the cached
+        # value of metric, as when the other metric was just read.
+        age = self._cache.age(metric)
+        if age is None:
+            age = self._ttl.get(metric, STATS_TTL)
+        return self._cache.get('uptime_load', age, self._cmd_uptime_load)
 
-        self._last_mem = now
-        self._mem_stats = mem_stats
+    def _read_disk_usage(self):
+        if platform.system() == 'Linux':
+            return self._proc_disks()
+        return self._df_disks()
+
+    def _read_memory_usage(self):
+        mem_stats = None
+        try:
+            if platform.system() == 'Linux':
+                mem_stats = self._linux_mem()
+            elif platform.system() == 'FreeBSD':
+                mem_stats = self._freebsd_mem()
+        except Exception:
+            pass
+        if mem_stats is None:
+            mem_stats = MemoryUsage(*(None,) * len(MemoryUsage._fields))
         return mem_stats
 
-    def logical_cpu_count(self):
+    def _read_logical_cpu_count(self):
         cores = 0
         if platform.system() == 'Linux':
             cpu_path = '/dev/cpu'
@@ -215,13 +459,78 @@ class SystemStats(object):
             return 1
         return cores
 
-    def _uptime_load(self):
-        # If not enough time has elapsed, then do not update stats.
-        now = int(time.time())
-        if now - SystemStats._last_uptime < STATS_TTL:
-            return SystemStats._uptime, SystemStats._load
+    def _proc_disks(self):
+        """Get disk usage for mounted filesystems on a linux system.
+
+        This is done by reading /proc/self/mounts and calling statvfs for each
+        mount point.  As with df, filesystems that have no blocks are skipped.
 
-        SystemStats._last_uptime = now
+        Return: {mount: DiskUsage}
+
+        """
+        disks = {}
+        with open('/proc/self/mounts') as f:
+            for l in f:
+                fields = l.split()
+                if len(fields) < 2:
+                    continue
+                part = _unescape_mount(fields[0])
+                mount = _unescape_mount(fields[1])
+                try:
+                    st = os.statvfs(mount)
+                except OSError:
+                    continue
+                if not st.f_blocks:
+                    continue
+                size = st.f_blocks * st.f_frsize
+                used = (st.f_blocks - st.f_bfree) * st.f_frsize
+                avail = st.f_bavail * st.f_frsize
+                disks[mount] = DiskUsage(part, size, used, avail,
+                                         _capacity(used, avail))
+        return disks
+
+    def _df_disks(self):
+        """Get disk usage for mounted filesystems by running df.
+
+        Return: {mount: DiskUsage}
+
+        """
+        proc = subprocess.Popen(('df', '-P'), stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        out, err = proc.communicate()
+        df = out.decode('utf-8').strip().split('\n')
+        block_size = int(df[0].split()[1].split('-')[0])
+        disks = {}
+        for l in df[1:]:
+            part, size_bks, used_bks, avail_bks, cap, mount = l.split()[:6]
+            disks[mount] = DiskUsage(part, int(size_bks) * block_size,
+                                     int(used_bks) * block_size,
+                                     int(avail_bks) * block_size,
+                                     int(cap.rstrip('%')))
+        return disks
+
+    def _proc_uptime_load(self):
+        """Get uptime and load averages on a linux system."""
+        return self._proc_uptime(), self._proc_load()
+
+    def _proc_uptime(self):
+        """Get uptime on a linux system, by reading /proc/uptime."""
+        with open('/proc/uptime') as f:
+            seconds = int(float(f.read().split()[0]))
+        minutes, seconds = divmod(seconds, 60)
+        hours, minutes = divmod(minutes, 60)
+        days, hours = divmod(hours, 24)
+        return {'days': days, 'hours': hours, 'minutes': minutes}
+
+    def _proc_load(self):
+        """Get load averages on a linux system, by reading /proc/loadavg."""
+        with open('/proc/loadavg') as f:
+            one, five, fifteen = f.read().split()[:3]
+        return {'one': float(one), 'five': float(five),
+                'fifteen': float(fifteen)}
+
+    def _cmd_uptime_load(self):
+        """Get uptime and load averages by running uptime."""
         not_nums = string.whitespace+string.ascii_letters+string.punctuation
         uptime = subprocess.check_output('uptime').decode('utf-8')
 
@@ -249,9 +558,6 @@ class SystemStats(object):
         l = {'one': float(one.rstrip(',')),
              'five': float(five.rstrip(',')),
              'fifteen': float(fifteen.rstrip(','))}
-
-        SystemStats._uptime = u
-        SystemStats._load = l
         return u, l
 
     def _linux_mem(self):
@@ -259,142 +565,720 @@ class SystemStats(object):
 
         This is done by reading /proc/meminfo
 
+        Return: MemoryUsage
+
         """
         meminfo = {}
+        with open('/proc/meminfo') as file_meminfo:
+            for l in file_meminfo:
+                k, _, v = l.partition(':')
+                meminfo[k] = v
 
         def convert_mem(label):
-            mem, units = meminfo[label].split()
-            if units == 'kB':
-                mem = int(mem) * 1024
-            elif units == 'mB':
-                mem = int(mem) * 1024 * 1024
-            else:
-                mem = int(mem)
+            v = meminfo[label].split()
+            mem = int(v[0])
+            if len(v) > 1:
+                if v[1] == 'kB':
+                    mem *= 1024
+                elif v[1] == 'mB':
+                    mem *= 1024 * 1024
             return mem
 
-        mem_free = mem_used = mem_total = mem_avail = 'n/a'
-        swapped = swap_total = 'n/a'
-        if os.path.exists('/proc/meminfo'):
-            try:
-                with open('/proc/meminfo') as file_meminfo:
-                    meminfo_data = file_meminfo.read()
-                for l in meminfo_data.split("\n"):
-                    if ':' not in l:
-                        continue
-                    k, v = l.split(':', 1)
-                    meminfo[k] = v.strip()
-
-                mem_total = convert_mem('MemTotal')
-                mem_free = convert_mem('MemFree')
-                mem_buffers = convert_mem('Buffers')
-
-                mem_cached = convert_mem('Cached')
-                #mem_inactive = convert_mem('Inactive')
-                swapped = convert_mem('SwapCached')
-                swap_total = convert_mem('SwapTotal')
-
-                # determine logical summary information
-                #mem_avail = mem_inactive + mem_cached + mem_free
-                mem_avail = mem_buffers + mem_cached + mem_free
-                mem_used = mem_total - mem_avail
-
-                if self._show_bytes:
-                    mem_free = '%d (%s)' % (mem_free,
-                                            size_str(mem_free))
-                    mem_total = '%d (%s)' % (mem_total,
-                                             size_str(mem_total))
-                    mem_avail = '%d (%s)' % (mem_avail,
-                                             size_str(mem_avail))
-                    mem_used = '%d (%s)' % (mem_used,
-                                            size_str(mem_used))
-                    swapped = '%d (%s)' % (swapped,
-                                           size_str(swapped))
-                    swap_total = '%d (%s)' % (swap_total,
-                                              size_str(swap_total))
-                else:
-                    mem_free = size_str(mem_free)
-                    mem_total = size_str(mem_total)
-                    mem_avail = size_str(mem_avail)
-                    mem_used = size_str(mem_used)
-                    swapped = size_str(swapped)
-                    swap_total = size_str(swap_total)
-            except Exception:
-                pass
+        mem_total = convert_mem('MemTotal')
+        mem_free = convert_mem('MemFree')
+        mem_buffers = convert_mem('Buffers')
+        mem_cached = convert_mem('Cached')
+        #mem_inactive = convert_mem('Inactive')
+        swapped = convert_mem('SwapCached')
+        swap_total = convert_mem('SwapTotal')
 
-        return {'free': mem_free, 'used': mem_used, 'total': mem_total,
-                'swapped': swapped, 'swap_total': swap_total,
-                'available': mem_avail}
+        # determine logical summary information
+        #mem_avail = mem_inactive + mem_cached + mem_free
+        mem_avail = mem_buffers + mem_cached + mem_free
+        mem_used = mem_total - mem_avail
+        return MemoryUsage(mem_total, mem_avail, mem_used, mem_free,
+                           swap_total, swapped)
 
     def _freebsd_mem(self):
         """Get the available memory for a FreeBSD system.
 
         This is done by reading information from sysctl.
 
+        Return: MemoryUsage
+
+        """
+        sysctl = {}
+        out = subprocess.check_output(
+            ('/sbin/sysctl', '-a')).decode('utf-8').strip()
+        for l in out.split('\n'):
+            if ':' not in l:
+                continue
+            k, v = l.split(':', 1)
+            sysctl[k] = v
+
+        def mem_rounded(mem_size):
+            chip_size = 1
+            chip_guess = (mem_size // 8) - 1
+            while (chip_guess):
+                chip_guess >>= 1
+                chip_size <<= 1
+            return ((mem_size // chip_size) + 1) * chip_size
+
+        mem_phys = int(sysctl['hw.physmem'])
+        page_size = int(sysctl['hw.pagesize'])
+        mem_hw = mem_rounded(mem_phys)
+        #mem_all = (int(sysctl['vm.stats.vm.v_page_count']) * page_size)
+        #mem_wire = (int(sysctl['vm.stats.vm.v_wire_count']) * page_size)
+        #mem_active= (int(sysctl['vm.stats.vm.v_active_count'])* page_size)
+        mem_inactive = (int(sysctl['vm.stats.vm.v_inactive_count']) *
+                        page_size)
+        mem_cache = (int(sysctl['vm.stats.vm.v_cache_count']) * page_size)
+        mem_free = (int(sysctl['vm.stats.vm.v_free_count']) * page_size)
+
+        swap_total = int(sysctl['vm.swap_total'])
+        swapped = int(sysctl['vm.stats.vm.v_swappgsout'])
+
+        # determine logical summary information
+        mem_total = mem_hw
+        mem_avail = mem_inactive + mem_cache + mem_free
+        mem_used = mem_total - mem_avail
+        return MemoryUsage(mem_total, mem_avail, mem_used, mem_free,
+                           swap_total, swapped)
+
+    def _size_fmt(self, size):
+        """Format size in bytes as string, or 'n/a' if size is None."""
+        if size is None:
+            return 'n/a'
+        if self._show_bytes:
+            # Show absolute bytes as well as short size value.
+            return '%d (%s)' % (size, size_str(size))
+        return size_str(size)
+
+
+class CpuSampler(object):
+
+    """
+    Calculate CPU utilization from successive samples of /proc/stat.
+
+    Each call to sample() reads the current CPU time counters and returns the
+    utilization since the previous call, so the caller does not need to wait
+    between two readings.  Only the previous counters are kept.
+
+    """
+
+    def __init__(self, path='/proc/stat'):
+        self._path = path
+        self._prev = {}
+
+    def sample(self):
+        """Return dictionary of {name: CpuUsage} since the previous sample."""
+        try:
+            with open(self._path, 'rb') as f:
+                data = f.read()
+        except (IOError, OSError):
+            return {}
+
+        prev = self._prev
+        cur = {}
+        usage = {}
+        for line in data.split(b'\n'):
+            if not line.startswith(b'cpu'):
+                # CPU lines are all at the start of the file.
+                break
+            fields = line.split()
+            name = fields[0].decode()
+            # user nice system idle iowait irq softirq steal
+            times = [int(v) for v in fields[1:9]]
+            times.extend((0,) * (8 - len(times)))
+            cur[name] = times
+            last = prev.get(name)
+            if last is None:
+                d = times
+            else:
+                # Counters can go backward if a CPU goes offline.
+                d = [max(t - l, 0) for t, l in zip(times, last)]
+            total = sum(d)
+            if total <= 0:
+                usage[name] = CpuUsage(0.0, 0.0, 0.0, 0.0, 100.0)
+                continue
+            pct = 100.0 / total
+            usage[name] = CpuUsage((d[0] + d[1]) * pct,
+                                   (d[2] + d[5] + d[6]) * pct,
+                                   d[4] * pct, d[7] * pct, d[3] * pct)
+        self._prev = cur
+        return usage
+
+
+class DiskIOSampler(object):
+
+    """
+    Calculate disk I/O rates from successive samples of /proc/diskstats.
+
+    Each call to sample() reads the current I/O counters of each block device
+    and returns the rates since the previous call.  Only the previous counters
+    are kept.  Devices that have never done any I/O, such as unused loop
+    devices, are skipped.
+
+    """
+
+    # Bytes in each sector counted by /proc/diskstats.
+    SECTOR_SIZE = 512
+
+    def __init__(self, path='/proc/diskstats', devices=None):
         """
-        mem_free = mem_used = mem_total = mem_avail = 'n/a'
-        swapped = swap_total = 'n/a'
+        Arguments:
+        path    -- Path of diskstats file.
+        devices -- Glob pattern of device names to include.  Default is all.
+
+        """
+        self._path = path
+        self._devices = devices
+        self._prev = {}
+        self._prev_time = None
+
+    def sample(self):
+        """Return dictionary of {device: DiskIO} since the previous sample."""
         try:
-            sysctl = {}
-            out = subprocess.check_output(
-                ('/sbin/sysctl', '-a')).decode('utf-8').strip()
-            for l in out.split('\n'):
-                if ':' not in l:
-                    continue
-                k, v = l.split(':', 1)
-                sysctl[k] = v
-
-            def mem_rounded(mem_size):
-                chip_size = 1
-                chip_guess = (mem_size // 8) - 1
-                while (chip_guess):
-                    chip_guess >>= 1
-                    chip_size <<= 1
-                return ((mem_size // chip_size) + 1) * chip_size
-
-            mem_phys = int(sysctl['hw.physmem'])
-            page_size = int(sysctl['hw.pagesize'])
-            mem_hw = mem_rounded(mem_phys)
-            #mem_all = (int(sysctl['vm.stats.vm.v_page_count']) * page_size)
-            #mem_wire = (int(sysctl['vm.stats.vm.v_wire_count']) * page_size)
-            #mem_active= (int(sysctl['vm.stats.vm.v_active_count'])* page_size)
-            mem_inactive = (int(sysctl['vm.stats.vm.v_inactive_count']) *
-                            page_size)
-            mem_cache = (int(sysctl['vm.stats.vm.v_cache_count']) * page_size)
-            mem_free = (int(sysctl['vm.stats.vm.v_free_count']) * page_size)
-
-            swap_total = int(sysctl['vm.swap_total'])
-            swapped = int(sysctl['vm.stats.vm.v_swappgsout'])
-
-            # determine logical summary information
-            mem_total = mem_hw
-            mem_avail = mem_inactive + mem_cache + mem_free
-            mem_used = mem_total - mem_avail
-
-            if self._show_bytes:
-                mem_free = '%d (%s)' % (mem_free,
-                                        size_str(mem_free))
-                mem_total = '%d (%s)' % (mem_total,
-                                         size_str(mem_total))
-                mem_avail = '%d (%s)' % (mem_avail,
-                                         size_str(mem_avail))
-                mem_used = '%d (%s)' % (mem_used,
-                                        size_str(mem_used))
-                swapped = '%d (%s)' % (swapped, size_str(swapped))
-                swap_total = '%d (%s)' % (swap_total,
-                                          size_str(swap_total))
+            with open(self._path, 'rb') as f:
+                data = f.read()
+        except (IOError, OSError):
+            return {}
+        now = time.monotonic()
+        if self._prev_time is None:
+            elapsed = _seconds_since_boot(now)
+        else:
+            elapsed = now - self._prev_time
+        self._prev_time = now
+
+        prev = self._prev
+        cur = {}
+        rates = {}
+        for line in data.split(b'\n'):
+            fields = line.split()
+            if len(fields) < 14:
+                continue
+            dev = fields[2].decode()
+            if self._devices and not fnmatch.fnmatch(dev, self._devices):
+                continue
+            # reads, sectors read, ms reading, writes, sectors written,
+            # ms writing, ms doing I/O, weighted ms doing I/O
+            counters = (int(fields[3]), int(fields[5]), int(fields[6]),
+                        int(fields[7]), int(fields[9]), int(fields[10]),
+                        int(fields[12]), int(fields[13]))
+            if not (counters[0] or counters[3]):
+                continue
+            cur[dev] = counters
+            last = prev.get(dev)
+            if last is None:
+                d = counters
             else:
-                mem_free = size_str(mem_free)
-                mem_total = size_str(mem_total)
-                mem_avail = size_str(mem_avail)
-                mem_used = size_str(mem_used)
-                swapped = size_str(swapped)
-                swap_total = size_str(swap_total)
-        except Exception:
-            pass
+                # Counters are reset if the device is removed and added.
+                d = [max(c - l, 0) for c, l in zip(counters, last)]
+            rates[dev] = _disk_io(d, elapsed, self.SECTOR_SIZE)
+        self._prev = cur
+        return rates
+
+
+def _disk_io(d, elapsed, sector_size):
+    """Return DiskIO from deltas of diskstats counters over elapsed seconds."""
+    reads, rd_sectors, rd_ms, writes, wr_sectors, wr_ms, io_ms, weighted_ms = d
+    if elapsed <= 0:
+        return DiskIO(0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0)
+    ios = reads + writes
+    return DiskIO(rd_sectors * sector_size / elapsed,
+                  wr_sectors * sector_size / elapsed,
+                  reads / elapsed, writes / elapsed,
+                  weighted_ms / 1000.0 / elapsed,
+                  float(rd_ms + wr_ms) / ios if ios else 0.0,
+                  min(100.0, io_ms / 10.0 / elapsed))
+
+
+class NetworkSampler(object):
+
+    """
+    Calculate network interface rates from successive samples of /proc/net/dev.
+
+    Each call to sample() reads the current counters of each interface and
+    returns the rates since the previous call.  Only the previous counters
+    are kept.  Counters that wrap around at 32 bits, and counters that are
+    reset when an interface is re-created, are handled.
+
+    """
+
+    def __init__(self, path='/proc/net/dev', interfaces=None):
+        """
+        Arguments:
+        path       -- Path of net/dev file.
+        interfaces -- Glob pattern of interface names to include.  Default is
+                      all interfaces.
+
+        """
+        self._path = path
+        self._interfaces = interfaces
+        self._prev = {}
+        self._prev_time = None
+
+    def sample(self):
+        """Return {interface: NetworkUsage} since the previous sample."""
+        try:
+            with open(self._path, 'rb') as f:
+                data = f.read()
+        except (IOError, OSError):
+            return {}
+        now = time.monotonic()
+        if self._prev_time is None:
+            elapsed = _seconds_since_boot(now)
+        else:
+            elapsed = now - self._prev_time
+        self._prev_time = now
+
+        prev = self._prev
+        cur = {}
+        rates = {}
+        # Skip the two header lines.
+        for line in data.split(b'\n')[2:]:
+            name, sep, values = line.partition(b':')
+            if not sep:
+                continue
+            name = name.strip().decode()
+            if self._interfaces and not fnmatch.fnmatch(name,
+                                                         self._interfaces):
+                continue
+            fields = values.split()
+            # rx bytes, packets, errs, drop, tx bytes, packets, errs, drop
+            counters = (int(fields[0]), int(fields[8]), int(fields[1]),
+                        int(fields[9]), int(fields[2]), int(fields[10]),
+                        int(fields[3]), int(fields[11]))
+            cur[name] = counters
+            last = prev.get(name)
+            if last is None:
+                d = counters
+            else:
+                d = [_counter_delta(c, l) for c, l in zip(counters, last)]
+            rates[name] = _network_usage(d, elapsed)
+        self._prev = cur
+        return rates
+
+
+def _network_usage(d, elapsed):
+    """Return NetworkUsage from deltas of net/dev counters over elapsed."""
+    if elapsed <= 0:
+        elapsed = 1.0
+    return NetworkUsage(d[0] / elapsed, d[1] / elapsed, d[2] / elapsed,
+                        d[3] / elapsed, d[4], d[5], d[6], d[7])
+
+
+def _counter_delta(cur, last):
+    """Return increase from last to cur, for a counter that can go back.
+
+    A decrease is taken to be a 32-bit counter wrapping around only when last
+    was within _WRAP_MARGIN of 2**32 and cur is below _WRAP_MARGIN.  Any
+    other decrease is a reset, as when an interface is re-created or its
+    driver reloaded, so the increase is cur.
+
+    """
+    if cur >= last:
+        return cur - last
+    if (1 << 32) - _WRAP_MARGIN <= last < (1 << 32) and cur < _WRAP_MARGIN:
+        return cur + (1 << 32) - last
+    return cur
+
+
+def _seconds_since_boot(now):
+    """Return seconds since boot, or now if /proc/uptime is not available."""
+    try:
+        with open('/proc/uptime') as f:
+            return float(f.read().split()[0])
+    except (IOError, OSError):
+        return now
+
+
+class StatsSampler(object):
+
+    """
+    Collect stats at a fixed interval into fixed-size ring buffers.
+
+    Each metric is kept in an array of floats, holding the most recent
+    history samples, with one shared array of sample times.  A background
+    thread collects samples every interval seconds after start() is called.
+    Aggregates over the last N seconds are calculated by aggregate().
+
+    The default metrics are:
+    cpu_busy, cpu_iowait   -- Percent of all CPU time.
+    load_one               -- One minute load average.
+    mem_used, mem_available
+                           -- Memory in bytes.
+    disk_used:<mount>      -- Percent of space used on each filesystem.
+    disk_read:<dev>, disk_write:<dev>
+                           -- Bytes per second read and written on each
+                              block device.
+    disk_util:<dev>        -- Percent of time each block device was busy.
+    net_rx:<if>, net_tx:<if>
+                           -- Bytes per second received and sent on each
+                              network interface.
 
-        return {'free': mem_free, 'used': mem_used, 'total': mem_total,
-                'swapped': swapped, 'swap_total': swap_total,
-                'available': mem_avail}
+    Other metrics are added by giving collectors, which are functions that
+    return a dictionary of {metric name: value}.  A metric that is missing
+    from history samples in a row, such as for a network interface that was
+    removed, is dropped, so memory use stays fixed when device names change.
+
+    """
+
+    def __init__(self, interval=1.0, history=3600, collectors=None):
+        """
+        Arguments:
+        interval   -- Seconds between samples.
+        history    -- Number of samples kept for each metric.
+        collectors -- Functions that return {name: value} for each sample.
+                      Default is the metrics listed above.
+
+        """
+        assert interval > 0 and history > 0
+        self._interval = interval
+        self._history = history
+        if collectors is None:
+            collectors = self._default_collectors()
+        self._collectors = list(collectors)
+        self._times = array('d', [0.0]) * history
+        self._columns = {}
+        self._seen = {}        # {name: sample number when last collected}
+        self._samples = 0
+        self._pos = 0
+        self._count = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Start collecting samples in a background thread."""
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop collecting samples, and wait for the thread to exit."""
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def metrics(self):
+        """Return sorted list of metric names."""
+        with self._lock:
+            return sorted(self._columns)
+
+    def sample(self):
+        """Collect one sample of all metrics now."""
+        values = {}
+        for collect in self._collectors:
+            try:
+                values.update(collect())
+            except Exception:
+                continue
+        now = time.monotonic()
+        nan = float('nan')
+        with self._lock:
+            pos = self._pos
+            self._times[pos] = now
+            self._samples += 1
+            for name in values:
+                if name not in self._columns:
+                    self._columns[name] = array('d', [nan]) * self._history
+                self._seen[name] = self._samples
+            for name, column in list(self._columns.items()):
+                if name in values:
+                    column[pos] = values[name]
+                elif self._samples - self._seen[name] >= self._history:
+                    # Every sample kept for the metric is now missing.
+                    del self._columns[name]
+                    del self._seen[name]
+                else:
+                    column[pos] = nan
+            self._pos = (pos + 1) % self._history
+            if self._count < self._history:
+                self._count += 1
+
+    def latest(self, name):
+        """Return the most recent value of metric, or None."""
+        with self._lock:
+            column = self._columns.get(name)
+            if column is None or not self._count:
+                return None
+            value = column[self._pos - 1]
+        return None if value != value else value
+
+    def aggregate(self, name, seconds):
+        """Return Aggregate of the samples of metric in the last seconds.
+
+        The window is found by scanning back from the newest sample, and is
+        read in place from the ring buffer, without copying or sorting it.
+        Count, min, max, and mean are found in one pass.  The 95th percentile
+        is found in a second pass that keeps only the largest 5% of values in
+        a heap, so the time is O(window) for a fixed percentile.  Samples
+        where the metric was not available are skipped.  Returns None if there
+        are no samples.
+
+        """
+        with self._lock:
+            column = self._columns.get(name)
+            if column is None:
+                return None
+            segments = self._window(column, seconds)
+            count = 0
+            total = 0.0
+            lo = hi = None
+            for seg in segments:
+                for v in seg:
+                    if v != v:
+                        continue
+                    count += 1
+                    total += v
+                    if lo is None or v < lo:
+                        lo = v
+                    if hi is None or v > hi:
+                        hi = v
+            if not count:
+                return None
+            # The 95th percentile is the value at index int(0.95 * count) of
+            # the sorted values, which is the smallest of the values above it.
+            top = count - min(count - 1, int(0.95 * count))
+            p95 = heapq.nlargest(top, (v for seg in segments for v in seg
+                                       if v == v))[-1]
+        return Aggregate(count, lo, hi, total / count, p95)
+
+    def _window(self, column, seconds):
+        # Return memoryviews of the samples of column in the last seconds.
+        # Must be called with lock held.
+        start = time.monotonic() - seconds
+        times = self._times
+        n = 0
+        i = self._pos - 1
+        while n < self._count and times[i] >= start:
+            n += 1
+            i -= 1
+        if not n:
+            return ()
+        mv = memoryview(column)
+        end = self._pos
+        first = end - n
+        if first >= 0:
+            return (mv[first:end],)
+        return (mv[first + self._history:], mv[:end])
+
+    def _run(self):
+        while not self._stop.is_set():
+            started = time.monotonic()
+            self.sample()
+            self._stop.wait(max(0.0, self._interval -
+                                (time.monotonic() - started)))
+
+    def _default_collectors(self):
+        # Cached values are never used, so that every sample is current.
+        ss = SystemStats(ttl=0)
+        cpu = CpuSampler()
+        disk_io = DiskIOSampler()
+        network = NetworkSampler()
+
+        def collect_cpu():
+            usage = cpu.sample().get('cpu')
+            if usage is None:
+                return {}
+            return {'cpu_busy': 100.0 - usage.idle,
+                    'cpu_iowait': usage.iowait}
+
+        def collect_load():
+            return {'load_one': ss.cpu_load()['one']}
+
+        def collect_mem():
+            mem = ss.memory_stats()
+            if mem.used is None:
+                return {}
+            return {'mem_used': mem.used, 'mem_available': mem.available}
+
+        def collect_disk():
+            disks = ss.disk_stats()
+            return dict(('disk_used:' + mount, du.capacity)
+                        for mount, du in disks.items())
+
+        def collect_disk_io():
+            values = {}
+            for dev, io in disk_io.sample().items():
+                values['disk_read:' + dev] = io.read_bytes
+                values['disk_write:' + dev] = io.write_bytes
+                values['disk_util:' + dev] = io.util
+            return values
+
+        def collect_network():
+            values = {}
+            for name, net in network.sample().items():
+                values['net_rx:' + name] = net.rx_bytes
+                values['net_tx:' + name] = net.tx_bytes
+            return values
+
+        return [collect_cpu, collect_load, collect_mem, collect_disk,
+                collect_disk_io, collect_network]
+
+
+def process_stats(pids=None, fds=True, io=True, proc='/proc'):
+    """Return resource usage of processes, from one pass over /proc.
+
+    RSS, CPU time, state, parent, and thread count all come from
+    /proc/<pid>/stat, so each process costs a single read.  Counting open
+    files and reading I/O bytes are extra system calls per process, and can
+    be skipped when not needed.  Processes that exit during the scan are
+    left out.
+
+    Arguments:
+    pids  -- Iterable of process IDs to read.  Default is all processes.
+    fds   -- Count open file descriptors in /proc/<pid>/fd.
+    io    -- Read storage I/O bytes from /proc/<pid>/io.
+    proc  -- Path where proc filesystem is mounted.
+
+    Return: Dictionary of {pid: ProcessStats}.  Empty if proc is not
+    available.
+
+    """
+    if pids is None:
+        try:
+            pids = [int(entry.name) for entry in os.scandir(proc)
+                    if entry.name.isdigit()]
+        except OSError:
+            return {}
+    page_size = os.sysconf('SC_PAGE_SIZE')
+    clk_tck = float(os.sysconf('SC_CLK_TCK'))
+    stats = {}
+    for pid in pids:
+        base = '%s/%d/' % (proc, pid)
+        data = _read_proc_file(base + 'stat')
+        if not data:
+            continue
+        # The command name is in parentheses and may contain any character,
+        # so fields are found from the last closing parenthesis.
+        close = data.rfind(b')')
+        name = data[data.find(b'(') + 1:close].decode('utf-8', 'replace')
+        f = data[close + 2:].split()
+        fd_count = read_bytes = write_bytes = None
+        if fds:
+            try:
+                fd_count = len(os.listdir(base + 'fd'))
+            except OSError:
+                pass
+        if io:
+            io_data = _read_proc_file(base + 'io')
+            if io_data:
+                # read_bytes and write_bytes are the 5th and 6th lines.
+                io_fields = io_data.split()
+                read_bytes = int(io_fields[9])
+                write_bytes = int(io_fields[11])
+        stats[pid] = ProcessStats(
+            pid, name, f[0].decode(), int(f[1]), int(f[17]),
+            int(f[21]) * page_size, (int(f[11]) + int(f[12])) / clk_tck,
+            fd_count, read_bytes, write_bytes)
+    return stats
+
+
+def top_processes(metric='rss', count=10, stats=None, proc='/proc'):
+    """Return the processes using the most of a resource.
+
+    Arguments:
+    metric -- One of PROCESS_METRICS.  io_bytes is read_bytes plus
+              write_bytes.
+    count  -- Number of processes to return.
+    stats  -- Dictionary from process_stats() to rank.  Default is to scan
+              all processes, reading only what metric needs.
+    proc   -- Path where proc filesystem is mounted.
+
+    Return: List of ProcessStats, largest first.  Processes where metric is
+    not readable are left out.
+
+    """
+    if metric not in PROCESS_METRICS:
+        raise ValueError('unknown process metric: %s' % (metric,))
+    if stats is None:
+        stats = process_stats(fds=(metric == 'fds'),
+                              io=metric in ('read_bytes', 'write_bytes',
+                                            'io_bytes'),
+                              proc=proc)
+    if metric == 'io_bytes':
+        procs = [p for p in stats.values() if p.read_bytes is not None]
+        return heapq.nlargest(count, procs,
+                              key=lambda p: p.read_bytes + p.write_bytes)
+    idx = ProcessStats._fields.index(metric)
+    procs = [p for p in stats.values() if p[idx] is not None]
+    return heapq.nlargest(count, procs, key=lambda p: p[idx])
+
+
+def _read_proc_file(path):
+    """Return contents of small proc file, or None if it cannot be read.
+
+    Uses a single os.read, without the buffering of a file object.
+
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return None
+    try:
+        return os.read(fd, 4096)
+    except OSError:
+        return None
+    finally:
+        os.close(fd)
+
+
+def _cpu_order(name):
+    """Sort key that puts 'cpu' first, followed by 'cpuN' in number order."""
+    return int(name[3:] or -1)
+
+
+def _unescape_mount(field):
+    """Decode octal escapes, such as \\040 for space, in a mounts field."""
+    if '\\' not in field:
+        return field
+    return re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)), field)
+
+
+def _capacity(used, avail):
+    """Return percent of space used, rounded up, as df shows capacity."""
+    total = used + avail
+    if not total:
+        return 0
+    return -(-used * 100 // total)
+
+
+def benchmark(count=100):
+    """Measure the time to get uptime, load, disk usage, and process stats.
+
+    Uptime, load, and disk usage are measured by reading /proc, where
+    available, and by running the uptime and df commands.  Cached values are
+    not used.
+
+    Arguments:
+    count -- Number of calls to time for each measurement.
+
+    Return: List of (name, seconds per call) tuples.
+
+    """
+    ss = SystemStats()
+    funcs = [('uptime command', ss._cmd_uptime_load),
+             ('df command', ss._df_disks)]
+    if platform.system() == 'Linux':
+        funcs.insert(0, ('/proc/uptime, /proc/loadavg', ss._proc_uptime_load))
+        funcs.insert(2, ('/proc/self/mounts, statvfs', ss._proc_disks))
+        funcs.append(('process_stats', process_stats))
+        funcs.append(('process_stats, stat only',
+                      lambda: process_stats(fds=False, io=False)))
+    results = []
+    for name, func in funcs:
+        start = time.time()
+        for _ in range(count):
+            func()
+        results.append((name, (time.time() - start) / count))
+    return results
 
 
 def size_str(byte_size):
@@ -413,11 +1297,38 @@ def size_str(byte_size):
 
 if __name__ == '__main__':
     import argparse
+    import sys
     ap = argparse.ArgumentParser(description='Show system information')
     ap.add_argument('--verbose', '-v', action='store_true',
                     help='Show verbose output.')
+    ap.add_argument('--benchmark', action='store_true',
+                    help='Measure time to get stats, with and without '
+                    'running commands, and exit.')
+    ap.add_argument('--top', metavar='METRIC', choices=PROCESS_METRICS,
+                    help='Show the processes using the most of METRIC, one '
+                    'of: %s, and exit.' % ', '.join(PROCESS_METRICS))
+    ap.add_argument('--count', '-n', type=int, default=10,
+                    help='Number of processes shown by --top.')
     args = ap.parse_args()
 
+    if args.top:
+        print('%7s %7s %10s %10s %5s %7s %10s %10s  %s' % (
+            'PID', 'PPID', 'RSS', 'CPU', 'FDS', 'THREADS', 'READ', 'WRITE',
+            'NAME'))
+        for p in top_processes(args.top, args.count):
+            print('%7d %7d %10s %10.2f %5s %7d %10s %10s  %s' % (
+                p.pid, p.ppid, size_str(p.rss), p.cpu_time,
+                '-' if p.fds is None else p.fds, p.threads,
+                '-' if p.read_bytes is None else size_str(p.read_bytes),
+                '-' if p.write_bytes is None else size_str(p.write_bytes),
+                p.name))
+        sys.exit(0)
+
+    if args.benchmark:
+        for name, secs in benchmark():
+            print('%-30s %10.1f us/call' % (name, secs * 1000000))
+        sys.exit(0)
+
     # This module can be run alone to output stats info for the local system.
     if args.verbose:
         print(SystemStats(True, True))
@@ -0,0 +1,997 @@
+"""
+Unit tests for linksame utility.
+
+Test with py.test
+
+"""
+from __future__ import print_function
+
+import errno
+import os
+import pytest
+
+# Uncomment to import from repo instead of site-packages.
+import sys
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, parentdir)
+
+from systemtools import linksame
+
+
+def _write(path, data):
+    d = os.path.dirname(path)
+    if not os.path.isdir(d):
+        os.makedirs(d)
+    with open(path, 'wb') as f:
+        f.write(data)
+    return path
+
+
+@pytest.fixture
+def tree(tmpdir):
+    """Create a directory tree containing some identical files."""
+    root = str(tmpdir)
+    _write(os.path.join(root, 'a', 'one.txt'), b'same data' * 1000)
+    _write(os.path.join(root, 'b', 'one_copy.txt'), b'same data' * 1000)
+    _write(os.path.join(root, 'b', 'c', 'one.txt'), b'same data' * 1000)
+    _write(os.path.join(root, 'a', 'two.txt'), b'other data' * 100)
+    _write(os.path.join(root, 'b', 'two.txt'), b'other data' * 100)
+    # Same size as two.txt, but different content.
+    _write(os.path.join(root, 'c', 'notwo.txt'), b'OTHER DATA' * 100)
+    _write(os.path.join(root, 'c', 'unique.txt'), b'unique')
+    _write(os.path.join(root, 'c', 'empty.txt'), b'')
+    return root
+
+
+def _inode(path):
+    return os.stat(path).st_ino
+
+
+class TestLinkSameFiles(object):
+
+    def test_dry_run(self, tree):
+        before = sorted((p, _inode(p)) for p in _walk(tree))
+        err = linksame.link_same_files([tree], quiet=True)
+        assert err is None
+        after = sorted((p, _inode(p)) for p in _walk(tree))
+        assert before == after
+
+    def test_hardlink(self, tree):
+        err = linksame.link_same_files([tree], link=True, quiet=True)
+        assert err is None
+        a1 = os.path.join(tree, 'a', 'one.txt')
+        b1 = os.path.join(tree, 'b', 'one_copy.txt')
+        c1 = os.path.join(tree, 'b', 'c', 'one.txt')
+        assert _inode(a1) == _inode(b1) == _inode(c1)
+        assert (_inode(os.path.join(tree, 'a', 'two.txt')) ==
+                _inode(os.path.join(tree, 'b', 'two.txt')))
+        assert (_inode(os.path.join(tree, 'c', 'notwo.txt')) !=
+                _inode(os.path.join(tree, 'b', 'two.txt')))
+        with open(a1, 'rb') as f:
+            assert f.read() == b'same data' * 1000
+
+    def test_symlink(self, tree):
+        err = linksame.link_same_files([tree], link=True, symlink=True,
+                                       quiet=True)
+        assert err is None
+        # Longest basename is kept as the real file.
+        base = os.path.join(tree, 'b', 'one_copy.txt')
+        assert not os.path.islink(base)
+        for p in (os.path.join(tree, 'a', 'one.txt'),
+                  os.path.join(tree, 'b', 'c', 'one.txt')):
+            assert os.path.islink(p)
+            assert not os.path.isabs(os.readlink(p))
+            assert os.path.samefile(p, base)
+
+    def test_report(self, tree):
+        import io
+        import json
+        out = io.StringIO()
+        stats = linksame.LinkStats()
+        err = linksame.link_same_files([tree], link=True, quiet=True,
+                                       report=out, stats=stats)
+        assert err is None
+        records = [json.loads(l) for l in out.getvalue().splitlines()]
+        groups = [r for r in records if r['type'] == 'group']
+        assert records[-1]['type'] == 'summary'
+        assert len(groups) == 2 == stats.group_count
+        assert stats.link_count == 3 == records[-1]['link_count']
+        one = [g for g in groups if len(g['files']) == 3][0]
+        assert one['base'] == os.path.join(tree, 'b', 'one_copy.txt')
+        assert one['size'] == 9000
+        assert not one['dry_run']
+        assert one['actions'] == {
+            os.path.join(tree, 'a', 'one.txt'): 'hardlink',
+            os.path.join(tree, 'b', 'c', 'one.txt'): 'hardlink',
+            os.path.join(tree, 'b', 'one_copy.txt'): 'base'}
+        assert stats.as_dict()['size_saved'] == 2 * 9000 + 1000
+
+    @pytest.mark.parametrize('max_files', [None, 2])
+    def test_progress(self, tree, max_files):
+        calls = []
+
+        def progress(p):
+            calls.append((p.phase, p.files_walked, p.bytes_remaining))
+
+        stats = linksame.LinkStats()
+        err = linksame.link_same_files([tree], link=True, quiet=True,
+                                       stats=stats, progress=progress,
+                                       max_files=max_files)
+        assert err is None
+        assert calls[0][0] == 'hash'
+        assert calls[-1] == ('done', 7, 0)
+
+    def test_progress_counts(self, tree):
+        done = []
+        stats = linksame.LinkStats()
+        linksame.link_same_files([tree], link=True, quiet=True, stats=stats,
+                                 progress=done.append)
+        p = done[-1]
+        assert p.phase == 'done'
+        assert p.candidate_bytes == stats.candidate_bytes
+        assert p.bytes_hashed == stats.bytes_read
+        assert p.groups_done == p.group_count == 2
+        assert p.link_count == 3
+        assert p.hash_rate() > 0
+
+    def test_link_fails(self, tree, monkeypatch):
+        def fail(src, dst):
+            raise OSError(errno.EPERM, 'not permitted')
+
+        monkeypatch.setattr(os, 'link', fail)
+        monkeypatch.setattr(os, 'symlink', fail)
+        before = sorted((p, _inode(p)) for p in _walk(tree))
+        stats = linksame.LinkStats()
+        err = linksame.link_same_files([tree], link=True, quiet=True,
+                                       stats=stats)
+        assert err is None
+        assert stats.link_count == 0
+        # Files are unchanged, and no temporary files are left.
+        assert sorted((p, _inode(p)) for p in _walk(tree)) == before
+
+    def test_removed_before_verify(self, tree, monkeypatch, capsys):
+        # A file removed between hashing and comparing is skipped.
+        gone = os.path.join(tree, 'b', 'c', 'one.txt')
+        create_hash_map = linksame._create_hash_map
+
+        def hash_then_remove(*args, **kwargs):
+            result = create_hash_map(*args, **kwargs)
+            if os.path.exists(gone):
+                os.unlink(gone)
+            return result
+
+        monkeypatch.setattr(linksame, '_create_hash_map', hash_then_remove)
+        stats = linksame.LinkStats()
+        err = linksame.link_same_files([tree], link=True, verify=True,
+                                       jobs=1, stats=stats)
+        assert err is None
+        assert stats.link_count == 2
+        assert (_inode(os.path.join(tree, 'a', 'one.txt')) ==
+                _inode(os.path.join(tree, 'b', 'one_copy.txt')))
+        assert 'cannot read %s' % (gone,) in capsys.readouterr()[1]
+
+    def test_split_identical_removed(self, tmpdir, capsys):
+        files = [linksame._file_info(_write(
+            os.path.join(str(tmpdir), name), b'data')) for name in 'abc']
+        os.unlink(files[0].path)
+        groups = linksame._split_identical(files)
+        assert [[i.path for i in g] for g in groups] == [
+            [files[1].path, files[2].path]]
+        assert linksame._split_identical(files, True)
+        assert capsys.readouterr()[1].count('cannot read') == 1
+
+    def test_base_removed(self, tmpdir, capsys):
+        # A real copy is never replaced by a link to a missing base file.
+        a = _write(os.path.join(str(tmpdir), 'a'), b'data')
+        base = _write(os.path.join(str(tmpdir), 'longer_name'), b'data')
+        files = [linksame._file_info(a), linksame._file_info(base)]
+        os.unlink(base)
+        actions = {}
+        assert linksame._link_files(files, True, False, False, False,
+                                    actions=actions) == (0, 0)
+        assert actions[a] == 'failed'
+        assert not os.path.islink(a)
+        assert 'failed to create hardlink' in capsys.readouterr()[1]
+
+    def test_base_changed_symlink(self, tmpdir, monkeypatch, capsys):
+        def cross_device(src, dst):
+            raise OSError(errno.EXDEV, 'cross-device link')
+
+        a = _write(os.path.join(str(tmpdir), 'a'), b'data')
+        base = _write(os.path.join(str(tmpdir), 'longer_name'), b'data')
+        files = [linksame._file_info(a), linksame._file_info(base)]
+        os.replace(_write(base + '.new', b'DATA'), base)
+        monkeypatch.setattr(os, 'link', cross_device)
+        actions = {}
+        assert linksame._link_files(files, True, False, False, False,
+                                    actions=actions) == (0, 0)
+        assert actions[a] == 'failed'
+        assert not os.path.islink(a)
+        assert 'changed or removed' in capsys.readouterr()[1]
+
+    def test_file_removed(self, tree, monkeypatch, capsys):
+        # A file removed after the walk is skipped, and the others linked.
+        gone = os.path.join(tree, 'b', 'c', 'one.txt')
+        walk_files = linksame._walk_files
+
+        def walk_then_remove(*args):
+            infos = list(walk_files(*args))
+            os.unlink(gone)
+            return iter(infos)
+
+        monkeypatch.setattr(linksame, '_walk_files', walk_then_remove)
+        stats = linksame.LinkStats()
+        err = linksame.link_same_files([tree], link=True, stats=stats)
+        assert err is None
+        assert stats.link_count == 2
+        assert (_inode(os.path.join(tree, 'a', 'one.txt')) ==
+                _inode(os.path.join(tree, 'b', 'one_copy.txt')))
+        assert 'cannot read %s' % (gone,) in capsys.readouterr()[1]
+
+    def test_replace_with_link(self, tree):
+        a1 = os.path.join(tree, 'a', 'one.txt')
+        b1 = os.path.join(tree, 'b', 'one_copy.txt')
+        linksame._replace_with_link(lambda tmp: os.link(b1, tmp), a1)
+        assert _inode(a1) == _inode(b1)
+        assert sorted(os.listdir(os.path.join(tree, 'a'))) == [
+            'one.txt', 'two.txt']
+
+    def test_reflink(self, tree):
+        a1 = os.path.join(tree, 'a', 'one.txt')
+        b1 = os.path.join(tree, 'b', 'one_copy.txt')
+        before = _inode(a1)
+        err = linksame.link_same_files([tree], link=True, reflink=True,
+                                       quiet=True)
+        assert err is None
+        # Whether or not the filesystem supports reflinks, the files remain
+        # separate, unchanged files.
+        assert _inode(a1) == before
+        assert _inode(a1) != _inode(b1)
+        assert not os.path.islink(a1)
+        with open(a1, 'rb') as f:
+            assert f.read() == b'same data' * 1000
+
+    def test_checkpoint(self, tree, monkeypatch):
+        checkpoint = tree + '.checkpoint'
+        link_hash_map = linksame._link_hash_map
+        calls = []
+
+        def interrupted(*args):
+            calls.append(args[0])
+            if len(calls) > 1:
+                raise RuntimeError("interrupted")
+            return link_hash_map(*args)
+
+        monkeypatch.setattr(linksame, '_link_hash_map', interrupted)
+        with pytest.raises(RuntimeError):
+            linksame.link_same_files([tree], link=True, quiet=True, jobs=1,
+                                     checkpoint=checkpoint)
+        assert os.path.isfile(checkpoint)
+        a1 = os.path.join(tree, 'a', 'one.txt')
+        b1 = os.path.join(tree, 'b', 'one_copy.txt')
+        a2 = os.path.join(tree, 'a', 'two.txt')
+        b2 = os.path.join(tree, 'b', 'two.txt')
+        assert _inode(a1) == _inode(b1)
+        assert _inode(a2) != _inode(b2)
+
+        monkeypatch.setattr(linksame, '_link_hash_map', link_hash_map)
+        assert linksame.link_same_files([os.path.dirname(tree)], quiet=True,
+                                        checkpoint=checkpoint, resume=True)
+        stats = linksame.LinkStats()
+        err = linksame.link_same_files([tree], link=True, quiet=True,
+                                       checkpoint=checkpoint, resume=True,
+                                       stats=stats)
+        assert err is None
+        assert _inode(a2) == _inode(b2)
+        assert stats.link_count == 3
+        assert stats.group_count == 2
+        assert not os.path.exists(checkpoint)
+
+    def test_resume_walk(self, tree, monkeypatch):
+        checkpoint = tree + '.checkpoint'
+        scan_dir = linksame._scan_dir
+        scanned = []
+
+        def interrupted(dirpath, *args):
+            if len(scanned) == 2:
+                raise RuntimeError("interrupted")
+            scanned.append(dirpath)
+            return scan_dir(dirpath, *args)
+
+        monkeypatch.setattr(linksame._Checkpoint, 'BATCH_SIZE', 1)
+        monkeypatch.setattr(linksame, '_scan_dir', interrupted)
+        with pytest.raises(RuntimeError):
+            linksame.link_same_files([tree], link=True, quiet=True,
+                                     checkpoint=checkpoint)
+        first = list(scanned)
+        del scanned[:]
+
+        def counted(dirpath, *args):
+            scanned.append(dirpath)
+            return scan_dir(dirpath, *args)
+
+        monkeypatch.setattr(linksame, '_scan_dir', counted)
+        stats = linksame.LinkStats()
+        err = linksame.link_same_files([tree], link=True, quiet=True,
+                                       checkpoint=checkpoint, resume=True,
+                                       stats=stats)
+        assert err is None
+        # Directories walked before the interruption are not walked again.
+        assert not set(first) & set(scanned)
+        assert len(first) + len(scanned) == 5
+        assert stats.link_count == 3
+        assert (_inode(os.path.join(tree, 'a', 'one.txt')) ==
+                _inode(os.path.join(tree, 'b', 'c', 'one.txt')))
+
+    def test_resume_nothing_saved(self, tree):
+        checkpoint = tree + '.checkpoint'
+        for _ in range(2):
+            stats = linksame.LinkStats()
+            err = linksame.link_same_files([tree], link=True, quiet=True,
+                                           checkpoint=checkpoint, resume=True,
+                                           stats=stats)
+            assert err is None
+            assert not os.path.exists(checkpoint)
+        assert (_inode(os.path.join(tree, 'a', 'two.txt')) ==
+                _inode(os.path.join(tree, 'b', 'two.txt')))
+
+    def test_resume_files_changed(self, tree, monkeypatch):
+        checkpoint = tree + '.checkpoint'
+        link_hash_map = linksame._link_hash_map
+        calls = []
+
+        def interrupted(*args):
+            calls.append(args[0])
+            if len(calls) > 1:
+                raise RuntimeError("interrupted")
+            return link_hash_map(*args)
+
+        monkeypatch.setattr(linksame, '_link_hash_map', interrupted)
+        with pytest.raises(RuntimeError):
+            linksame.link_same_files([tree], link=True, quiet=True, jobs=1,
+                                     checkpoint=checkpoint)
+        monkeypatch.setattr(linksame, '_link_hash_map', link_hash_map)
+
+        # Remove one file, and replace another, in the group not yet done.
+        a2 = os.path.join(tree, 'a', 'two.txt')
+        b2 = os.path.join(tree, 'b', 'two.txt')
+        os.unlink(os.path.join(tree, 'c', 'notwo.txt'))
+        os.replace(_write(b2 + '.new', b'other data' * 100), b2)
+        stats = linksame.LinkStats()
+        err = linksame.link_same_files([tree], link=True, quiet=True,
+                                       checkpoint=checkpoint, resume=True,
+                                       stats=stats)
+        assert err is None
+        assert not os.path.exists(checkpoint)
+        # The replaced file is not linked using its old information.
+        assert _inode(a2) != _inode(b2)
+        assert stats.link_count == 2
+
+    @pytest.mark.parametrize('max_files', [1, 3, 1000])
+    def test_max_files(self, tree, monkeypatch, max_files):
+        monkeypatch.setattr(linksame, 'MERGE_WIDTH', 2)
+        stats = linksame.LinkStats()
+        err = linksame.link_same_files([tree], link=True, quiet=True,
+                                       max_files=max_files, stats=stats)
+        assert err is None
+        assert stats.link_count == 3
+        assert (_inode(os.path.join(tree, 'a', 'one.txt')) ==
+                _inode(os.path.join(tree, 'b', 'c', 'one.txt')))
+        assert (_inode(os.path.join(tree, 'a', 'two.txt')) ==
+                _inode(os.path.join(tree, 'b', 'two.txt')))
+
+    def test_spill_dir(self, tree, tmpdir, monkeypatch):
+        spill = tmpdir.mkdir('spill')
+        write_runs = linksame._write_runs
+        dirs = []
+
+        def record_dir(infos, max_files, tmp):
+            dirs.append(tmp)
+            return write_runs(infos, max_files, tmp)
+
+        monkeypatch.setattr(linksame, '_write_runs', record_dir)
+        stats = linksame.LinkStats()
+        err = linksame.link_same_files([os.path.join(tree, 'a'),
+                                        os.path.join(tree, 'b')],
+                                       quiet=True, max_files=2, stats=stats,
+                                       spill_dir=str(spill))
+        assert err is None
+        assert os.path.dirname(dirs[0]) == str(spill)
+        # The runs are removed when done.
+        assert spill.listdir() == []
+        assert linksame.link_same_files([tree], quiet=True, max_files=2,
+                                        spill_dir=str(tmpdir.join('none')))
+
+    def test_bad_max_files(self, tree):
+        assert linksame.link_same_files([tree], quiet=True, max_files=0)
+
+    def test_resume_without_checkpoint(self, tree):
+        assert linksame.link_same_files([tree], quiet=True, resume=True)
+
+    def test_reflink_symlink(self, tree):
+        assert linksame.link_same_files([tree], quiet=True, reflink=True,
+                                        symlink=True)
+
+    @pytest.mark.parametrize('jobs', [1, 2, 16])
+    def test_jobs(self, tree, jobs):
+        err = linksame.link_same_files([tree], link=True, quiet=True,
+                                       jobs=jobs)
+        assert err is None
+        assert (_inode(os.path.join(tree, 'a', 'one.txt')) ==
+                _inode(os.path.join(tree, 'b', 'one_copy.txt')))
+
+    def test_bad_jobs(self, tree):
+        assert linksame.link_same_files([tree], quiet=True, jobs=-1)
+
+    def test_not_dir(self, tree):
+        err = linksame.link_same_files([os.path.join(tree, 'nothere')],
+                                       quiet=True)
+        assert err
+
+    def test_output(self, tree, capsys):
+        linksame.link_same_files([tree])
+        out = capsys.readouterr()[0]
+        assert 'Replaced 3 files with links' in out
+        assert 'files/s' in out and 'MB/s' in out
+
+
+class TestLinkSameUpdate(object):
+
+    def test_update(self, tree):
+        upd = os.path.join(tree, 'a', 'two.txt')
+        err = linksame.link_same_update(upd, [tree], link=True, quiet=True)
+        assert err is None
+        assert _inode(upd) == _inode(os.path.join(tree, 'b', 'two.txt'))
+        # Files not identical to update file are left alone.
+        assert (_inode(os.path.join(tree, 'a', 'one.txt')) !=
+                _inode(os.path.join(tree, 'b', 'one_copy.txt')))
+
+    def test_update_hardlinks(self, tree, capsys):
+        upd = os.path.join(tree, 'a', 'two.txt')
+        os.link(os.path.join(tree, 'c', 'notwo.txt'),
+                os.path.join(tree, 'c', 'notwo2.txt'))
+        os.link(os.path.join(tree, 'b', 'two.txt'),
+                os.path.join(tree, 'b', 'two2.txt'))
+        err = linksame.link_same_update(upd, [tree], link=True)
+        assert err is None
+        assert (_inode(upd) == _inode(os.path.join(tree, 'b', 'two2.txt')) ==
+                _inode(os.path.join(tree, 'b', 'two.txt')))
+        out = capsys.readouterr()[0]
+        assert 'Avoided 2 hash operations' in out
+
+    def test_updates(self, tree):
+        upd1 = os.path.join(tree, 'a', 'two.txt')
+        upd2 = os.path.join(tree, 'a', 'one.txt')
+        err = linksame.link_same_updates([upd1, upd2], [tree], link=True,
+                                         quiet=True)
+        assert err is None
+        assert _inode(upd1) == _inode(os.path.join(tree, 'b', 'two.txt'))
+        assert (_inode(upd2) == _inode(os.path.join(tree, 'b', 'c', 'one.txt'))
+                == _inode(os.path.join(tree, 'b', 'one_copy.txt')))
+        assert _inode(os.path.join(tree, 'c', 'notwo.txt')) != _inode(upd1)
+
+    def test_updates_only_required(self, tree):
+        # Files that are identical to each other, but not to the update file,
+        # are not linked.
+        other = os.path.join(tree, 'c', 'other.txt')
+        _write(other, b'OTHER DATA' * 100)
+        upd = os.path.join(tree, 'a', 'two.txt')
+        err = linksame.link_same_updates([upd], [tree], link=True, quiet=True)
+        assert err is None
+        assert _inode(other) != _inode(os.path.join(tree, 'c', 'notwo.txt'))
+
+    def test_updates_stdin(self, tree, monkeypatch):
+        import io
+        upd = os.path.join(tree, 'a', 'two.txt')
+        monkeypatch.setattr(sys, 'stdin', io.StringIO(upd + '\n\n'))
+        monkeypatch.setattr(sys, 'argv', ['linksame', '-w', '-q',
+                                          '--update-list', '-', tree])
+        assert linksame.main() == 0
+        assert _inode(upd) == _inode(os.path.join(tree, 'b', 'two.txt'))
+
+    def test_update_list_missing(self, tree, monkeypatch, capsys):
+        missing = os.path.join(tree, 'nothere.txt')
+        monkeypatch.setattr(sys, 'argv', ['linksame', '-q', '--update-list',
+                                          missing, tree])
+        assert linksame.main() == 1
+        assert 'cannot read update list' in capsys.readouterr()[1]
+
+    def test_report_bad_path(self, tree, monkeypatch, capsys):
+        report = os.path.join(tree, 'nothere', 'report.jsonl')
+        monkeypatch.setattr(sys, 'argv', ['linksame', '-q', '--report',
+                                          report, tree])
+        assert linksame.main() == 1
+        assert 'cannot write report' in capsys.readouterr()[1]
+
+    @pytest.mark.parametrize('opts', [
+        ['--update', 'x', '--checkpoint', 'cp'],
+        ['--update-list', 'x', '--resume'],
+        ['--update', 'x', '--max-files', '10'],
+        ['--watch', '--update', 'x'],
+        ['--watch', '--jobs', '2'],
+        ['--watch', '--device-jobs', '/=1'],
+        ['--watch', '--progress'],
+        ['--watch', '--checkpoint', 'cp'],
+        ['--update', 'x', '--spill-dir', '.'],
+        ['--checkpoint', 'cp', '--spill-dir', '.']])
+    def test_incompatible_options(self, tree, monkeypatch, capsys, opts):
+        monkeypatch.setattr(sys, 'argv', ['linksame', '-q'] + opts + [tree])
+        assert linksame.main() == 1
+        assert 'cannot use' in capsys.readouterr()[1]
+
+    def test_update_empty(self, tree):
+        err = linksame.link_same_update(
+            os.path.join(tree, 'c', 'empty.txt'), [tree], quiet=True)
+        assert err
+
+
+def _watcher(tree, link=True, verify=False):
+    try:
+        w = linksame._Watcher(
+            [tree], None, linksame.HashCache(':memory:'), linksame.DEFAULT_HASH,
+            linksame.BLOCKSIZE, (verify, link, False, False, False, False,
+                                 None), linksame.LinkStats())
+    except OSError:
+        pytest.skip('inotify not available')
+    w.scan()
+    return w
+
+
+def _poll_until(w, cond):
+    for _ in range(20):
+        w.poll(0.1)
+        if cond():
+            return True
+    return False
+
+
+class TestWatchSameFiles(object):
+
+    def test_new_file(self, tree):
+        w = _watcher(tree)
+        try:
+            assert w.dir_count() == 5
+            a1 = os.path.join(tree, 'a', 'one.txt')
+            new = _write(os.path.join(tree, 'd', 'e', 'new.txt'),
+                         b'same data' * 1000)
+            assert _poll_until(w, lambda: _inode(new) == _inode(a1) or
+                               _inode(new) == _inode(os.path.join(
+                                   tree, 'b', 'one_copy.txt')))
+            assert w.dir_count() == 7
+            # A second copy in a watched directory is linked too.
+            other = _write(os.path.join(tree, 'c', 'other.txt'),
+                           b'other data' * 100)
+            two = os.path.join(tree, 'a', 'two.txt')
+            assert _poll_until(w, lambda: _inode(other) == _inode(two))
+            # A same-size file with different data is not linked.
+            assert (_inode(os.path.join(tree, 'c', 'notwo.txt')) !=
+                    _inode(two))
+        finally:
+            w.close()
+
+    def test_modified_and_removed(self, tree):
+        w = _watcher(tree)
+        try:
+            notwo = os.path.join(tree, 'c', 'notwo.txt')
+            os.unlink(os.path.join(tree, 'b', 'two.txt'))
+            _write(notwo, b'other data' * 100)
+            two = os.path.join(tree, 'a', 'two.txt')
+            assert _poll_until(w, lambda: _inode(notwo) == _inode(two))
+            assert w._stats.link_count == 1
+        finally:
+            w.close()
+
+    def test_file_removed(self, tree, monkeypatch):
+        w = _watcher(tree, verify=True)
+        split_identical = linksame._split_identical
+
+        def removed(files, quiet=False):
+            raise OSError(errno.ENOENT, 'No such file or directory')
+
+        monkeypatch.setattr(linksame, '_split_identical', removed)
+        new = _write(os.path.join(tree, 'c', 'new.txt'), b'same data' * 1000)
+        try:
+            # The error is ignored, and the watcher keeps running.
+            w._check_file(new)
+            monkeypatch.setattr(linksame, '_split_identical', split_identical)
+            new2 = _write(os.path.join(tree, 'c', 'new2.txt'),
+                          b'other data' * 100)
+            w._check_file(new2)
+        finally:
+            w.close()
+        assert _inode(new2) == _inode(os.path.join(tree, 'a', 'two.txt'))
+
+    def test_overflow(self, tree, monkeypatch):
+        w = _watcher(tree)
+        try:
+            # Files written while events are lost are still linked.
+            new = _write(os.path.join(tree, 'c', 'new.txt'),
+                         b'other data' * 100)
+            monkeypatch.setattr(w._inotify, 'read_events', lambda timeout: [
+                (-1, linksame._Inotify.IN_Q_OVERFLOW, '')])
+            w.poll(0)
+        finally:
+            w.close()
+        assert _inode(new) == _inode(os.path.join(tree, 'a', 'two.txt'))
+        # The existing copy in the same group is linked too.
+        assert w._stats.link_count == 2
+        assert w.dir_count() == 5
+
+    def test_watch_limit(self, tree, monkeypatch, capsys):
+        w = _watcher(tree)
+        add_watch = w._inotify.add_watch
+
+        def limited(path):
+            if path != tree:
+                raise OSError(errno.ENOSPC, 'No space left on device', path)
+            return add_watch(path)
+
+        monkeypatch.setattr(w._inotify, 'add_watch', limited)
+        try:
+            w.scan()
+        finally:
+            w.close()
+        assert w.dir_count() == 1
+        # Files in unwatched directories are still indexed.
+        assert len(w._paths) == 7
+        err = capsys.readouterr()[1]
+        assert err.count('fs.inotify.max_user_watches') == 1
+
+    def test_cache_forgets_removed(self, tree):
+        w = _watcher(tree)
+        cache = w._hash_cache
+        count = lambda: cache._db.execute(
+            'SELECT COUNT(*) FROM hashes').fetchone()[0]
+        try:
+            new = _write(os.path.join(tree, 'c', 'new.txt'),
+                         b'other data' * 100)
+            w._check_file(new)
+            # The copies replaced by links are gone, so only the hashes of
+            # the base file and of notwo.txt are kept.
+            assert count() == 2
+            w._check_file(new)
+            assert count() == 2
+            notwo = os.path.join(tree, 'c', 'notwo.txt')
+            for path in (new, notwo, os.path.join(tree, 'a', 'two.txt'),
+                         os.path.join(tree, 'b', 'two.txt')):
+                os.unlink(path)
+                w._remove(path)
+            assert count() == 0
+        finally:
+            w.close()
+
+    def test_cache_prune(self, tmpdir, monkeypatch):
+        import time
+        cache = linksame.HashCache(':memory:', max_age=10)
+        path = _write(os.path.join(str(tmpdir), 'f'), b'x')
+        cache.put(os.stat(path), 'digest', 'abc')
+        later = time.time() + 60
+        monkeypatch.setattr(time, 'time', lambda: later)
+        cache.prune()
+        assert cache.get(os.stat(path)) is None
+        cache.put(os.stat(path), 'digest', 'abc')
+        cache.prune()
+        assert cache.get(os.stat(path)) == 'abc'
+        cache.close()
+
+    def test_stop(self, tree):
+        import threading
+        stop = threading.Event()
+        stop.set()
+        err = linksame.watch_same_files([tree], quiet=True, stop=stop)
+        if err and 'inotify' in err:
+            pytest.skip(err)
+        assert err is None
+
+
+class TestWalkFiles(object):
+
+    def test_walk(self, tree):
+        os.symlink(os.path.join(tree, 'a', 'one.txt'),
+                   os.path.join(tree, 'a', 'symlink.txt'))
+        os.symlink(os.path.join(tree, 'a'), os.path.join(tree, 'dirlink'))
+        infos = list(linksame._walk_files([tree]))
+        assert sorted(i.path for i in infos) == sorted(
+            p for p in _walk(tree)
+            if os.path.getsize(p) and not os.path.islink(p))
+        for info in infos:
+            st = os.stat(info.path)
+            assert (info.size, info.dev, info.ino, info.nlink) == (
+                st.st_size, st.st_dev, st.st_ino, st.st_nlink)
+
+    def test_pattern(self, tree):
+        infos = linksame._walk_files([tree], 'one*')
+        assert sorted(os.path.basename(i.path) for i in infos) == [
+            'one.txt', 'one.txt', 'one_copy.txt']
+
+    def test_shared_dir(self, tree):
+        infos = [i for i in linksame._walk_files([tree])
+                 if i.dir == os.path.join(tree, 'c')]
+        assert sorted(i.name for i in infos) == ['notwo.txt', 'unique.txt']
+        assert infos[0].dir is infos[1].dir
+        assert infos[0].path == os.path.join(tree, 'c', infos[0].name)
+
+    def test_memory_benchmark(self, tree):
+        count, full, compact = linksame.memory_benchmark([tree])
+        assert count == 7
+        assert full > 0 and compact > 0
+
+    def test_file_info(self, tree):
+        assert linksame._file_info(os.path.join(tree, 'a')) is None
+        info = linksame._file_info(os.path.join(tree, 'c', 'unique.txt'))
+        assert info.size == 6 and info.nlink == 1
+
+
+class TestSortedRuns(object):
+
+    def test_read_groups(self, tree, tmpdir, monkeypatch):
+        monkeypatch.setattr(linksame, 'MERGE_WIDTH', 2)
+        infos = list(linksame._walk_files([tree]))
+        runs = linksame._write_runs(iter(infos), 2, str(tmpdir))
+        assert len(runs) == 4
+        groups = list(linksame._read_groups(runs, str(tmpdir)))
+        sizes = [fsize for fsize, _ in groups]
+        assert sizes == sorted(set(info.size for info in infos))
+        read = [info for _, files in groups for info in files]
+        assert sorted(read) == sorted(infos)
+
+
+class TestCreateHashMap(object):
+
+    def _files(self, tmpdir, datas):
+        return [linksame._file_info(
+            _write(os.path.join(str(tmpdir), 'f%d' % i), d))
+                for i, d in enumerate(datas)]
+
+    def test_partial_eliminates(self, tmpdir):
+        size = linksame.PARTIAL_SIZE * 8
+        files = self._files(tmpdir, [b'a' * size, b'b' + b'a' * (size - 1),
+                                     b'a' * (size - 1) + b'c'])
+        hash_map, bytes_read, _ = linksame._create_hash_map(files, size)
+        assert all(len(v) == 1 for v in hash_map.values())
+        # Only the partial hashes were read.
+        assert bytes_read == 3 * 2 * linksame.PARTIAL_SIZE
+
+    def test_differ_in_middle(self, tmpdir):
+        size = linksame.PARTIAL_SIZE * 8
+        half = size // 2
+        files = self._files(tmpdir, [b'a' * size,
+                                     b'a' * half + b'b' + b'a' * (half - 1),
+                                     b'a' * size])
+        hash_map, bytes_read, _ = linksame._create_hash_map(files, size)
+        groups = sorted(sorted(i.path for i in v) for v in hash_map.values())
+        assert groups == [[files[0].path, files[2].path], [files[1].path]]
+        assert bytes_read == 3 * (2 * linksame.PARTIAL_SIZE + size)
+
+    def test_small_files(self, tmpdir):
+        files = self._files(tmpdir, [b'xyz', b'xyz', b'abc'])
+        hash_map, bytes_read, _ = linksame._create_hash_map(files, 3)
+        assert sorted(len(v) for v in hash_map.values()) == [1, 2]
+        assert bytes_read == 9
+
+    def test_hardlinks_read_once(self, tmpdir):
+        files = self._files(tmpdir, [b'xyz', b'xyz'])
+        hlink = os.path.join(str(tmpdir), 'hlink')
+        os.link(files[0].path, hlink)
+        files = [linksame._file_info(f.path) for f in files]
+        files.append(linksame._file_info(hlink))
+        hash_map, bytes_read, avoided = linksame._create_hash_map(files, 3)
+        assert [len(v) for v in hash_map.values()] == [3]
+        assert bytes_read == 6
+        assert avoided == 1
+
+    def test_all_hardlinks(self, tmpdir):
+        files = self._files(tmpdir, [b'xyz'])
+        for i in range(3):
+            hlink = os.path.join(str(tmpdir), 'hlink%d' % i)
+            os.link(files[0].path, hlink)
+            files.append(linksame._file_info(hlink))
+        hash_map, bytes_read, avoided = linksame._create_hash_map(files, 3)
+        assert hash_map == {}
+        assert bytes_read == 0
+        assert avoided == 3
+        # Skipping the group before hashing counts the same.
+        stats = linksame.LinkStats()
+        assert linksame._make_buckets([(3, files)], stats) == []
+        assert stats.hashes_avoided == 3
+
+
+class TestHashAlgo(object):
+
+    @pytest.mark.parametrize('algo', ['sha1', 'md5', 'sha256'])
+    def test_algo(self, tree, algo):
+        err = linksame.link_same_files([tree], link=True, quiet=True,
+                                       hash_algo=algo, block_size=1000)
+        assert err is None
+        assert (_inode(os.path.join(tree, 'a', 'one.txt')) ==
+                _inode(os.path.join(tree, 'b', 'one_copy.txt')))
+
+    def test_bad_args(self, tree):
+        assert linksame.link_same_files([tree], quiet=True,
+                                        hash_algo='nosuchhash')
+        assert linksame.link_same_files([tree], quiet=True, block_size=0)
+        assert linksame.link_same_update(os.path.join(tree, 'a', 'two.txt'),
+                                         [tree], quiet=True,
+                                         hash_algo='nosuchhash')
+
+    def test_verify(self, tree, monkeypatch):
+        # Make all files of the same size appear to have the same hash.
+        monkeypatch.setattr(linksame, '_hash_file', lambda *args: 'x')
+        monkeypatch.setattr(linksame, '_hash_partial', lambda *args: 'x')
+        err = linksame.link_same_files([tree], link=True, quiet=True,
+                                       verify=True)
+        assert err is None
+        assert (_inode(os.path.join(tree, 'a', 'two.txt')) ==
+                _inode(os.path.join(tree, 'b', 'two.txt')))
+        assert (_inode(os.path.join(tree, 'c', 'notwo.txt')) !=
+                _inode(os.path.join(tree, 'b', 'two.txt')))
+
+    def test_hash_file(self, tmpdir):
+        import hashlib
+        for size in (1, 999, 1000, 1001, 5000):
+            data = os.urandom(size)
+            path = _write(os.path.join(str(tmpdir), 'f%d' % size), data)
+            # Larger block size first, so a larger buffer gets reused.
+            for block_size in (4096, 1000, 7):
+                assert (linksame._hash_file(path, 'sha1', block_size) ==
+                        hashlib.sha1(data).hexdigest())
+
+    def test_cache_per_algo(self, tmpdir):
+        db = os.path.join(str(tmpdir), 'cache.db')
+        st = os.stat(_write(os.path.join(str(tmpdir), 'f'), b'data'))
+        with linksame.HashCache(db, 'sha1') as c:
+            c.put(st, 'digest', 'abc')
+        with linksame.HashCache(db, 'md5') as c:
+            assert c.get(st) is None
+        with linksame.HashCache(db, 'sha1') as c:
+            assert c.get(st) == 'abc'
+
+    def test_benchmark(self):
+        results = linksame.hash_benchmark(['sha1', 'md5'], [4096, 65536],
+                                          1024 * 1024)
+        assert [r[:2] for r in results] == [('sha1', 4096), ('sha1', 65536),
+                                            ('md5', 4096), ('md5', 65536)]
+        assert all(r[2] > 0 for r in results)
+
+
+class TestHashCache(object):
+
+    def test_get_put(self, tmpdir):
+        path = _write(os.path.join(str(tmpdir), 'f'), b'data')
+        st = os.stat(path)
+        with linksame.HashCache(os.path.join(str(tmpdir), 'cache.db')) as c:
+            assert c.get(st) is None
+            c.put(st, 'digest', 'abc')
+            c.put(st, 'partial', 'def')
+            assert c.get(st) == 'abc'
+            assert c.get(st, 'partial') == 'def'
+            assert c.hits == 2 and c.misses == 1
+
+    def test_persist_and_change(self, tmpdir):
+        db = os.path.join(str(tmpdir), 'cache.db')
+        path = _write(os.path.join(str(tmpdir), 'f'), b'data')
+        st = os.stat(path)
+        with linksame.HashCache(db) as c:
+            c.put(st, 'digest', 'abc')
+        with linksame.HashCache(db) as c:
+            assert c.get(st) == 'abc'
+            os.utime(path, (st.st_atime, st.st_mtime + 10))
+            assert c.get(os.stat(path)) is None
+
+    def test_prune(self, tmpdir):
+        db = os.path.join(str(tmpdir), 'cache.db')
+        paths = [_write(os.path.join(str(tmpdir), 'f%d' % i), b'x' * i)
+                 for i in range(1, 4)]
+        with linksame.HashCache(db, max_entries=2) as c:
+            for p in paths:
+                c.put(os.stat(p), 'digest', p)
+        with linksame.HashCache(db, max_age=-1) as c:
+            assert sum(c.get(os.stat(p)) is not None for p in paths) == 2
+        with linksame.HashCache(db) as c:
+            assert all(c.get(os.stat(p)) is None for p in paths)
+
+    def test_max_entries(self, tree, tmpdir):
+        import sqlite3
+        db = os.path.join(str(tmpdir), 'cache.db')
+        assert linksame.link_same_files([tree], quiet=True, cache=db,
+                                        cache_max_entries=2) is None
+        conn = sqlite3.connect(db)
+        assert conn.execute('SELECT COUNT(*) FROM hashes').fetchone()[0] == 2
+        conn.close()
+        assert linksame.link_same_files([tree], quiet=True, cache=db,
+                                        cache_max_entries=0)
+
+    def test_no_reread(self, tree, tmpdir, monkeypatch):
+        db = os.path.join(str(tmpdir), 'cache.db')
+        assert linksame.link_same_files([tree], quiet=True, cache=db) is None
+
+        def no_hash(*args):
+            raise AssertionError('file hashed')
+        monkeypatch.setattr(linksame, '_hash_file', no_hash)
+        monkeypatch.setattr(linksame, '_hash_partial', no_hash)
+        assert linksame.link_same_files([tree], link=True, quiet=True,
+                                        cache=db) is None
+        assert (_inode(os.path.join(tree, 'a', 'one.txt')) ==
+                _inode(os.path.join(tree, 'b', 'one_copy.txt')))
+
+
+class TestRunJobs(object):
+
+    def test_all_results(self):
+        items = list(range(50))
+        results = dict(linksame._run_jobs(lambda x: x * x, items, 4))
+        assert results == dict((x, x * x) for x in items)
+
+    def test_limits(self):
+        import threading
+        import time
+        lock = threading.Lock()
+        active = {'a': 0, 'b': 0}
+        peak = {'a': 0, 'b': 0}
+
+        def func(item):
+            with lock:
+                active[item] += 1
+                peak[item] = max(peak[item], active[item])
+            time.sleep(0.01)
+            with lock:
+                active[item] -= 1
+            return item
+
+        items = ['a', 'b'] * 10
+        results = list(linksame._run_jobs(func, items, 4, lambda i: (i,),
+                                          {'a': 1}))
+        assert len(results) == 20
+        assert peak['a'] == 1
+        assert peak['b'] > 1
+
+    def test_device_limits(self, tree):
+        dev = os.stat(tree).st_dev
+        infos = list(linksame._walk_files([tree]))
+        buckets = [(i.size, [i]) for i in infos]
+        limits = linksame._device_limits(buckets, 8)
+        assert limits[dev] in (linksame.HDD_JOBS, 8)
+        device_jobs, err = linksame._resolve_device_jobs({tree: 3})
+        assert err is None
+        assert linksame._device_limits(buckets, 8, device_jobs) == {dev: 3}
+        assert linksame._resolve_device_jobs({tree: 0})[1]
+        assert linksame.link_same_files([tree], quiet=True,
+                                        device_jobs={tree: 2}) is None
+
+    def test_exception(self):
+        def fail(x):
+            raise ValueError(x)
+        with pytest.raises(ValueError):
+            list(linksame._run_jobs(fail, [1, 2, 3], 2))
+
+    def test_exception_stops(self):
+        import threading
+        import time
+        started = []
+        running = []
+        lock = threading.Lock()
+
+        def func(x):
+            with lock:
+                started.append(x)
+                running.append(x)
+            try:
+                if x == 0:
+                    raise ValueError(x)
+                time.sleep(0.01)
+            finally:
+                with lock:
+                    running.remove(x)
+            return x
+
+        with pytest.raises(ValueError):
+            list(linksame._run_jobs(func, list(range(100)), 4))
+        # No item is still running, and the remaining items were not started.
+        assert running == []
+        assert len(started) < 100
+
+
+def _walk(root):
+    for dirpath, dirnames, filenames in os.walk(root):
+        for fname in filenames:
+            yield os.path.join(dirpath, fname)
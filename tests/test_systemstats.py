@@ -0,0 +1,556 @@
+"""
+Unit tests for systemstats module.
+
+Run with pytest.
+
+"""
+import platform
+import pytest
+import time
+
+# Uncomment to import from repo instead of site-packages.
+import os
+import sys
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, parentdir)
+
+from systemtools import systemstats
+
+linux_only = pytest.mark.skipif(platform.system() != 'Linux',
+                                reason='requires /proc')
+
+
+class TestUptimeLoad(object):
+
+    @linux_only
+    def test_proc(self):
+        up, load = systemstats.SystemStats()._proc_uptime_load()
+        assert sorted(up) == ['days', 'hours', 'minutes']
+        assert 0 <= up['hours'] < 24 and 0 <= up['minutes'] < 60
+        assert sorted(load) == ['fifteen', 'five', 'one']
+        assert all(isinstance(v, float) for v in load.values())
+
+    @linux_only
+    def test_same_as_command(self):
+        ss = systemstats.SystemStats()
+        up, _ = ss._proc_uptime_load()
+        cmd_up, _ = ss._cmd_uptime_load()
+        to_min = lambda u: (u['days'] * 24 + u['hours']) * 60 + u['minutes']
+        assert abs(to_min(up) - to_min(cmd_up)) <= 1
+
+    def test_command_once(self, monkeypatch):
+        # Without /proc, one run of uptime gives both uptime and load.
+        clock = [1000.0]
+
+        def monotonic():
+            clock[0] += 0.001
+            return clock[0]
+
+        calls = []
+
+        def cmd_uptime_load(self):
+            calls.append(1)
+            return {'days': 0, 'hours': 1, 'minutes': len(calls)}, {
+                'one': 0.5, 'five': 0.5, 'fifteen': 0.5}
+
+        monkeypatch.setattr(systemstats.time, 'monotonic', monotonic)
+        monkeypatch.setattr(systemstats.platform, 'system', lambda: 'FreeBSD')
+        monkeypatch.setattr(systemstats.SystemStats, '_cmd_uptime_load',
+                            cmd_uptime_load)
+        ss = systemstats.SystemStats()
+        ss.uptime()
+        ss.cpu_load()
+        assert len(calls) == 1
+        ss._cached('uptime', True)
+        ss._cached('cpu_load', True)
+        assert len(calls) == 2
+        assert ss.uptime()['minutes'] == 2
+        clock[0] += systemstats.STATS_TTL
+        ss.cpu_load()
+        ss.uptime()
+        assert len(calls) == 3
+
+
+class TestDiskUsage(object):
+
+    @linux_only
+    def test_proc_root(self):
+        disks = systemstats.SystemStats()._proc_disks()
+        part, size, used, avail, cap = disks['/']
+        assert size > 0 and used + avail <= size
+        assert 0 <= cap <= 100
+
+    @linux_only
+    def test_same_as_df(self):
+        ss = systemstats.SystemStats()
+        disks = ss._proc_disks()
+        for mount, (part, size, _, _, _) in ss._df_disks().items():
+            if mount in disks:
+                assert disks[mount][1] == size
+
+    def test_disk_usage(self):
+        ds = systemstats.SystemStats(show_bytes=True).disk_usage()
+        for info in ds.values():
+            assert sorted(info) == ['available', 'capacity', 'partition',
+                                    'size', 'used']
+
+    def test_unescape_mount(self):
+        assert systemstats._unescape_mount(r'/mnt/a\040b') == '/mnt/a b'
+        assert systemstats._unescape_mount('/mnt/ab') == '/mnt/ab'
+
+    def test_capacity(self):
+        assert systemstats._capacity(1, 2) == 34
+        assert systemstats._capacity(0, 0) == 0
+
+    def test_disk_stats(self):
+        ss = systemstats.SystemStats(show_bytes=True)
+        ds = ss.disk_stats()
+        du = ds.get('/')
+        if du is None:
+            pytest.skip('/ not mounted')
+        assert isinstance(du, systemstats.DiskUsage)
+        assert isinstance(du.size, int)
+        info = ss.disk_usage()['/']
+        assert info['size'] == '%d (%s)' % (du.size,
+                                            systemstats.size_str(du.size))
+        assert info['capacity'] == '%d%%' % (du.capacity,)
+
+
+class TestMemoryUsage(object):
+
+    @linux_only
+    def test_memory_stats(self):
+        mem = systemstats.SystemStats().memory_stats()
+        assert isinstance(mem, systemstats.MemoryUsage)
+        assert mem.total > 0
+        assert mem.used + mem.available == mem.total
+
+    def test_memory_usage(self):
+        ss = systemstats.SystemStats()
+        mem = ss.memory_stats()
+        info = ss.memory_usage()
+        assert sorted(info) == sorted(mem._fields)
+        if mem.total is None:
+            assert info['total'] == 'n/a'
+        else:
+            assert info['total'] == systemstats.size_str(mem.total)
+
+    def test_raw_stats(self):
+        raw = systemstats.SystemStats().raw_stats()
+        assert sorted(raw) == sorted(systemstats.SystemStats().stats())
+        assert isinstance(raw['memory_usage'], systemstats.MemoryUsage)
+
+
+def test_benchmark():
+    results = systemstats.benchmark(2)
+    assert all(secs > 0 for _, secs in results)
+
+
+class TestCpuSampler(object):
+
+    def _write(self, path, lines):
+        with open(path, 'w') as f:
+            f.write('\n'.join(lines) + '\nintr 1 2 3\n')
+
+    def test_deltas(self, tmpdir):
+        path = str(tmpdir.join('stat'))
+        self._write(path, ['cpu  100 0 50 800 50 0 0 0 0 0',
+                           'cpu0 100 0 50 800 50 0 0 0 0 0'])
+        sampler = systemstats.CpuSampler(path)
+        usage = sampler.sample()
+        assert sorted(usage) == ['cpu', 'cpu0']
+        assert usage['cpu'] == systemstats.CpuUsage(10.0, 5.0, 5.0, 0.0, 80.0)
+
+        # user+nice 30, system+irq+softirq 20, idle 40, steal 10
+        self._write(path, ['cpu  120 10 60 840 50 5 5 10 0 0',
+                           'cpu0 120 10 60 840 50 5 5 10 0 0'])
+        usage = sampler.sample()
+        assert usage['cpu0'] == systemstats.CpuUsage(30.0, 20.0, 0.0, 10.0,
+                                                     40.0)
+
+        # No change since previous sample.
+        usage = sampler.sample()
+        assert usage['cpu'].idle == 100.0
+
+    def test_missing(self, tmpdir):
+        sampler = systemstats.CpuSampler(str(tmpdir.join('none')))
+        assert sampler.sample() == {}
+
+    @linux_only
+    def test_cpu_usage_str(self):
+        ss = systemstats.SystemStats()
+        assert 'cpu\tuser=' in ss.cpu_usage_str()
+        for cu in ss.cpu_usage().values():
+            assert abs(sum(cu) - 100.0) < 0.01
+
+
+class TestStatsSampler(object):
+
+    def _sampler(self, monkeypatch, history=5):
+        clock = [100.0]
+        monkeypatch.setattr(systemstats.time, 'monotonic', lambda: clock[0])
+        values = iter(range(1, 100))
+
+        def collect():
+            v = next(values)
+            d = {'n': float(v)}
+            if v % 2:
+                d['odd'] = float(v)
+            return d
+
+        sampler = systemstats.StatsSampler(1.0, history, [collect])
+        return sampler, clock
+
+    def test_aggregate(self, monkeypatch):
+        sampler, clock = self._sampler(monkeypatch)
+        assert sampler.aggregate('n', 10) is None
+        for _ in range(3):
+            sampler.sample()
+            clock[0] += 1.0
+        assert sampler.metrics() == ['n', 'odd']
+        assert sampler.latest('n') == 3.0
+        assert sampler.aggregate('n', 10) == systemstats.Aggregate(
+            3, 1.0, 3.0, 2.0, 3.0)
+        # Only the samples in the last 2 seconds.
+        assert sampler.aggregate('n', 2).count == 2
+        # Missing values are skipped.
+        assert sampler.aggregate('odd', 10) == systemstats.Aggregate(
+            2, 1.0, 3.0, 2.0, 3.0)
+        assert sampler.aggregate('none', 10) is None
+
+    def test_wrap(self, monkeypatch):
+        sampler, clock = self._sampler(monkeypatch, history=5)
+        for _ in range(12):
+            sampler.sample()
+            clock[0] += 1.0
+        agg = sampler.aggregate('n', 100)
+        assert agg == systemstats.Aggregate(5, 8.0, 12.0, 10.0, 12.0)
+        assert sampler.aggregate('n', 3).min == 10.0
+        assert sampler.latest('n') == 12.0
+
+    def test_drop_missing(self, monkeypatch):
+        clock = [1000.0]
+        monkeypatch.setattr(systemstats.time, 'monotonic', lambda: clock[0])
+        names = iter('net_rx:veth%d' % i for i in range(1000))
+        sampler = systemstats.StatsSampler(
+            1.0, 5, [lambda: {'x': 1.0, next(names): 1.0}])
+        for _ in range(1000):
+            sampler.sample()
+            clock[0] += 1.0
+        # Only metrics with a value among the last 5 samples are kept.
+        assert sampler.metrics() == ['net_rx:veth%d' % i
+                                     for i in range(995, 1000)] + ['x']
+        assert sampler.aggregate('x', 100).count == 5
+        assert sampler.aggregate('net_rx:veth995', 100).count == 1
+
+    def test_p95(self, monkeypatch):
+        import random
+        values = [random.random() for _ in range(1000)]
+        it = iter(values)
+        clock = [1000.0]
+        monkeypatch.setattr(systemstats.time, 'monotonic', lambda: clock[0])
+        sampler = systemstats.StatsSampler(1.0, 700, [lambda: {'x': next(it)}])
+        for _ in range(len(values)):
+            sampler.sample()
+            clock[0] += 1.0
+        for seconds in (1, 20, 333, 1000):
+            window = sorted(values[-min(seconds, 700):])
+            agg = sampler.aggregate('x', seconds)
+            assert agg.count == len(window)
+            assert agg.min == window[0] and agg.max == window[-1]
+            assert agg.p95 == window[min(len(window) - 1,
+                                         int(0.95 * len(window)))]
+
+    def test_thread(self):
+        sampler = systemstats.StatsSampler(0.01, 10, [lambda: {'x': 1.0}])
+        sampler.start()
+        try:
+            for _ in range(100):
+                if sampler.latest('x') is not None:
+                    break
+                time.sleep(0.01)
+        finally:
+            sampler.stop()
+        assert sampler.latest('x') == 1.0
+
+    @linux_only
+    def test_default_metrics(self):
+        sampler = systemstats.StatsSampler()
+        sampler.sample()
+        names = sampler.metrics()
+        for name in ('cpu_busy', 'load_one', 'mem_used'):
+            assert name in names
+
+
+class TestStatsCache(object):
+
+    def _counting(self, ss):
+        calls = []
+
+        def read():
+            calls.append(1)
+            return len(calls)
+
+        ss._read_memory_usage = read
+        return calls
+
+    def test_ttl(self, monkeypatch):
+        clock = [100.0]
+        monkeypatch.setattr(systemstats.time, 'monotonic', lambda: clock[0])
+        ss = systemstats.SystemStats(ttl={'memory_usage': 1})
+        self._counting(ss)
+        assert ss.memory_stats() == 1
+        clock[0] += 0.5
+        assert ss.memory_stats() == 1
+        clock[0] += 0.5
+        assert ss.memory_stats() == 2
+
+    def test_per_instance(self):
+        a = systemstats.SystemStats()
+        b = systemstats.SystemStats()
+        self._counting(a)
+        self._counting(b)
+        assert a.memory_stats() == 1
+        assert b.memory_stats() == 1
+        assert a.memory_stats() == 1
+
+    def test_shared(self, monkeypatch):
+        clock = [100.0]
+        monkeypatch.setattr(systemstats.time, 'monotonic', lambda: clock[0])
+        cache = systemstats.StatsCache()
+        fast = systemstats.SystemStats(ttl=1, cache=cache)
+        slow = systemstats.SystemStats(ttl=300, cache=cache)
+        self._counting(fast)
+        slow._read_memory_usage = fast._read_memory_usage
+        assert slow.memory_stats() == 1
+        clock[0] += 2
+        assert slow.memory_stats() == 1
+        assert fast.memory_stats() == 2
+        # The value read by one instance is used by the other.
+        assert slow.memory_stats() == 2
+
+    def test_refresh(self):
+        ss = systemstats.SystemStats()
+        calls = self._counting(ss)
+        ss.memory_stats()
+        ss.refresh(force=False)
+        assert len(calls) == 1
+        ss.refresh()
+        assert len(calls) == 2
+        assert ss.memory_stats() == 2
+
+    def test_bad_metric(self):
+        with pytest.raises(ValueError):
+            systemstats.SystemStats(ttl={'memory': 1})
+
+
+class TestDiskIOSampler(object):
+
+    LINE = '   8       0 %s %d 0 %d %d %d 0 %d %d 0 %d %d 0 0 0 0'
+
+    def _write(self, path, lines):
+        with open(path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+    def test_rates(self, tmpdir, monkeypatch):
+        clock = [1000.0]
+        monkeypatch.setattr(systemstats.time, 'monotonic', lambda: clock[0])
+        monkeypatch.setattr(systemstats, '_seconds_since_boot',
+                            lambda now: 100.0)
+        path = str(tmpdir.join('diskstats'))
+        # name, reads, sectors read, ms reading, writes, sectors written,
+        # ms writing, ms doing io, weighted ms
+        self._write(path, [self.LINE % ('sda', 100, 2000, 50, 100, 4000, 150,
+                                        1000, 2000),
+                           self.LINE % ('loop0', 0, 0, 0, 0, 0, 0, 0, 0)])
+        sampler = systemstats.DiskIOSampler(path)
+        io = sampler.sample()
+        assert sorted(io) == ['sda']
+        assert io['sda'].read_bytes == 2000 * 512 / 100.0
+        assert io['sda'].await_ms == 1.0
+
+        clock[0] += 2.0
+        self._write(path, [self.LINE % ('sda', 110, 2200, 70, 130, 4400, 230,
+                                        2000, 4000)])
+        io = sampler.sample()['sda']
+        assert io == systemstats.DiskIO(200 * 512 / 2.0, 400 * 512 / 2.0,
+                                        5.0, 15.0, 1.0, 2.5, 50.0)
+
+    def test_devices(self, tmpdir):
+        path = str(tmpdir.join('diskstats'))
+        self._write(path, [self.LINE % (name, 1, 1, 1, 1, 1, 1, 1, 1)
+                           for name in ('sda', 'sda1', 'nvme0n1')])
+        sampler = systemstats.DiskIOSampler(path, 'sd*')
+        assert sorted(sampler.sample()) == ['sda', 'sda1']
+
+    def test_missing(self, tmpdir):
+        sampler = systemstats.DiskIOSampler(str(tmpdir.join('none')))
+        assert sampler.sample() == {}
+
+    @linux_only
+    def test_disk_io_str(self):
+        ss = systemstats.SystemStats()
+        assert ss.disk_io_str().startswith('Disk I/O:')
+        assert isinstance(ss.raw_stats()['disk_io'], dict)
+
+
+class TestNetworkSampler(object):
+
+    HEADER = ['Inter-|   Receive                            |  Transmit',
+              ' face |bytes    packets errs drop fifo frame compressed '
+              'multicast|bytes    packets errs drop fifo colls carrier '
+              'compressed']
+    LINE = '%6s:%d %d %d %d 0 0 0 0 %d %d %d %d 0 0 0 0'
+
+    def _write(self, path, lines):
+        with open(path, 'w') as f:
+            f.write('\n'.join(self.HEADER + lines) + '\n')
+
+    def test_rates(self, tmpdir, monkeypatch):
+        clock = [1000.0]
+        monkeypatch.setattr(systemstats.time, 'monotonic', lambda: clock[0])
+        monkeypatch.setattr(systemstats, '_seconds_since_boot',
+                            lambda now: 100.0)
+        path = str(tmpdir.join('dev'))
+        self._write(path, [self.LINE % ('eth0', 10000, 100, 1, 2,
+                                        20000, 200, 3, 4)])
+        sampler = systemstats.NetworkSampler(path)
+        net = sampler.sample()['eth0']
+        assert net.rx_bytes == 100.0
+        assert net.tx_packets == 2.0
+        assert net.rx_errors == 1
+
+        clock[0] += 2.0
+        self._write(path, [self.LINE % ('eth0', 12000, 110, 1, 3,
+                                        26000, 220, 5, 4)])
+        net = sampler.sample()['eth0']
+        assert net == systemstats.NetworkUsage(1000.0, 3000.0, 5.0, 10.0,
+                                               0, 2, 1, 0)
+
+    def test_wraparound(self, tmpdir, monkeypatch):
+        clock = [1000.0]
+        monkeypatch.setattr(systemstats.time, 'monotonic', lambda: clock[0])
+        path = str(tmpdir.join('dev'))
+        self._write(path, [self.LINE % ('eth0', 2**32 - 100, 0, 0, 0,
+                                        2**32 - 50, 0, 0, 0)])
+        sampler = systemstats.NetworkSampler(path)
+        sampler.sample()
+        clock[0] += 1.0
+        self._write(path, [self.LINE % ('eth0', 400, 0, 0, 0, 150, 0, 0, 0)])
+        net = sampler.sample()['eth0']
+        assert net.rx_bytes == 500.0
+        assert net.tx_bytes == 200.0
+
+    def test_reset(self, tmpdir, monkeypatch):
+        clock = [1000.0]
+        monkeypatch.setattr(systemstats.time, 'monotonic', lambda: clock[0])
+        path = str(tmpdir.join('dev'))
+        self._write(path, [self.LINE % ('veth0', 1000000, 500, 2, 0,
+                                        2**40, 800, 0, 0)])
+        sampler = systemstats.NetworkSampler(path)
+        sampler.sample()
+        clock[0] += 1.0
+        # Interface re-created, so the counters start again from zero.
+        self._write(path, [self.LINE % ('veth0', 10, 1, 0, 0, 20, 2, 0, 0)])
+        net = sampler.sample()['veth0']
+        assert net == systemstats.NetworkUsage(10.0, 20.0, 1.0, 2.0,
+                                               0, 0, 0, 0)
+        assert systemstats._counter_delta(10, 1000000) == 10
+
+    def test_interfaces(self, tmpdir):
+        path = str(tmpdir.join('dev'))
+        self._write(path, [self.LINE % (name, 1, 1, 0, 0, 1, 1, 0, 0)
+                           for name in ('lo', 'eth0', 'eth1')])
+        sampler = systemstats.NetworkSampler(path, 'eth*')
+        assert sorted(sampler.sample()) == ['eth0', 'eth1']
+
+    def test_missing(self, tmpdir):
+        sampler = systemstats.NetworkSampler(str(tmpdir.join('none')))
+        assert sampler.sample() == {}
+
+    @linux_only
+    def test_network_usage_str(self):
+        ss = systemstats.SystemStats()
+        assert ss.network_usage_str().startswith('Network Usage:')
+        assert 'lo' in ss.network_usage()
+        assert list(ss.network_usage('lo')) == ['lo']
+        assert isinstance(ss.raw_stats()['network_usage'], dict)
+
+
+class TestProcessStats(object):
+
+    STAT = ('%d (%s) S 1 %d %d 0 -1 4194560 100 0 0 0 250 50 0 0 20 0 %d 0 '
+            '1000 10000000 %d 18446744073709551615 1 1 0 0 0 0 0 0 0 0 0 0 '
+            '17 0 0 0 0 0 0')
+    IO = ('rchar: 5000\nwchar: 6000\nsyscr: 10\nsyscw: 20\n'
+          'read_bytes: %d\nwrite_bytes: %d\ncancelled_write_bytes: 0\n')
+
+    def _make_proc(self, tmpdir, pid, name, threads, rss_pages, fds=None,
+                   io=None):
+        d = tmpdir.join(str(pid))
+        d.ensure(dir=True)
+        d.join('stat').write(self.STAT % (pid, name, pid, pid, threads,
+                                          rss_pages))
+        if fds is not None:
+            fd_dir = d.join('fd')
+            fd_dir.ensure(dir=True)
+            for i in range(fds):
+                fd_dir.join(str(i)).write('')
+        if io is not None:
+            d.join('io').write(self.IO % io)
+
+    def test_process_stats(self, tmpdir):
+        self._make_proc(tmpdir, 10, 'sh', 1, 100, fds=3, io=(4096, 8192))
+        self._make_proc(tmpdir, 20, 'odd) name (x', 4, 50)
+        tmpdir.join('self').ensure(dir=True)
+        stats = systemstats.process_stats(proc=str(tmpdir))
+        assert sorted(stats) == [10, 20]
+        p = stats[10]
+        page_size = os.sysconf('SC_PAGE_SIZE')
+        clk_tck = os.sysconf('SC_CLK_TCK')
+        assert p == systemstats.ProcessStats(
+            10, 'sh', 'S', 1, 1, 100 * page_size, 300.0 / clk_tck, 3,
+            4096, 8192)
+        p = stats[20]
+        assert p.name == 'odd) name (x'
+        assert p.threads == 4
+        assert p.fds is None
+        assert p.read_bytes is None
+
+    def test_skip(self, tmpdir):
+        self._make_proc(tmpdir, 10, 'sh', 1, 100, fds=3, io=(1, 2))
+        stats = systemstats.process_stats(pids=[10, 11], fds=False, io=False,
+                                          proc=str(tmpdir))
+        assert list(stats) == [10]
+        assert stats[10].fds is None
+        assert stats[10].write_bytes is None
+
+    def test_top_processes(self, tmpdir):
+        self._make_proc(tmpdir, 10, 'a', 1, 100, fds=1, io=(10, 0))
+        self._make_proc(tmpdir, 20, 'b', 8, 300, fds=5)
+        self._make_proc(tmpdir, 30, 'c', 2, 200, fds=2, io=(0, 40))
+        proc = str(tmpdir)
+        top = systemstats.top_processes('rss', 2, proc=proc)
+        assert [p.pid for p in top] == [20, 30]
+        top = systemstats.top_processes('fds', proc=proc)
+        assert [p.pid for p in top] == [20, 30, 10]
+        top = systemstats.top_processes('io_bytes', proc=proc)
+        assert [p.pid for p in top] == [30, 10]
+        stats = systemstats.process_stats(proc=proc)
+        top = systemstats.top_processes('threads', 1, stats)
+        assert top[0].name == 'b'
+        with pytest.raises(ValueError):
+            systemstats.top_processes('bogus', proc=proc)
+
+    def test_missing(self, tmpdir):
+        proc = str(tmpdir.join('none'))
+        assert systemstats.process_stats(proc=proc) == {}
+        assert systemstats.top_processes(proc=proc) == []
+
+    @linux_only
+    def test_self(self):
+        pid = os.getpid()
+        p = systemstats.process_stats([pid])[pid]
+        assert p.rss > 0
+        assert p.fds > 0
+        assert p.ppid == os.getppid()